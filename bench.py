@@ -0,0 +1,401 @@
+# bench.py
+"""Load test: replays synthetic Telegram updates through the real handlers.
+
+Each run builds a synthetic dataset, imports the bot against it and drives a mix of
+user sessions (/start, wallet, redeem, withdraw, cancel, admin listings) through
+`Application.process_update`, with the Bot API answered in-process. Every configuration
+runs in its own subprocess so startup time and peak RSS are measured cleanly.
+
+    python bench.py --users 10000 100000 1000000 --backend json sqlite redis --out results.json
+    python bench.py --users 100000 --baseline results.json   # Compare against an earlier run
+
+Results are printed and written as JSON: throughput, per-step latency percentiles,
+startup/save_data/shutdown times and peak RSS for every (backend, users) pair. The redis
+backend runs against an in-process fakeredis server, so it measures the bot's side of
+Redis but no network.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+
+from telegram.request import BaseRequest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BENCH_ADMIN_ID = 1  # Admin id written into the synthetic config
+FIRST_USER_ID = 10_000_000  # Synthetic users are FIRST_USER_ID + 0..n-1
+BENCH_REDIS_URL = "memory://bench"  # Shared by the import and the bot within the run's process
+
+# Sessions per 100, by kind
+DEFAULT_MIX = {"start": 30, "wallet": 20, "redeem": 15, "withdraw": 10, "cancel": 10, "admin": 5,
+               "earn": 10}
+
+
+# --- FAKE BOT API ---
+class FakeBotAPI(BaseRequest):
+    """Answers every Bot API call in-process with a minimal valid result."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        if api_method == "getMe":
+            result = {"id": 42, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif api_method in ("sendMessage", "editMessageText"):
+            params = request_data.parameters if request_data is not None else {}
+            result = {"message_id": next(self._message_ids), "date": int(time.time()),
+                      "chat": {"id": int(params.get("chat_id", 1)), "type": "private"}, "text": "ok"}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# --- SYNTHETIC DATA ---
+def make_dataset(users, seed):
+    """Returns (data, plan); the plan tells sessions which codes and withdrawals exist."""
+    from storage import RedemptionSet
+
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    user_ids = [str(FIRST_USER_ID + i) for i in range(users)]
+    data = {
+        "users": {},
+        "codes": {},
+        "links": [{"title": f"Task {i}", "url": f"https://example.com/{i}"} for i in range(10)],
+        "config": {"support_info": "@support", "how_to_video": "https://example.com/video",
+                   "admins": [BENCH_ADMIN_ID]},
+        "pending_withdrawals": {},
+        "ledger": {"units": "paise", "seq": 0},  # Amounts below are paise; write_dataset opens the log
+    }
+    for i, user_id in enumerate(user_ids):
+        data["users"][user_id] = {
+            "balance": rng.choice((0, 0, 500, 1000, 2500, 10000)),
+            "joined_at": (start + timedelta(seconds=i * 7)).isoformat(),
+            "redeemed_codes": [], "pending_withdrawals": [], "withdrawal_history": [],
+        }
+
+    codes = []
+    for i in range(max(100, users // 100)):
+        code = f"CODE{i:07d}"
+        used_by = RedemptionSet(rng.sample(user_ids, min(len(user_ids), rng.randint(0, 200))))
+        data["codes"][code] = {"value": rng.choice((100, 200, 500)), "used_by": used_by}
+        codes.append(code)
+
+    withdrawals = []
+    for i in range(max(50, users // 10)):
+        user_id = rng.choice(user_ids)
+        request = {"id": str(uuid.UUID(int=rng.getrandbits(128), version=4)), "user_id": user_id,
+                   "amount": rng.choice((100, 500, 1000)), "upi": "bench@upi",
+                   "timestamp": (start + timedelta(seconds=i * 13)).isoformat()}
+        data["pending_withdrawals"][request["id"]] = request
+        data["users"][user_id]["pending_withdrawals"].append(request["id"])
+        withdrawals.append((user_id, request["id"]))
+
+    return data, {"users": users, "codes": codes, "withdrawals": withdrawals}
+
+def write_dataset(workdir, backend, users, seed):
+    """Writes the dataset for `backend` and its plan (plan.json) into `workdir`."""
+    from storage import TransactionLog, encode_json_object
+
+    data, plan = make_dataset(users, seed)
+    json_path = os.path.join(workdir, "data.json")
+    if backend in ("json", "redis"):
+        log = TransactionLog.open(os.path.join(workdir, "ledger.db"))
+        with log.batch():
+            log.append_openings((user_id, user["balance"]) for user_id, user in data["users"].items())
+        data["ledger"]["seq"] = log.last_id()
+        log.close()
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, default=encode_json_object)
+    del data
+    if backend == "sqlite":
+        from storage import migrate_json_to_sqlite
+        migrate_json_to_sqlite(json_path, os.path.join(workdir, "data.db"))
+        os.remove(json_path)
+    with open(os.path.join(workdir, "plan.json"), "w", encoding="utf-8") as f:
+        json.dump(plan, f)
+
+
+# --- SYNTHETIC UPDATES ---
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {"id": int(user_id), "is_bot": False, "first_name": "Bench"}
+
+    def _message(self, user_id, text, entities=None):
+        message = {"message_id": next(self._update_ids), "date": int(time.time()),
+                   "chat": {"id": int(user_id), "type": "private"}, "from": self._user(user_id), "text": text}
+        if entities:
+            message["entities"] = entities
+        return message
+
+    def _update(self, payload):
+        from telegram import Update
+        return Update.de_json(dict(payload, update_id=next(self._update_ids)), self.bot)
+
+    def command(self, user_id, command):
+        entity = [{"type": "bot_command", "offset": 0, "length": len(command) + 1}]
+        return self._update({"message": self._message(user_id, f"/{command}", entity)})
+
+    def text(self, user_id, text):
+        return self._update({"message": self._message(user_id, text)})
+
+    def callback(self, user_id, data):
+        return self._update({"callback_query": {
+            "id": str(next(self._update_ids)), "from": self._user(user_id), "chat_instance": "bench",
+            "data": data, "message": self._message(BENCH_ADMIN_ID if data.startswith("a") else user_id, "menu")}})
+
+
+def make_sessions(plan, count, mix, seed, repo):
+    """Returns a list of sessions; each is a list of (step label, update factory call)."""
+    from main import USER_ORDERS, WITHDRAWAL_ORDERS, encode_cursor
+
+    rng = random.Random(seed + 1)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    withdrawals = list(plan["withdrawals"])
+    rng.shuffle(withdrawals)
+    new_users = (str(90_000_000 + i) for i in itertools.count())
+
+    sessions = []
+    for _ in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        user_id = str(FIRST_USER_ID + rng.randrange(plan["users"]))
+        if kind == "start":
+            user_id = next(new_users) if rng.random() < 0.3 else user_id
+            steps = [("start", lambda f, u=user_id: f.command(u, "start"))]
+        elif kind == "wallet":
+            steps = [("wallet", lambda f, u=user_id: f.callback(u, "user_wallet"))]
+        elif kind == "earn":
+            steps = [("earn", lambda f, u=user_id: f.callback(u, "user_earn"))]
+        elif kind == "redeem":
+            code = rng.choice(plan["codes"]) if rng.random() < 0.9 else "NOSUCHCODE"
+            steps = [("redeem_start", lambda f, u=user_id: f.callback(u, "user_redeem")),
+                     ("redeem_code", lambda f, u=user_id, c=code: f.text(u, c))]
+        elif kind == "withdraw":
+            steps = [("withdraw_start", lambda f, u=user_id: f.callback(u, "user_withdraw")),
+                     ("withdraw_amount", lambda f, u=user_id: f.text(u, "1")),
+                     ("withdraw_upi", lambda f, u=user_id: f.text(u, "bench@upi"))]
+        elif kind == "cancel" and withdrawals:
+            user_id, w_id = withdrawals.pop()
+            steps = [("cancel_list", lambda f, u=user_id: f.callback(u, "user_cancel_withdraw_list")),
+                     ("cancel_withdrawal",
+                      lambda f, u=user_id, w=w_id: f.callback(u, f"user_cancel_withdraw_confirm_{w}"))]
+        else:
+            order = rng.choice(list(USER_ORDERS.values()))
+            first = repo.page_users(order, limit=5)
+            w_order = rng.choice(list(WITHDRAWAL_ORDERS.values()))
+            steps = [("admin_view_users", lambda f, o=order: f.callback(BENCH_ADMIN_ID, f"avu|{o.code}")),
+                     ("admin_view_withdrawals", lambda f, o=w_order: f.callback(BENCH_ADMIN_ID, f"avw|{o.code}"))]
+            if first.has_next:
+                data = encode_cursor("avu", order, False, first.last)
+                steps.append(("admin_view_users", lambda f, d=data: f.callback(BENCH_ADMIN_ID, d)))
+            user_id = BENCH_ADMIN_ID
+        sessions.append((user_id, steps))
+    return sessions
+
+
+# --- ONE RUN ---
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return {"count": len(samples), "p50_ms": pick(0.50), "p90_ms": pick(0.90), "p99_ms": pick(0.99),
+            "max_ms": samples[-1] * 1000, "mean_ms": sum(samples) / len(samples) * 1000}
+
+def peak_rss_mb():
+    # VmHWM starts afresh at exec; ru_maxrss can carry over the parent's peak on Linux
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+async def drive(main, plan, args):
+    api = FakeBotAPI()
+    application = main.build_application(request=api)
+    await application.initialize()
+    await main.post_init(application)
+    factory = UpdateFactory(application.bot)
+    sessions = make_sessions(plan, args.sessions, DEFAULT_MIX, args.seed, main.repo)
+
+    latencies = defaultdict(list)
+    user_locks = defaultdict(asyncio.Lock)  # One session per user at a time, like a real chat
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_session(user_id, steps):
+        # Wait for the user's previous session before taking a slot; admin sessions overlap
+        async with user_locks[user_id] if user_id != BENCH_ADMIN_ID else nullcontext(), semaphore:
+            for label, make in steps:
+                update = make(factory)
+                started = time.perf_counter()
+                await application.process_update(update)
+                latencies[label].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_session(user_id, steps) for user_id, steps in sessions))
+    elapsed = time.perf_counter() - started
+
+    started_save = time.perf_counter()
+    await main.save_data(urgent=True)
+    save_seconds = time.perf_counter() - started_save
+
+    persistence = getattr(main.repo, "persistence", None)
+    stats = {name: getattr(persistence, name) for name in
+             ("flushes", "records_written", "bytes_written", "last_flush_seconds")} if persistence else {}
+    started_close = time.perf_counter()
+    await application.shutdown()
+    await main.post_shutdown(application)
+    close_seconds = time.perf_counter() - started_close
+
+    updates = sum(len(samples) for samples in latencies.values())
+    return {
+        "updates": updates,
+        "seconds": elapsed,
+        "updates_per_second": updates / elapsed if elapsed else 0.0,
+        "latency": percentiles([s for samples in latencies.values() for s in samples]),
+        "steps": {label: percentiles(samples) for label, samples in sorted(latencies.items())},
+        "save_data_seconds": save_seconds,
+        "shutdown_seconds": close_seconds,
+        "persistence": stats,
+        "bot_api_calls": dict(api.calls),
+    }
+
+def run_one(args):
+    """Runs the bot against the dataset in `args.workdir` and prints the result as one JSON line."""
+    workdir = args.workdir
+    with open(os.path.join(workdir, "plan.json"), "r", encoding="utf-8") as f:
+        plan = json.load(f)
+    data_file_mb = sum(os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir)) / 2**20
+    os.chdir(workdir)
+    os.environ["STORAGE_BACKEND"] = args.backend[0]
+    os.environ["SQLITE_FILE"] = os.path.join(workdir, "data.db")
+    os.environ["REDIS_URL"] = BENCH_REDIS_URL
+    if args.backend[0] == "redis":  # The in-process server only lives as long as this process
+        from shared_state import migrate_json_to_redis
+        migrate_json_to_redis(os.path.join(workdir, "data.json"), BENCH_REDIS_URL,
+                              ledger_path=os.path.join(workdir, "ledger.db"))
+    os.environ["CONCURRENT_UPDATES"] = str(args.concurrency)
+    os.environ["METRICS_PORT"] = "0"
+
+    started = time.perf_counter()
+    import main  # Loads the dataset
+    startup_seconds = time.perf_counter() - started
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+
+    result = asyncio.run(drive(main, plan, args))
+    result.update({
+        "backend": args.backend[0],
+        "users": args.users[0],
+        "sessions": args.sessions,
+        "concurrency": args.concurrency,
+        "startup_seconds": startup_seconds,
+        "data_file_mb": data_file_mb,
+        "peak_rss_mb": peak_rss_mb(),
+    })
+    print(json.dumps(result))
+
+
+# --- DRIVER ---
+def summarize(result, baseline=None):
+    line = (f"{result['backend']:>6} {result['users']:>8} users | {result['updates_per_second']:8.0f} upd/s | "
+            f"p50 {result['latency']['p50_ms']:6.2f}ms p99 {result['latency']['p99_ms']:7.2f}ms | "
+            f"startup {result['startup_seconds']:6.2f}s save {result['save_data_seconds'] * 1000:6.1f}ms "
+            f"shutdown {result['shutdown_seconds']:5.2f}s | "
+            f"rss {result['peak_rss_mb']:7.1f}MB")
+    if baseline:
+        change = lambda key: (result[key] / baseline[key] - 1) * 100 if baseline.get(key) else 0.0
+        line += (f"\n{'':>22}vs baseline: throughput {change('updates_per_second'):+.1f}% "
+                 f"p99 {(result['latency']['p99_ms'] / baseline['latency']['p99_ms'] - 1) * 100:+.1f}% "
+                 f"startup {change('startup_seconds'):+.1f}% rss {change('peak_rss_mb'):+.1f}%")
+    return line
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--backend", nargs="+", default=["json"], choices=["json", "sqlite", "redis"])
+    parser.add_argument("--sessions", type=int, default=5000, help="User sessions replayed per run")
+    parser.add_argument("--concurrency", type=int, default=32, help="Sessions in flight at once")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="Write all results to this JSON file")
+    parser.add_argument("--baseline", help="Earlier --out file to compare against")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary data directories")
+    parser.add_argument("--run-one", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    sys.path.insert(0, HERE)
+    if args.run_one:
+        run_one(args)
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = {(r["backend"], r["users"]): r for r in json.load(f)["results"]}
+
+    results = []
+    for backend, users in itertools.product(args.backend, args.users):
+        workdir = tempfile.mkdtemp(prefix="bench-")
+        try:
+            started = time.perf_counter()
+            write_dataset(workdir, backend, users, args.seed)
+            dataset_seconds = time.perf_counter() - started
+            cmd = [sys.executable, os.path.abspath(__file__), "--run-one", "--workdir", workdir,
+                   "--backend", backend, "--users", str(users), "--sessions", str(args.sessions),
+                   "--concurrency", str(args.concurrency), "--seed", str(args.seed)]
+            proc = subprocess.run(cmd, capture_output=True, text=True)
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+        if proc.returncode != 0:
+            print(f"{backend} {users}: failed\n{proc.stderr[-2000:]}", file=sys.stderr)
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        result["dataset_seconds"] = dataset_seconds
+        results.append(result)
+        print(summarize(result, baseline.get((backend, users))))
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"created_at": datetime.now().isoformat(), "python": sys.version.split()[0],
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+# broadcast.py
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+
+from outbound import BULK, NOTIFY, outbound_priority
+from pagination import USER_ORDERS
+from persistence import atomic_write_bytes
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows ~30 messages/second overall to different chats; stay a little below it.
+GLOBAL_RATE = 25
+BATCH_SIZE = 200  # Recipients per checkpoint
+MAX_ATTEMPTS = 3  # Per recipient, for network errors (RetryAfter doesn't count)
+# Recipients are walked in join order, so users who join mid-broadcast land after the cursor
+RECIPIENT_ORDER = USER_ORDERS["j"]
+
+
+class TokenBucket:
+    """Async token bucket. `pause` blocks every caller, e.g. after a RetryAfter."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Broadcaster:
+    """Sends one message to every user, resumably and within Telegram's flood limits.
+
+    The job (text, cursor and counters) is checkpointed to `state_path` after every batch of
+    recipients, so a restart resumes from the last finished batch; at most one batch can be
+    delivered twice. The cursor is the (join date, id) of the last recipient, so each batch
+    is one keyset seek however far along the job is, and deleting users doesn't shift it. Users who blocked the bot are pruned at the end, unless they still have
+    money or pending withdrawals. Progress is edited into the admin's message as it runs.
+    """
+
+    def __init__(self, repo, state_path, rate=GLOBAL_RATE, concurrency=20, progress_interval=5.0):
+        self.repo = repo
+        self.state_path = state_path
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.job = None
+        self._task = None
+
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+
+    # --- Job lifecycle ---
+    def start(self, bot, text, admin_chat_id, progress_message_id):
+        """Starts a new broadcast. Returns False if one is already running."""
+        if self.is_running():
+            return False
+        self.job = {
+            "id": str(uuid.uuid4()),
+            "text": text,
+            "admin_chat_id": admin_chat_id,
+            "progress_message_id": progress_message_id,
+            "cursor": 0,  # Recipients done, for progress
+            "after": None,  # (joined_at, user_id) of the last one
+            "total": self.repo.count_users(),
+            "sent": 0,
+            "failed": 0,
+            "blocked_total": 0,
+            "blocked": [],  # Not yet pruned
+            "started_at": time.time(),
+            "status": "running",
+        }
+        self._task = asyncio.create_task(self._run(bot))
+        return True
+
+    def resume(self, bot):
+        """Continues an unfinished job left in the state file. Returns True if one was found."""
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            return False
+        if job.get("status") != "running":
+            return False
+        logger.info("Resuming broadcast %s at recipient %d/%d", job["id"], job["cursor"], job["total"])
+        if "after" not in job:
+            # Checkpointed by an older version as an offset in storage order: start over in join
+            # order, skipping the recipients that offset covered
+            job["after"] = None
+            job["skip"] = self.repo.list_user_ids(0, job["cursor"])
+        self.job = job
+        self._task = asyncio.create_task(self._run(bot))
+        return True
+
+    def cancel(self):
+        if self.is_running():
+            self.job["status"] = "cancelled"
+            self._task.cancel()
+
+    async def stop(self):
+        """Stops the task on shutdown, leaving the job resumable."""
+        if self.is_running():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _checkpoint(self):
+        payload = json.dumps(self.job).encode("utf-8")
+        await asyncio.get_running_loop().run_in_executor(None, atomic_write_bytes, self.state_path, payload)
+
+    # --- Sending ---
+    async def _run(self, bot):
+        job = self.job
+        await self._checkpoint()
+        last_report = 0.0
+        try:
+            skip = set(job.get("skip", ()))
+            while True:
+                after = tuple(job["after"]) if job["after"] else None
+                page = self.repo.page_users(RECIPIENT_ORDER, after, limit=BATCH_SIZE)
+                if not page.items:
+                    break
+                batch = [user["user_id"] for user in page.items if user["user_id"] not in skip]
+                if batch:
+                    await self._send_batch(bot, batch)
+                job["cursor"] += len(page.items)
+                job["after"] = list(page.last)
+                await self._checkpoint()
+                if not page.has_next:
+                    break
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    await self._report(bot)
+            job["status"] = "done"
+        except asyncio.CancelledError:
+            if job["status"] != "cancelled":
+                raise  # Shutdown: keep the checkpoint as "running" so it resumes
+        finally:
+            if job["status"] != "running":
+                self._prune_blocked()
+                await self._checkpoint()
+                await self._report(bot)
+
+    async def _send_batch(self, bot, user_ids):
+        queue = asyncio.Queue()
+        for user_id in user_ids:
+            queue.put_nowait(user_id)
+
+        async def worker():
+            while not queue.empty():
+                user_id = queue.get_nowait()
+                result = await self._send_one(bot, user_id)
+                if result == "sent":
+                    self.job["sent"] += 1
+                elif result == "blocked":
+                    self.job["blocked_total"] += 1
+                    self.job["blocked"].append(user_id)
+                else:
+                    self.job["failed"] += 1
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(user_ids)))))
+
+    async def _send_one(self, bot, user_id):
+        attempts = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                with outbound_priority(BULK):  # Queued behind every interactive reply
+                    await bot.send_message(chat_id=int(user_id), text=self.job["text"], parse_mode=ParseMode.HTML)
+                return "sent"
+            except RetryAfter as e:
+                logger.warning("Broadcast hit flood control, pausing for %ss", e.retry_after)
+                self.bucket.pause(float(e.retry_after))
+            except Forbidden:
+                return "blocked"
+            except BadRequest as e:
+                if "chat not found" in e.message.lower():
+                    return "blocked"
+                logger.warning("Broadcast to %s rejected: %s", user_id, e.message)
+                return "failed"
+            except NetworkError as e:
+                attempts += 1
+                if attempts >= MAX_ATTEMPTS:
+                    logger.warning("Broadcast to %s failed: %s", user_id, e)
+                    return "failed"
+                await asyncio.sleep(2 ** attempts)
+
+    def _prune_blocked(self):
+        """Removes users who blocked the bot and have nothing left to lose."""
+        pruned = 0
+        for user_id in self.job["blocked"]:
+            user = self.repo.get_user(user_id)
+            if user is None or user["balance"] > 0 or self.repo.get_user_withdrawals(user_id):
+                continue
+            self.repo.delete_user(user_id)
+            pruned += 1
+        self.job["blocked"] = []
+        self.job["pruned"] = self.job.get("pruned", 0) + pruned
+        self.repo.commit()
+
+    # --- Progress ---
+    def progress_text(self):
+        job = self.job
+        elapsed = max(time.time() - job["started_at"], 1e-6)
+        title = {"running": "📣 Broadcasting…", "done": "✅ Broadcast finished",
+                 "cancelled": "🛑 Broadcast cancelled"}[job["status"]]
+        text = (
+            f"<b>{title}</b>\n\n"
+            f"<b>Progress:</b> {job['cursor']}/{job['total']}\n"
+            f"<b>Sent:</b> {job['sent']} | <b>Failed:</b> {job['failed']} | "
+            f"<b>Blocked:</b> {job['blocked_total']}\n"
+            f"<b>Throughput:</b> {job['sent'] / elapsed:.1f} msg/s"
+        )
+        if job["status"] != "running":
+            text += f"\n<b>Pruned users:</b> {job.get('pruned', 0)}"
+        return text
+
+    async def _report(self, bot):
+        job = self.job
+        reply_markup = None
+        if job["status"] == "running":
+            reply_markup = InlineKeyboardMarkup(
+                [[InlineKeyboardButton("🛑 Stop Broadcast", callback_data="admin_broadcast_cancel")]])
+        try:
+            with outbound_priority(NOTIFY):
+                await bot.edit_message_text(
+                    chat_id=job["admin_chat_id"], message_id=job["progress_message_id"],
+                    text=self.progress_text(), reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        except TelegramError as e:  # Including RetryAfter: the next report will catch up
+            logger.info("Could not update broadcast progress: %s", e)
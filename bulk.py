@@ -0,0 +1,148 @@
+# bulk.py
+
+import asyncio
+import csv
+import io
+import json
+import secrets
+from datetime import datetime
+
+from money import format_paise, to_paise
+
+# Documents the admin panel sends and accepts. Money columns are rupees ("12.50") in the
+# files, like everywhere an admin reads or types amounts, and paise once parsed.
+FORMATS = ("csv", "jsonl")
+COLUMNS = {
+    "users": ("user_id", "balance", "joined_at"),
+    "codes": ("code", "value", "uses", "max_uses", "expires_at"),
+    "withdrawals": ("id", "user_id", "amount", "upi", "timestamp"),
+}
+MONEY_COLUMNS = ("balance", "value", "amount")
+MAX_IMPORT_BYTES = 20 * 1024 * 1024  # Largest file a bot may download through getFile
+MAX_GENERATED_CODES = 100_000
+CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # No 0/O or 1/I to misread
+
+
+class BulkError(ValueError):
+    """A row of an uploaded file that can't be imported; nothing from the file is applied."""
+
+    def __init__(self, line, message):
+        super().__init__(f"Line {line}: {message}")
+        self.line = line
+
+
+# --- CODE GENERATION ---
+def generate_codes(count, length=10, prefix=""):
+    """Returns `count` distinct random codes, e.g. "PROMO-7KQ2M9XH4C" with prefix "PROMO-"."""
+    codes = set()
+    while len(codes) < count:
+        # 32 letters, so each random byte maps onto one without bias
+        codes.add(prefix + "".join(CODE_ALPHABET[byte & 31] for byte in secrets.token_bytes(length)))
+    return sorted(codes)
+
+
+# --- EXPORT ---
+def _row_writer(section, fmt, text):
+    """Returns write(row) for rows of `section` in `fmt`, writing into the text stream `text`."""
+    def as_text(row):
+        return {key: format_paise(value) if key in MONEY_COLUMNS and value is not None else value
+                for key, value in row.items()}
+
+    if fmt == "jsonl":
+        return lambda row: text.write(json.dumps(as_text(row), ensure_ascii=False) + "\n")
+    writer = csv.DictWriter(text, COLUMNS[section], extrasaction="ignore")
+    writer.writeheader()
+    return lambda row: writer.writerow(as_text(row))
+
+async def export(repo, section, fmt, out, page_size=1000):
+    """Writes every row of `section` to the binary file `out`. Returns the number of rows.
+
+    Reads a page at a time and lets other handlers run in between, so a large export
+    never holds the event loop or more than one page in memory.
+    """
+    text = io.TextIOWrapper(out, encoding="utf-8", newline="", write_through=True)
+    write = _row_writer(section, fmt, text)
+    rows = 0
+    for page in repo.export_pages(section, page_size):
+        for row in page:
+            write(row)
+        rows += len(page)
+        await asyncio.sleep(0)
+    text.detach()  # Leaves `out` open for the caller
+    return rows
+
+def dump(section, rows, fmt="csv"):
+    """Rows already in memory, such as freshly generated codes, as the bytes of a document."""
+    text = io.StringIO(newline="")
+    write = _row_writer(section, fmt, text)
+    for row in rows:
+        write(row)
+    return text.getvalue().encode("utf-8")
+
+
+# --- IMPORT ---
+def read_rows(data, filename):
+    """Parses an uploaded CSV (with a header row) or JSONL file into (line, dict) pairs."""
+    text = bytes(data).decode("utf-8-sig")
+    if filename.lower().endswith((".jsonl", ".json", ".ndjson")):
+        rows = []
+        for line, raw in enumerate(text.splitlines(), 1):
+            if not raw.strip():
+                continue
+            try:
+                row = json.loads(raw)
+            except ValueError:
+                raise BulkError(line, "not valid JSON") from None
+            if not isinstance(row, dict):
+                raise BulkError(line, "expected a JSON object")
+            rows.append((line, row))
+        return rows
+    reader = csv.DictReader(io.StringIO(text, newline=""))
+    return [(reader.line_num, row) for row in reader if any(value for value in row.values() if value)]
+
+def _field(line, row, name, parse, required=True):
+    value = row.get(name)
+    if value is None or str(value).strip() == "":
+        if required:
+            raise BulkError(line, f"missing {name}")
+        return None
+    try:
+        return parse(str(value).strip())
+    except ValueError:
+        raise BulkError(line, f"invalid {name} {value!r}") from None
+
+def _positive_int(text):
+    number = int(text)
+    if number <= 0:
+        raise ValueError(text)
+    return number
+
+def _timestamp(text):
+    return datetime.fromisoformat(text).isoformat()
+
+def parse_codes(rows):
+    """(code, value, max_uses, expires_at) tuples from "code", "value" and optional limit/expiry columns."""
+    codes = []
+    for line, row in rows:
+        value = _field(line, row, "value", to_paise)
+        if value <= 0:
+            raise BulkError(line, "value must be positive")
+        codes.append((_field(line, row, "code", str), value,
+                      _field(line, row, "max_uses", _positive_int, required=False),
+                      _field(line, row, "expires_at", _timestamp, required=False)))
+    return codes
+
+def parse_users(rows):
+    """(user_id, balance, joined_at) tuples; balance and joined_at are optional."""
+    users = []
+    for line, row in rows:
+        balance = _field(line, row, "balance", to_paise, required=False) or 0
+        if balance < 0:
+            raise BulkError(line, "balance can't be negative")
+        users.append((str(_field(line, row, "user_id", int)), balance,
+                      _field(line, row, "joined_at", _timestamp, required=False)))
+    return users
+
+def parse_withdrawal_ids(rows):
+    """The "id" column of a payout file, such as a settled copy of the withdrawals export."""
+    return [_field(line, row, "id", str) for line, row in rows]
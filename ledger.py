@@ -0,0 +1,209 @@
+# ledger.py
+
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+
+# --- ERRORS ---
+class LedgerError(Exception):
+    """Base class for balance operations that were refused."""
+
+class InvalidCode(LedgerError):
+    pass
+
+class AlreadyRedeemed(LedgerError):
+    pass
+
+class CodeExpired(LedgerError):
+    pass
+
+class CodeExhausted(LedgerError):
+    pass
+
+class InsufficientFunds(LedgerError):
+    def __init__(self, balance):
+        super().__init__(f"Insufficient balance: {balance}")
+        self.balance = balance
+
+class WithdrawalNotFound(LedgerError):
+    pass
+
+class NotWithdrawalOwner(LedgerError):
+    pass
+
+
+class Ledger:
+    """Every balance mutation goes through here.
+
+    Each user maps onto one of `shards` asyncio locks, so two updates for the same user never
+    interleave their check and their write, while different users proceed in parallel. The
+    check and the write also share one repository transaction, so the storage backend never
+    sees a half-applied change. Durability is awaited after the lock is released.
+
+    When several workers share the storage, the repository's `lock()` extends the per-user
+    lock across processes, and capped codes are locked too so two workers can't both take
+    a code's last use. Shared storage is a network round trip away, so there the reads and
+    writes under the locks run in a worker thread instead of on the event loop.
+
+    Amounts are integer paise. Every change is logged by the repository as an immutable
+    transaction; `reconcile` checks the stored balances against that log and `report`
+    aggregates it.
+    """
+
+    def __init__(self, repo, shards=256):
+        self.repo = repo
+        self._locks = [asyncio.Lock() for _ in range(shards)]
+
+    def lock_for(self, user_id):
+        return self._locks[hash(str(user_id)) % len(self._locks)]
+
+    @asynccontextmanager
+    async def _locked(self, user_id):
+        async with self.lock_for(user_id), self.repo.lock(f"user:{user_id}"):
+            yield
+
+    @asynccontextmanager
+    async def _code_lock(self, code):
+        if not self.repo.shared:
+            yield
+            return
+        code_info = await asyncio.to_thread(self.repo.get_code, code)
+        if code_info is None or code_info["max_uses"] is None:
+            yield
+            return
+        async with self.repo.lock(f"code:{code}"):
+            yield
+
+    async def _run(self, body):
+        """Calls `body` inside one repository transaction, in a worker thread for shared storage."""
+        def transaction():
+            with self.repo.transaction():
+                return body()
+
+        if self.repo.shared:
+            return await asyncio.to_thread(transaction)
+        return transaction()
+
+    async def redeem(self, user_id, code):
+        """Credits a code's value once per user. Returns (amount, new_balance)."""
+        def apply():
+            code_info = self.repo.get_code(code)
+            if code_info is None:
+                raise InvalidCode(code)
+            if self.repo.has_redeemed(code, user_id):
+                raise AlreadyRedeemed(code)
+            if code_info["expires_at"] and datetime.fromisoformat(code_info["expires_at"]) <= datetime.now():
+                raise CodeExpired(code)
+            if code_info["remaining"] == 0:
+                raise CodeExhausted(code)
+            amount = code_info["value"]
+            new_balance = self.repo.adjust_balance(user_id, amount, "redeem", code)
+            self.repo.record_redemption(code, user_id)
+            return amount, new_balance
+
+        async with self._locked(user_id), self._code_lock(code):
+            amount, new_balance = await self._run(apply)
+        await self.repo.commit(urgent=True)
+        return amount, new_balance
+
+    async def withdraw(self, user_id, amount, upi):
+        """Debits `amount` paise into a new pending withdrawal. Returns (request, new_balance)."""
+        user_id_str = str(user_id)
+
+        def apply():
+            self.repo.ensure_user(user_id_str)
+            balance = self.repo.get_user(user_id_str)["balance"]
+            if amount <= 0 or amount > balance:
+                raise InsufficientFunds(balance)
+            request = {
+                "id": str(uuid.uuid4()),
+                "user_id": user_id_str,
+                "amount": amount,
+                "upi": upi,
+                "timestamp": datetime.now().isoformat()
+            }
+            new_balance = self.repo.adjust_balance(user_id_str, -amount, "withdraw", request["id"])
+            self.repo.create_withdrawal(request)
+            return request, new_balance
+
+        async with self._locked(user_id_str):
+            request, new_balance = await self._run(apply)
+        await self.repo.commit(urgent=True)
+        return request, new_balance
+
+    async def cancel_withdrawal(self, user_id, withdrawal_id):
+        """Refunds a pending withdrawal owned by the user. Returns the cancelled request."""
+        user_id_str = str(user_id)
+
+        def apply():
+            request = self.repo.get_withdrawal(withdrawal_id)
+            if request is None:
+                raise WithdrawalNotFound(withdrawal_id)
+            if request["user_id"] != user_id_str:
+                raise NotWithdrawalOwner(withdrawal_id)
+            if self.repo.delete_withdrawal(withdrawal_id) is None:  # Settled by another worker meanwhile
+                raise WithdrawalNotFound(withdrawal_id)
+            self.repo.adjust_balance(user_id_str, request["amount"], "refund", withdrawal_id)
+            return request
+
+        async with self._locked(user_id_str):
+            request = await self._run(apply)
+        await self.repo.commit(urgent=True)
+        return request
+
+    # --- Bulk ---
+    async def import_users(self, users):
+        """Creates (user_id, balance, joined_at) users in one transaction. Returns the ids created.
+
+        Users who already exist are skipped, so no balance that a handler may be holding a
+        lock on is touched, and re-importing the same file changes nothing.
+        """
+        created = await self._run(lambda: self.repo.add_users(users))
+        await self.repo.commit(urgent=True)
+        return created
+
+    async def settle(self, withdrawal_ids):
+        """Marks a payout file's withdrawals as paid in one transaction. Returns (settled, missing).
+
+        A request the user cancels meanwhile is refunded or settled, never both: each backend
+        removes the pending request atomically, and only whoever removed it acts on it.
+        """
+        result = await self._run(lambda: self.repo.settle_withdrawals(withdrawal_ids))
+        await self.repo.commit(urgent=True)
+        return result
+
+    # --- Audit ---
+    async def reconcile(self, fix=False, page_size=500):
+        """Checks every stored balance against the transaction log.
+
+        Streams through the users a page at a time and lets handlers run between pages.
+        With `fix`, each mismatched balance is rebuilt from the log under the user's lock,
+        which logs a "reconcile" entry. Returns {"users", "mismatches", "fixed"}, where
+        mismatches are (user_id, stored, logged) tuples.
+        """
+        checked, mismatches = 0, []
+        pages = self.repo.reconcile_pages(page_size)
+        while True:
+            if self.repo.shared:
+                page = await asyncio.to_thread(next, pages, None)
+            else:
+                page = next(pages, None)
+                await asyncio.sleep(0)
+            if page is None:
+                break
+            checked += page[0]
+            mismatches.extend(page[1])
+        fixed = 0
+        if fix and mismatches:
+            for user_id, _, _ in mismatches:
+                async with self._locked(user_id):
+                    await self._run(lambda: self.repo.rebuild_balance(user_id))
+                fixed += 1
+            await self.repo.commit(urgent=True)
+        return {"users": checked, "mismatches": mismatches, "fixed": fixed}
+
+    async def report(self, days=7):
+        """Aggregates the transaction log in a worker thread (see storage.ledger_summary)."""
+        return await asyncio.to_thread(self.repo.ledger_summary, days)
@@ -1,37 +1,92 @@
 # main.py
 
+import html
 import logging
-import json
 import os
-import uuid
+import tempfile
+import time
 from functools import wraps
 from datetime import datetime
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     CallbackQueryHandler,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes,
 )
 from telegram.constants import ParseMode
+from telegram.request import HTTPXRequest
+
+from persistence import PersistenceService
+from broadcast import Broadcaster
+import bulk
+from bulk import BulkError
+from render_cache import RenderCache
+from throttle import Throttle, update_action
+import metrics
+from metrics import InstrumentedRequest, SamplingProfiler, instrument_handlers, observe_flush, start_metrics_server
+from outbound import PRIORITY_NAMES, OutboundScheduler
+from money import format_paise, to_paise
+from pagination import USER_ORDERS, WITHDRAWAL_ORDERS, decode_page_request, encode_cursor
+from storage import HistoryStore, JsonRepository, SQLiteRepository, TransactionLog, json_journal
+from ledger import (
+    Ledger, InvalidCode, AlreadyRedeemed, CodeExpired, CodeExhausted, InsufficientFunds,
+    WithdrawalNotFound, NotWithdrawalOwner,
+)
 
 # --- CONFIGURATION ---
 BOT_TOKEN = os.getenv("BOT_TOKEN", "7731491024:AAGbDm-TIJ0C_S9CwOV0lrcMQ08Qb1eHW8Y")  # Recommended to use environment variables
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")  # e.g. a local fake Bot API for testing
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # "polling" or "webhook"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public base URL, e.g. https://bot.example.com; unset = don't register
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Checked against X-Telegram-Bot-Api-Secret-Token; generated if unset
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))  # Seconds to finish queued updates on SIGTERM
+WEBHOOK_REUSE_PORT = os.getenv("WEBHOOK_REUSE_PORT") == "1"  # Lets several workers on one host share the port
 ADMIN_IDS = [5924971946]  # <-- IMPORTANT: Replace with your Telegram User ID
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # "json", "sqlite" or "redis" (shared by several workers)
 DATA_FILE = "data.json"
+HISTORY_FILE = "history.db"  # Redeemed codes and paid-out withdrawals of the JSON backend, read on demand
+LEDGER_FILE = "ledger.db"  # Append-only transaction log of the JSON backend (SQLite and Redis keep their own)
+SQLITE_FILE = os.getenv("SQLITE_FILE", "data.db")  # Migrate with: python storage.py data.json data.db
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")  # "memory://" = in-process fakeredis; migrate with shared_state.py
+BROADCAST_FILE = "broadcast.json"  # Checkpoint of the running broadcast, for resuming after a restart
 CURRENCY_SYMBOL = "₹"
 ITEMS_PER_PAGE = 5  # For pagination
+JOURNAL_COMPACT_EVERY = 5000  # Mutations between snapshot compactions
+SNAPSHOT_BACKUPS = 3  # Earlier snapshots kept to fall back on if data.json is damaged
+PERSIST_FLUSH_INTERVAL = 0.5  # Max seconds a journaled mutation waits before hitting disk
+PERSIST_FLUSH_EVERY = 500  # Buffered mutations that trigger an early flush
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))  # Updates processed in parallel (1 = sequential)
+BOT_API_CONNECTIONS = int(os.getenv("BOT_API_CONNECTIONS", "64"))  # Pooled connections; further calls queue by priority
+BOT_API_MAX_RETRY_AFTER = 30.0  # Longest flood wait (seconds) sat out and retried; longer ones fail the call
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # Use 0.0.0.0 to scrape from outside a container
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))  # Prometheus /metrics endpoint; 0 disables it
+THROTTLE_RULES = {  # Action: (tokens per second, burst). Admins are never throttled
+    "callback": (1.0, 5),  # Each button has its own bucket at this rate unless listed below
+    "callback:user_wallet": (0.2, 3),
+    "callback:user_earn": (0.2, 3),
+    "message": (0.5, 5),
+    "command": (0.2, 3),
+    "redeem": (1 / 60, 5),  # Wrong codes; while it's empty, further codes are refused
+}
+THROTTLE_MAX_BUCKETS = 100_000  # Per worker; idle buckets are evicted first
 
 # --- CONVERSATION STATES ---
 # Using constants for states makes the code more readable
 REDEEM_CODE_STATE, WITHDRAW_AMOUNT_STATE, WITHDRAW_UPI_STATE, ADMIN_ADD_CODE_VALUE, \
 ADMIN_ADD_CODE_TEXT, ADMIN_ADD_LINK_URL, ADMIN_ADD_LINK_TITLE, ADMIN_EDIT_BALANCE_ID, \
 ADMIN_EDIT_BALANCE_AMOUNT, ADMIN_REMOVE_USER_ID, ADMIN_SEND_MESSAGE_CONFIRM, \
-ADMIN_SET_SUPPORT_INFO, ADMIN_SET_HOW_TO, ADMIN_ADD_ADMIN_ID, ADMIN_REMOVE_ADMIN_ID = range(16)
+ADMIN_SET_SUPPORT_INFO, ADMIN_SET_HOW_TO, ADMIN_ADD_ADMIN_ID, ADMIN_REMOVE_ADMIN_ID, \
+ADMIN_BULK_GENERATE, ADMIN_BULK_IMPORT = range(17)
 
 # --- LOGGING SETUP ---
 logging.basicConfig(
@@ -41,32 +96,48 @@ logger = logging.getLogger(__name__)
 
 
 # --- DATA HANDLING ---
-def load_data():
-    """Loads data from JSON file. Returns a default structure if file doesn't exist."""
-    try:
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        # Default structure
-        return {
-            "users": {},
-            "codes": {},
-            "links": [],
-            "config": {
-                "support_info": "No support info set.",
-                "how_to_video": "No how-to video set.",
-                "admins": ADMIN_IDS, # Initialize with hardcoded admin
-            },
-            "pending_withdrawals": {},
-        }
-
-def save_data(data):
-    """Saves data to JSON file."""
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+def default_data():
+    """Returns the default structure for a fresh data file."""
+    return {
+        "users": {},
+        "codes": {},
+        "links": [],
+        "config": {
+            "support_info": "No support info set.",
+            "how_to_video": "No how-to video set.",
+            "admins": ADMIN_IDS, # Initialize with hardcoded admin
+        },
+        "pending_withdrawals": {},
+    }
+
+def open_repository():
+    """Opens the storage backend selected by STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteRepository(SQLITE_FILE, default_config=default_data()["config"])
+    if STORAGE_BACKEND == "redis":
+        from shared_state import RedisRepository, connect
+        return RedisRepository(connect(REDIS_URL), default_config=default_data()["config"])
+    journal = json_journal(DATA_FILE, compact_every=JOURNAL_COMPACT_EVERY, backups=SNAPSHOT_BACKUPS)
+    persistence = PersistenceService(journal, flush_interval=PERSIST_FLUSH_INTERVAL, flush_every=PERSIST_FLUSH_EVERY,
+                                     on_flush=observe_flush)
+    metrics.BUFFERED_RECORDS.callback = journal.buffered
+    return JsonRepository(journal, persistence, default_data, history=HistoryStore(HISTORY_FILE),
+                          transactions=TransactionLog.open(LEDGER_FILE))
+
+def save_data(urgent=False):
+    """Returns a future resolved once all changes so far are durable."""
+    return repo.commit(urgent=urgent)
 
 # Load data at startup
-bot_data = load_data()
+repo = open_repository()
+ledger = Ledger(repo)
+broadcaster = Broadcaster(repo, BROADCAST_FILE)
+render_cache = RenderCache()
+throttle = Throttle(THROTTLE_RULES, max_buckets=THROTTLE_MAX_BUCKETS)
+metrics.THROTTLE_BUCKETS.callback = throttle.__len__
+repo.add_listener(render_cache.invalidate)  # Drop cached screens when links or config change
+profiler = SamplingProfiler()
+metrics_runner = None
 
 
 # --- DECORATORS (for security) ---
@@ -75,8 +146,9 @@ def admin_only(func):
     @wraps(func)
     async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         user_id = update.effective_user.id
-        if user_id not in bot_data["config"]["admins"]:
-            await update.callback_query.answer("Access Denied!", show_alert=True)
+        if not is_admin(user_id):
+            if update.callback_query:
+                await update.callback_query.answer("Access Denied!", show_alert=True)
             return
         return await func(update, context, *args, **kwargs)
     return wrapped
@@ -85,15 +157,11 @@ def admin_only(func):
 # --- HELPER FUNCTIONS ---
 def get_user_data(user_id):
     """Ensures a user entry exists and returns it."""
-    user_id_str = str(user_id)
-    if user_id_str not in bot_data["users"]:
-        bot_data["users"][user_id_str] = {
-            "balance": 0.0,
-            "redeemed_codes": [],
-            "pending_withdrawals": [],
-            "withdrawal_history": [],
-        }
-    return bot_data["users"][user_id_str]
+    repo.ensure_user(user_id)
+    return repo.get_user(user_id)
+
+def is_admin(user_id):
+    return user_id in render_cache.get("admins", lambda: set(repo.get_config("admins")), depends_on=("config",))
 
 def build_menu(buttons, n_cols):
     """Builds an inline keyboard menu from a list of buttons."""
@@ -103,15 +171,130 @@ def back_button(menu_type="main"):
     """Returns a standard back button."""
     return InlineKeyboardButton("⬅️ Back", callback_data=f"back_to_{menu_type}")
 
+BACK_TO_MAIN_MARKUP = InlineKeyboardMarkup([[back_button("main")]])
+BACK_TO_ADMIN_MARKUP = InlineKeyboardMarkup([[back_button("admin")]])
+
+def pagination_keyboard(prefix, orders, order, page):
+    """Builds sort-order buttons and Prev/Next buttons that carry keyset cursors."""
+    sort_buttons = [
+        InlineKeyboardButton(f"✅ {o.label}" if o is order else o.label, callback_data=f"{prefix}|{o.code}")
+        for o in orders.values()
+    ]
+    nav_buttons = []
+    if page.has_prev:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=encode_cursor(prefix, order, True, page.first)))
+    if page.has_next:
+        nav_buttons.append(InlineKeyboardButton("Next ➡️", callback_data=encode_cursor(prefix, order, False, page.last)))
+    keyboard = [sort_buttons]
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    keyboard.append([back_button("admin")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+# --- CACHED SCREENS ---
+# Built once and shared by every request; rebuilt only after the data they show changes.
+def user_menu_markup():
+    def build():
+        keyboard = [
+            InlineKeyboardButton("💰 Wallet", callback_data="user_wallet"),
+            InlineKeyboardButton("🎯 Earn", callback_data="user_earn"),
+            InlineKeyboardButton("🔑 Redeem Code", callback_data="user_redeem"),
+            InlineKeyboardButton("💵 Withdraw", callback_data="user_withdraw"),
+            InlineKeyboardButton("❌ Cancel Withdraw", callback_data="user_cancel_withdraw_list"),
+            InlineKeyboardButton("🔍 Check Pending", callback_data="user_check_withdraw"),
+            InlineKeyboardButton("🛠️ Get Support", callback_data="user_support"),
+            InlineKeyboardButton("🎥 How to Use", callback_data="user_how_to"),
+        ]
+        return InlineKeyboardMarkup(build_menu(keyboard, n_cols=2))
+    return render_cache.get("user_menu", build)
+
+def admin_menu_screen():
+    def build():
+        text = "🛡️ <b>Admin Panel</b>\n\nWelcome, Admin! Manage the bot from here."
+        keyboard = [
+            InlineKeyboardButton("➕ Add Code", callback_data="admin_add_code"),
+            InlineKeyboardButton("📎 Add Link", callback_data="admin_add_link"),
+            InlineKeyboardButton("👁️ View Users", callback_data="admin_view_users_0"),
+            InlineKeyboardButton("🧾 View Withdrawals", callback_data="admin_view_withdrawals_0"),
+            InlineKeyboardButton("✏️ Edit Balance", callback_data="admin_edit_balance"),
+            InlineKeyboardButton("🗑️ Remove User", callback_data="admin_remove_user"),
+            InlineKeyboardButton("🗨️ Send Message", callback_data="admin_send_message"),
+            InlineKeyboardButton("☎️ Set Support Info", callback_data="admin_set_support"),
+            InlineKeyboardButton("🎬 Set How-to-Use", callback_data="admin_set_howto"),
+            InlineKeyboardButton("🛂 Add Admin", callback_data="admin_add_admin"),
+            InlineKeyboardButton("🚫 Remove Admin", callback_data="admin_remove_admin"),
+            InlineKeyboardButton("📈 Metrics", callback_data="admin_metrics"),
+            InlineKeyboardButton("📒 Ledger", callback_data="admin_ledger"),
+            InlineKeyboardButton("📦 Bulk", callback_data="admin_bulk"),
+            InlineKeyboardButton("⬅️ Back to User Menu", callback_data="back_to_main"),
+        ]
+        return text, InlineKeyboardMarkup(build_menu(keyboard, n_cols=2))
+    return render_cache.get("admin_menu", build)
+
+def earn_screen():
+    def build():
+        links = repo.get_links()
+        if not links:
+            return "🎯 <b>Earn Links</b>\n\nNo earning opportunities available right now. Please check back later!", BACK_TO_MAIN_MARKUP
+        text = "🎯 <b>Earn Links</b>\n\nClick on a link below to complete the task and earn rewards:\n"
+        keyboard = [[InlineKeyboardButton(link['title'], url=link['url'])] for link in links]
+        keyboard.append([back_button("main")])
+        return text, InlineKeyboardMarkup(keyboard)
+    return render_cache.get("earn", build, depends_on=("links",))
+
+def support_screen():
+    def build():
+        return (f"<b>🛠️ Get Support</b>\n\n"
+                f"For any help, please contact us:\n"
+                f"{repo.get_config('support_info')}")
+    return render_cache.get("support", build, depends_on=("config",))
+
+def how_to_screen():
+    def build():
+        return f"🎥 <b>How to Use</b>\n\nWatch this video guide:\n{repo.get_config('how_to_video')}"
+    return render_cache.get("how_to", build, depends_on=("config",))
+
+
+# --- THROTTLING ---
+async def throttle_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before every other handler group and drops updates over the sender's rate.
+
+    A dropped update never reaches handler logic or costs a Bot API call, except for one
+    "slow down" notice per run of rejections.
+    """
+    user = update.effective_user
+    action = update_action(update)
+    if user is None or action is None or is_admin(user.id):
+        return
+    if throttle.allow(user.id, action):
+        return
+    if throttle.first_rejection(user.id, action):
+        if update.callback_query:
+            await update.callback_query.answer("⏳ Too many requests. Please slow down.")
+        else:
+            await update.message.reply_text("⏳ Too many attempts. Please wait a minute before trying again.")
+    raise ApplicationHandlerStop
+
+
+# --- SHARED HANDLER STATE ---
+async def load_shared_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs after throttling: reads the sender's conversation states and user_data from the shared storage."""
+    await repo.prefetch(update)
+
+async def save_shared_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs after every other handler group: writes back what the handlers changed."""
+    await repo.flush()
+
 
 # --- MAIN MENU and /start COMMAND ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the /start command."""
     user = update.effective_user
     get_user_data(user.id) # Ensure user is in our database
-    save_data(bot_data) # Save in case it's a new user
+    save_data() # Persist in the background in case it's a new user
 
-    if user.id in bot_data["config"]["admins"]:
+    if is_admin(user.id):
         await show_admin_menu(update, context)
     else:
         await show_user_menu(update, context)
@@ -123,19 +306,7 @@ async def show_user_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, mes
         f"👋 Welcome, {user.first_name}!\n\n"
         "This is your Reward Bot. Use the buttons below to navigate."
     )
-    
-    keyboard = [
-        InlineKeyboardButton("💰 Wallet", callback_data="user_wallet"),
-        InlineKeyboardButton("🎯 Earn", callback_data="user_earn"),
-        InlineKeyboardButton("🔑 Redeem Code", callback_data="user_redeem"),
-        InlineKeyboardButton("💵 Withdraw", callback_data="user_withdraw"),
-        InlineKeyboardButton("❌ Cancel Withdraw", callback_data="user_cancel_withdraw_list"),
-        InlineKeyboardButton("🔍 Check Pending", callback_data="user_check_withdraw"),
-        InlineKeyboardButton("🛠️ Get Support", callback_data="user_support"),
-        InlineKeyboardButton("🎥 How to Use", callback_data="user_how_to"),
-    ]
-
-    reply_markup = InlineKeyboardMarkup(build_menu(keyboard, n_cols=2))
+    reply_markup = user_menu_markup()
     
     if update.callback_query:
         await update.callback_query.edit_message_text(text=welcome_message, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
@@ -150,13 +321,17 @@ async def wallet_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id_str = str(query.from_user.id)
     user = get_user_data(user_id_str)
+    history = repo.get_history(user_id_str)  # Only loaded from disk for this screen
+    payouts = history["withdrawal_history"]
     
     text = (
         f"<b>💰 Your Wallet</b>\n\n"
-        f"<b>Current Balance:</b> {CURRENCY_SYMBOL}{user['balance']:.2f}\n\n"
+        f"<b>Current Balance:</b> {CURRENCY_SYMBOL}{format_paise(user['balance'])}\n"
+        f"<b>Codes Redeemed:</b> {len(history['redeemed_codes'])}\n"
+        f"<b>Withdrawn:</b> {CURRENCY_SYMBOL}{format_paise(sum(p['amount'] for p in payouts))} in {len(payouts)} payouts\n\n"
         f"Manage your earnings and withdrawals here."
     )
-    reply_markup = InlineKeyboardMarkup([[back_button("main")]])
+    reply_markup = BACK_TO_MAIN_MARKUP
     await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
@@ -164,20 +339,7 @@ async def earn_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Displays earning links."""
     query = update.callback_query
     await query.answer()
-    
-    if not bot_data["links"]:
-        text = "🎯 <b>Earn Links</b>\n\nNo earning opportunities available right now. Please check back later!"
-        reply_markup = InlineKeyboardMarkup([[back_button("main")]])
-        await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-        return
-
-    text = "🎯 <b>Earn Links</b>\n\nClick on a link below to complete the task and earn rewards:\n"
-    keyboard = []
-    for link in bot_data["links"]:
-        keyboard.append([InlineKeyboardButton(link['title'], url=link['url'])])
-    keyboard.append([back_button("main")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
+    text, reply_markup = earn_screen()
     await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
@@ -186,36 +348,38 @@ async def redeem_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     text = "🔑 <b>Redeem Code</b>\n\nPlease send the redeem code now."
-    reply_markup = InlineKeyboardMarkup([[back_button("main")]])
+    reply_markup = BACK_TO_MAIN_MARKUP
     await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
     return REDEEM_CODE_STATE
 
 async def redeem_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     code_text = update.message.text.strip()
-    
-    if code_text not in bot_data["codes"]:
-        await update.message.reply_text("❌ Invalid code. Please try again or go back.", reply_markup=InlineKeyboardMarkup([[back_button("main")]]))
+    if not is_admin(user_id) and throttle.exhausted(user_id, "redeem"):
+        # Too many wrong codes: ignore further guesses until the bucket refills
+        metrics.THROTTLED.inc("redeem")
+        if throttle.first_rejection(user_id, "redeem"):
+            await update.message.reply_text("⏳ Too many attempts. Please wait a minute before trying again.")
         return REDEEM_CODE_STATE
 
-    code_info = bot_data["codes"][code_text]
-    if str(user_id) in code_info.get("used_by", []):
-        await update.message.reply_text("❌ You have already used this code.", reply_markup=InlineKeyboardMarkup([[back_button("main")]]))
+    try:
+        amount, new_balance = await ledger.redeem(user_id, code_text)
+    except InvalidCode:
+        throttle.charge(user_id, "redeem")
+        await update.message.reply_text("❌ Invalid code. Please try again or go back.", reply_markup=BACK_TO_MAIN_MARKUP)
+        return REDEEM_CODE_STATE
+    except AlreadyRedeemed:
+        await update.message.reply_text("❌ You have already used this code.", reply_markup=BACK_TO_MAIN_MARKUP)
+        return REDEEM_CODE_STATE
+    except CodeExpired:
+        await update.message.reply_text("❌ This code has expired.", reply_markup=BACK_TO_MAIN_MARKUP)
+        return REDEEM_CODE_STATE
+    except CodeExhausted:
+        await update.message.reply_text("❌ This code has reached its usage limit.", reply_markup=BACK_TO_MAIN_MARKUP)
         return REDEEM_CODE_STATE
-
-    user_data = get_user_data(user_id)
-    amount = code_info["value"]
-    user_data["balance"] += amount
-    
-    if "used_by" not in code_info:
-        code_info["used_by"] = []
-    code_info["used_by"].append(str(user_id))
-    user_data["redeemed_codes"].append(code_text)
-    
-    save_data(bot_data)
     
-    await update.message.reply_text(f"✅ Success! {CURRENCY_SYMBOL}{amount:.2f} has been added to your wallet.")
-    await show_user_menu(update, context, message_text=f"✅ Code redeemed! Your new balance is {CURRENCY_SYMBOL}{user_data['balance']:.2f}")
+    await update.message.reply_text(f"✅ Success! {CURRENCY_SYMBOL}{format_paise(amount)} has been added to your wallet.")
+    await show_user_menu(update, context, message_text=f"✅ Code redeemed! Your new balance is {CURRENCY_SYMBOL}{format_paise(new_balance)}")
     return ConversationHandler.END
 
 
@@ -228,24 +392,24 @@ async def withdraw_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("You have no balance to withdraw.", show_alert=True)
         return ConversationHandler.END
 
-    text = f"💵 <b>Withdraw Funds</b>\n\nYour balance is {CURRENCY_SYMBOL}{user_data['balance']:.2f}.\n\nPlease enter the amount you wish to withdraw."
-    reply_markup = InlineKeyboardMarkup([[back_button("main")]])
+    text = f"💵 <b>Withdraw Funds</b>\n\nYour balance is {CURRENCY_SYMBOL}{format_paise(user_data['balance'])}.\n\nPlease enter the amount you wish to withdraw."
+    reply_markup = BACK_TO_MAIN_MARKUP
     await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
     return WITHDRAW_AMOUNT_STATE
 
 async def withdraw_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        amount = float(update.message.text)
+        amount = to_paise(update.message.text)
     except ValueError:
-        await update.message.reply_text("❌ Invalid amount. Please enter a number.", reply_markup=InlineKeyboardMarkup([[back_button("main")]]))
+        await update.message.reply_text("❌ Invalid amount. Please enter a number with at most two decimals.", reply_markup=BACK_TO_MAIN_MARKUP)
         return WITHDRAW_AMOUNT_STATE
     
     user_data = get_user_data(update.effective_user.id)
     if amount <= 0:
-        await update.message.reply_text("❌ Amount must be positive.", reply_markup=InlineKeyboardMarkup([[back_button("main")]]))
+        await update.message.reply_text("❌ Amount must be positive.", reply_markup=BACK_TO_MAIN_MARKUP)
         return WITHDRAW_AMOUNT_STATE
     if amount > user_data["balance"]:
-        await update.message.reply_text(f"❌ Insufficient balance. You can withdraw up to {CURRENCY_SYMBOL}{user_data['balance']:.2f}.", reply_markup=InlineKeyboardMarkup([[back_button("main")]]))
+        await update.message.reply_text(f"❌ Insufficient balance. You can withdraw up to {CURRENCY_SYMBOL}{format_paise(user_data['balance'])}.", reply_markup=BACK_TO_MAIN_MARKUP)
         return WITHDRAW_AMOUNT_STATE
 
     context.user_data["withdraw_amount"] = amount
@@ -255,30 +419,18 @@ async def withdraw_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def withdraw_upi(update: Update, context: ContextTypes.DEFAULT_TYPE):
     upi_id = update.message.text.strip()
     amount = context.user_data["withdraw_amount"]
-    user_id_str = str(update.effective_user.id)
-    user_data = get_user_data(user_id_str)
-    
-    # Deduct from balance
-    user_data["balance"] -= amount
     
-    # Create withdrawal request
-    withdrawal_id = str(uuid.uuid4())
-    request = {
-        "id": withdrawal_id,
-        "user_id": user_id_str,
-        "amount": amount,
-        "upi": upi_id,
-        "timestamp": datetime.now().isoformat()
-    }
-
-    # Store in both central and user records
-    bot_data["pending_withdrawals"][withdrawal_id] = request
-    user_data["pending_withdrawals"].append(withdrawal_id)
-
-    save_data(bot_data)
+    # Balance is re-checked under the user's lock; it may have changed since withdraw_amount
+    try:
+        _, new_balance = await ledger.withdraw(update.effective_user.id, amount, upi_id)
+    except InsufficientFunds as e:
+        context.user_data.clear()
+        await update.message.reply_text(f"❌ Insufficient balance. You can withdraw up to {CURRENCY_SYMBOL}{format_paise(e.balance)}.")
+        await show_user_menu(update, context)
+        return ConversationHandler.END
     
-    await update.message.reply_text(f"✅ Withdrawal request for {CURRENCY_SYMBOL}{amount:.2f} to {upi_id} has been submitted. It will be processed soon.")
-    await show_user_menu(update, context, message_text=f"✅ Withdrawal requested. Your new balance is {CURRENCY_SYMBOL}{user_data['balance']:.2f}")
+    await update.message.reply_text(f"✅ Withdrawal request for {CURRENCY_SYMBOL}{format_paise(amount)} to {upi_id} has been submitted. It will be processed soon.")
+    await show_user_menu(update, context, message_text=f"✅ Withdrawal requested. Your new balance is {CURRENCY_SYMBOL}{format_paise(new_balance)}")
     
     context.user_data.clear()
     return ConversationHandler.END
@@ -289,14 +441,12 @@ async def list_pending_withdrawals(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     await query.answer()
     user_id_str = str(query.from_user.id)
-    user_data = get_user_data(user_id_str)
+    pending = repo.get_user_withdrawals(user_id_str)
     
-    pending_ids = user_data.get("pending_withdrawals", [])
-    
-    if not pending_ids:
+    if not pending:
         title = "❌ Cancel Withdrawal" if for_cancellation else "🔍 Pending Withdrawals"
         text = f"<b>{title}</b>\n\nYou have no pending withdrawal requests."
-        reply_markup = InlineKeyboardMarkup([[back_button("main")]])
+        reply_markup = BACK_TO_MAIN_MARKUP
         await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         return
         
@@ -304,57 +454,51 @@ async def list_pending_withdrawals(update: Update, context: ContextTypes.DEFAULT
     text = f"<b>{title}</b>\n\nHere are your current requests:\n"
     
     keyboard = []
-    for w_id in pending_ids:
-        # Check if the withdrawal still exists centrally
-        if w_id in bot_data["pending_withdrawals"]:
-            w_details = bot_data["pending_withdrawals"][w_id]
-            button_text = f"{CURRENCY_SYMBOL}{w_details['amount']:.2f} to {w_details['upi']}"
-            if for_cancellation:
-                keyboard.append([InlineKeyboardButton(button_text, callback_data=f"user_cancel_withdraw_confirm_{w_id}")])
-            else:
-                 # In check mode, buttons aren't needed, but you could add details
-                 text += f"\n- <b>ID:</b> ...{w_id[-6:]}\n  <b>Amount:</b> {CURRENCY_SYMBOL}{w_details['amount']:.2f}\n  <b>UPI:</b> {w_details['upi']}\n"
+    for w_details in pending:
+        w_id = w_details["id"]
+        button_text = f"{CURRENCY_SYMBOL}{format_paise(w_details['amount'])} to {w_details['upi']}"
+        if for_cancellation:
+            keyboard.append([InlineKeyboardButton(button_text, callback_data=f"user_cancel_withdraw_confirm_{w_id}")])
+        else:
+             # In check mode, buttons aren't needed, but you could add details
+             text += f"\n- <b>ID:</b> ...{w_id[-6:]}\n  <b>Amount:</b> {CURRENCY_SYMBOL}{format_paise(w_details['amount'])}\n  <b>UPI:</b> {html.escape(w_details['upi'])}\n"
+    
+    if not for_cancellation:
+        recent = repo.get_history(user_id_str)["withdrawal_history"][-3:]
+        if recent:
+            text += "\n<b>Recent Payouts:</b>\n"
+            text += "".join(f"- {CURRENCY_SYMBOL}{format_paise(p['amount'])} to {html.escape(p['upi'])}\n" for p in reversed(recent))
     
     if for_cancellation:
         keyboard.append([back_button("main")])
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
     else: # Just checking
-        reply_markup = InlineKeyboardMarkup([[back_button("main")]])
+        reply_markup = BACK_TO_MAIN_MARKUP
         await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
+async def list_cancellable_withdrawals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await list_pending_withdrawals(update, context, for_cancellation=True)
+
 async def cancel_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Refunds the amount and removes the withdrawal request."""
     query = update.callback_query
     await query.answer()
-    user_id_str = str(query.from_user.id)
     w_id = query.data.split("_")[-1]
 
-    if w_id not in bot_data["pending_withdrawals"]:
+    try:
+        # The ledger also checks that the user owns this withdrawal
+        withdrawal_data = await ledger.cancel_withdrawal(query.from_user.id, w_id)
+    except WithdrawalNotFound:
         await query.answer("This withdrawal request is already processed or invalid.", show_alert=True)
         return
-
-    withdrawal_data = bot_data["pending_withdrawals"][w_id]
-    
-    # Security check: ensure the user owns this withdrawal
-    if withdrawal_data["user_id"] != user_id_str:
+    except NotWithdrawalOwner:
         await query.answer("Error: Mismatch.", show_alert=True)
         return
-
-    user_data = get_user_data(user_id_str)
-
-    # Refund balance
-    user_data["balance"] += withdrawal_data["amount"]
-
-    # Remove from lists
-    user_data["pending_withdrawals"].remove(w_id)
-    del bot_data["pending_withdrawals"][w_id]
-
-    save_data(bot_data)
     
     await query.edit_message_text(
-        f"✅ Withdrawal of {CURRENCY_SYMBOL}{withdrawal_data['amount']:.2f} has been cancelled and refunded to your wallet.",
-        reply_markup=InlineKeyboardMarkup([[back_button("main")]]),
+        f"✅ Withdrawal of {CURRENCY_SYMBOL}{format_paise(withdrawal_data['amount'])} has been cancelled and refunded to your wallet.",
+        reply_markup=BACK_TO_MAIN_MARKUP,
         parse_mode=ParseMode.HTML
     )
 
@@ -363,17 +507,15 @@ async def cancel_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def support_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    text = (f"<b>🛠️ Get Support</b>\n\n"
-            f"For any help, please contact us:\n"
-            f"{bot_data['config']['support_info']}")
-    reply_markup = InlineKeyboardMarkup([[back_button("main")]])
+    text = support_screen()
+    reply_markup = BACK_TO_MAIN_MARKUP
     await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 async def how_to_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    text = f"🎥 <b>How to Use</b>\n\nWatch this video guide:\n{bot_data['config']['how_to_video']}"
-    reply_markup = InlineKeyboardMarkup([[back_button("main")]])
+    text = how_to_screen()
+    reply_markup = BACK_TO_MAIN_MARKUP
     await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
@@ -383,22 +525,7 @@ async def how_to_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Displays the main admin menu."""
-    text = "🛡️ <b>Admin Panel</b>\n\nWelcome, Admin! Manage the bot from here."
-    keyboard = [
-        InlineKeyboardButton("➕ Add Code", callback_data="admin_add_code"),
-        InlineKeyboardButton("📎 Add Link", callback_data="admin_add_link"),
-        InlineKeyboardButton("👁️ View Users", callback_data="admin_view_users_0"),
-        InlineKeyboardButton("🧾 View Withdrawals", callback_data="admin_view_withdrawals_0"),
-        InlineKeyboardButton("✏️ Edit Balance", callback_data="admin_edit_balance"),
-        InlineKeyboardButton("🗑️ Remove User", callback_data="admin_remove_user"),
-        InlineKeyboardButton("🗨️ Send Message", callback_data="admin_send_message"),
-        InlineKeyboardButton("☎️ Set Support Info", callback_data="admin_set_support"),
-        InlineKeyboardButton("🎬 Set How-to-Use", callback_data="admin_set_howto"),
-        InlineKeyboardButton("🛂 Add Admin", callback_data="admin_add_admin"),
-        InlineKeyboardButton("🚫 Remove Admin", callback_data="admin_remove_admin"),
-        InlineKeyboardButton("⬅️ Back to User Menu", callback_data="back_to_main"),
-    ]
-    reply_markup = InlineKeyboardMarkup(build_menu(keyboard, n_cols=2))
+    text, reply_markup = admin_menu_screen()
     
     # Message could come from /start (no query) or a button press (query)
     if update.callback_query:
@@ -411,34 +538,40 @@ async def admin_add_code_start(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     text = "🔢 Please enter the new redeem code text (e.g., WELCOME50)."
-    await query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup([[back_button("admin")]]))
+    await query.edit_message_text(text=text, reply_markup=BACK_TO_ADMIN_MARKUP)
     return ADMIN_ADD_CODE_TEXT
 
 @admin_only
 async def admin_add_code_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     code_text = update.message.text.strip()
-    if code_text in bot_data["codes"]:
-        await update.message.reply_text("This code already exists. Please choose a different one.", reply_markup=InlineKeyboardMarkup([[back_button("admin")]]))
+    if repo.get_code(code_text) is not None:
+        await update.message.reply_text("This code already exists. Please choose a different one.", reply_markup=BACK_TO_ADMIN_MARKUP)
         return ADMIN_ADD_CODE_TEXT
         
     context.user_data["new_code_text"] = code_text
-    await update.message.reply_text(f"✅ Code text set to `{code_text}`.\n\nNow, please enter the value of this code in {CURRENCY_SYMBOL}.", parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text(
+        f"✅ Code text set to <code>{code_text}</code>.\n\nNow, please enter the value of this code in {CURRENCY_SYMBOL}.\n"
+        "Optionally add a usage limit and an expiry date, e.g. <code>50 100 2025-12-31</code>.",
+        parse_mode=ParseMode.HTML)
     return ADMIN_ADD_CODE_VALUE
 
 @admin_only
 async def admin_add_code_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parts = update.message.text.split()
     try:
-        value = float(update.message.text)
-    except ValueError:
-        await update.message.reply_text("Invalid value. Please enter a number.", reply_markup=InlineKeyboardMarkup([[back_button("admin")]]))
+        value = to_paise(parts[0])
+        max_uses = int(parts[1]) if len(parts) > 1 else None
+        expires_at = datetime.fromisoformat(parts[2]).isoformat() if len(parts) > 2 else None
+    except (ValueError, IndexError):
+        await update.message.reply_text("Invalid value. Please enter a number, optionally followed by a usage limit and an expiry date (YYYY-MM-DD).", reply_markup=BACK_TO_ADMIN_MARKUP)
         return ADMIN_ADD_CODE_VALUE
 
     code_text = context.user_data["new_code_text"]
-    bot_data["codes"][code_text] = {"value": value, "used_by": []}
-    save_data(bot_data)
+    repo.add_code(code_text, value, max_uses=max_uses, expires_at=expires_at)
+    save_data()
     
     context.user_data.clear()
-    await update.message.reply_text(f"✅ Success! Code `{code_text}` with value {CURRENCY_SYMBOL}{value:.2f} has been created.", parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text(f"✅ Success! Code <code>{code_text}</code> with value {CURRENCY_SYMBOL}{format_paise(value)} has been created.", parse_mode=ParseMode.HTML)
     await show_admin_menu(update, context)
     return ConversationHandler.END
     
@@ -446,19 +579,532 @@ async def admin_add_code_value(update: Update, context: ContextTypes.DEFAULT_TYP
 async def admin_view_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    page = int(query.data.split("_")[-1])
+    order, backwards, cursor = decode_page_request(query.data, USER_ORDERS, "b")
+    page = repo.page_users(order, cursor, backwards, limit=ITEMS_PER_PAGE)
     
-    user_ids = list(bot_data["users"].keys())
-    
-    if not user_ids:
+    if not page.items and cursor is None:
         text = "No users found."
-        reply_markup = InlineKeyboardMarkup([[back_button("admin")]])
+        reply_markup = BACK_TO_ADMIN_MARKUP
         await query.edit_message_text(text=text, reply_markup=reply_markup)
         return
 
-    start_index = page * ITEMS_PER_PAGE
-    end_index = start_index + ITEMS_PER_PAGE
-    paginated_users = user_ids[start_index:end_index]
+    text = f"👁️ <b>Users List</b> (by {order.label}):\n\n"
+    for user_data in page.items:
+        text += f"<b>ID:</b> <code>{user_data['user_id']}</code> | <b>Balance:</b> {CURRENCY_SYMBOL}{format_paise(user_data['balance'])}\n"
+
+    reply_markup = pagination_keyboard("avu", USER_ORDERS, order, page)
+    await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+
+@admin_only
+async def admin_view_withdrawals(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    order, backwards, cursor = decode_page_request(query.data, WITHDRAWAL_ORDERS, "t")
+    page = repo.page_withdrawals(order, cursor, backwards, limit=ITEMS_PER_PAGE)
     
-    text = "👁️ <b>Users List</b> (Page {}):\n\n".format(page + 1)
-    for use
\ No newline at end of file
+    if not page.items and cursor is None:
+        text = "No pending withdrawals."
+        reply_markup = BACK_TO_ADMIN_MARKUP
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+        return
+
+    text = f"🧾 <b>Pending Withdrawals</b> (by {order.label}):\n"
+    for w_details in page.items:
+        text += (f"\n<b>User:</b> <code>{w_details['user_id']}</code> | <b>Amount:</b> {CURRENCY_SYMBOL}{format_paise(w_details['amount'])}\n"
+                 f"<b>UPI:</b> {html.escape(w_details['upi'])} | <b>At:</b> {w_details['timestamp'][:16]}\n")
+
+    reply_markup = pagination_keyboard("avw", WITHDRAWAL_ORDERS, order, page)
+    await query.edit_message_text(text=text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+
+
+# --- BROADCAST ---
+@admin_only
+async def admin_send_message_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if broadcaster.is_running():
+        await query.answer("A broadcast is already running.", show_alert=True)
+        return ConversationHandler.END
+    await query.answer()
+    text = "🗨️ Please send the message you want to broadcast to all users."
+    await query.edit_message_text(text=text, reply_markup=BACK_TO_ADMIN_MARKUP)
+    return ADMIN_SEND_MESSAGE_CONFIRM
+
+@admin_only
+async def admin_send_message_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["broadcast_text"] = update.message.text_html
+    keyboard = [
+        [InlineKeyboardButton("✅ Send to All", callback_data="admin_broadcast_confirm")],
+        [back_button("admin")],
+    ]
+    await update.message.reply_text(
+        f"<b>Preview</b> (will be sent to {repo.count_users()} users):\n\n{update.message.text_html}",
+        reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
+    return ADMIN_SEND_MESSAGE_CONFIRM
+
+@admin_only
+async def admin_send_message_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    text = context.user_data.pop("broadcast_text", None)
+    if text is None or not broadcaster.start(context.bot, text, query.message.chat_id, query.message.message_id):
+        await query.answer("A broadcast is already running.", show_alert=True)
+        return ConversationHandler.END
+    await query.answer()
+    await query.edit_message_text("📣 Broadcast started. Progress will appear here.")
+    return ConversationHandler.END
+
+@admin_only
+async def admin_broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.answer("Stopping broadcast…")
+    broadcaster.cancel()
+
+
+# --- METRICS ---
+def _bound(seconds):
+    if seconds is None:
+        return "-"
+    if seconds == float("inf"):
+        return f">{metrics.LATENCY_BUCKETS[-1]:g}s"
+    return f"≤{seconds * 1000:g}ms"
+
+def metrics_text(application):
+    """A short summary of the /metrics series for the admin panel."""
+    errors = {}
+    for (handler, _), count in metrics.HANDLER_ERRORS.items():
+        errors[handler] = errors.get(handler, 0) + count
+    handlers = sorted(metrics.HANDLER_SECONDS.label_values(), key=lambda v: -metrics.HANDLER_SECONDS.count(*v))
+    text = "📈 <b>Metrics</b>\n\n<b>Handlers</b> (calls, p50, p99, errors):\n"
+    for (name,) in handlers[:10]:
+        h = metrics.HANDLER_SECONDS
+        text += (f"<code>{name}</code>: {h.count(name)}, {_bound(h.quantile(0.5, name))}, "
+                 f"{_bound(h.quantile(0.99, name))}, {int(errors.get(name, 0))}\n")
+    text += "\n<b>Bot API</b> (calls, p50, p99):\n"
+    for (method,) in sorted(metrics.API_SECONDS.label_values()):
+        a = metrics.API_SECONDS
+        text += f"<code>{method}</code>: {a.count(method)}, {_bound(a.quantile(0.5, method))}, {_bound(a.quantile(0.99, method))}\n"
+    text += (f"\n<b>Persistence:</b> {metrics.FLUSH_SECONDS.count()} flushes, p99 {_bound(metrics.FLUSH_SECONDS.quantile(0.99))}, "
+             f"{metrics.FLUSH_BYTES.value() / 1024:.0f} KiB written\n"
+             f"<b>Throttled:</b> {throttled_text()}\n"
+             f"<b>Outbound:</b> {outbound_text(application.bot.request)}\n"
+             f"<b>Update queue:</b> {application.update_queue.qsize()} | "
+             f"<b>In flight:</b> {int(metrics.HANDLERS_IN_FLIGHT.value())}\n"
+             f"<b>Profiler:</b> {'running' if profiler.is_running() else 'off'}")
+    return text
+
+def throttled_text():
+    by_action = sorted(metrics.THROTTLED.items(), key=lambda item: -item[1])
+    top = ", ".join(f"<code>{action}</code> {int(count)}" for (action,), count in by_action[:3])
+    return (f"{int(sum(count for _, count in by_action))} updates{f' ({top})' if top else ''}, "
+            f"{len(throttle)} buckets")
+
+def outbound_text(scheduler):
+    stats = scheduler.stats()
+    waits = " | ".join(f"{name} p99 {_bound(metrics.OUTBOUND_WAIT.quantile(0.99, name))}"
+                       for name in PRIORITY_NAMES if metrics.OUTBOUND_WAIT.count(name))
+    calls = sum(metrics.API_SECONDS.count(*values) for values in metrics.API_SECONDS.label_values())
+    text = (f"{stats['in_flight']}/{scheduler.slots} busy, {stats['queued']} queued, "
+            f"{stats['flood_waits']} flood waits ({stats['flood_waits'] / max(calls, 1):.2%} of calls), "
+            f"{stats['edits_skipped']} edits skipped")
+    if stats["paused_for"]:
+        text += f", paused {stats['paused_for']:.0f}s"
+    if stats["paused_chats"]:
+        text += f", {stats['paused_chats']} chats paused"
+    return text + (f"\n<b>Queue wait:</b> {waits}" if waits else "")
+
+def metrics_markup():
+    toggle = "⏹ Stop Profiler" if profiler.is_running() else "▶️ Start Profiler"
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Refresh", callback_data="admin_metrics"),
+         InlineKeyboardButton(toggle, callback_data="admin_profiler")],
+        [back_button("admin")],
+    ])
+
+@admin_only
+async def admin_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text(metrics_text(context.application), reply_markup=metrics_markup(), parse_mode=ParseMode.HTML)
+
+@admin_only
+async def admin_profiler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Starts the sampling profiler, or stops it and sends the collected stacks."""
+    query = update.callback_query
+    if profiler.start():
+        await query.answer("Profiler started. Stop it to get the results.")
+    else:
+        profiler.stop()
+        await query.answer()
+        elapsed = time.time() - profiler.started_at
+        top = "\n".join(f"{share:6.1%}  <code>{html.escape(frame)}</code>" for frame, share in profiler.top(10))
+        await query.message.reply_document(
+            document=profiler.collapsed().encode("utf-8"), filename="profile.collapsed.txt",
+            caption=f"🔬 <b>Profile</b> ({elapsed:.0f}s, {sum(profiler.samples.values())} samples)\n\n{top}"[:1024],
+            parse_mode=ParseMode.HTML)
+    await query.edit_message_text(metrics_text(context.application), reply_markup=metrics_markup(), parse_mode=ParseMode.HTML)
+
+
+# --- LEDGER ---
+def ledger_text(summary):
+    """The transaction log's totals by kind and the last days' flows, for the admin panel."""
+    text = (f"📒 <b>Ledger</b>\n\n<b>Transactions:</b> {summary['count']}\n"
+            f"<b>Outstanding balances:</b> {CURRENCY_SYMBOL}{format_paise(summary['net'])}\n\n<b>By kind</b> (entries, net):\n")
+    for kind, (count, amount) in sorted(summary["kinds"].items()):
+        text += f"<code>{kind}</code>: {count}, {CURRENCY_SYMBOL}{format_paise(amount)}\n"
+    text += "\n<b>Last 7 days</b> (entries, in, out):\n"
+    for day, count, credits, debits in summary["days"]:
+        text += f"{day}: {count}, {CURRENCY_SYMBOL}{format_paise(credits)}, {CURRENCY_SYMBOL}{format_paise(debits)}\n"
+    return text
+
+def ledger_markup(repair=False):
+    keyboard = [[InlineKeyboardButton("🔄 Refresh", callback_data="admin_ledger"),
+                 InlineKeyboardButton("🔁 Reconcile", callback_data="admin_ledger_reconcile")]]
+    if repair:
+        keyboard.append([InlineKeyboardButton("🛠️ Repair from Log", callback_data="admin_ledger_repair")])
+    keyboard.append([back_button("admin")])
+    return InlineKeyboardMarkup(keyboard)
+
+@admin_only
+async def admin_ledger(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text(ledger_text(await ledger.report()), reply_markup=ledger_markup(), parse_mode=ParseMode.HTML)
+
+@admin_only
+async def admin_ledger_reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Checks every stored balance against the log; repairing is a separate, explicit step."""
+    query = update.callback_query
+    fix = query.data == "admin_ledger_repair"
+    await query.answer("Repairing…" if fix else "Reconciling…")
+    result = await ledger.reconcile(fix=fix)
+    mismatches = result["mismatches"]
+    text = f"🔁 <b>Reconcile</b>\n\n<b>Users checked:</b> {result['users']}\n<b>Mismatches:</b> {len(mismatches)}\n"
+    for user_id, stored, logged in mismatches[:10]:
+        text += (f"<code>{user_id}</code>: stored {CURRENCY_SYMBOL}{format_paise(stored)}, "
+                 f"log {CURRENCY_SYMBOL}{format_paise(logged)}\n")
+    if fix:
+        text += f"\n✅ Rebuilt {result['fixed']} balances from the log."
+    await query.edit_message_text(text, reply_markup=ledger_markup(repair=bool(mismatches) and not fix),
+                                  parse_mode=ParseMode.HTML)
+
+
+# --- BULK OPERATIONS ---
+BULK_IMPORTS = {
+    "codes": ("⬆️ Import Codes", "a CSV or JSONL file with <code>code</code> and <code>value</code> columns, "
+              "optionally <code>max_uses</code> and <code>expires_at</code>. Codes that already exist are skipped."),
+    "users": ("⬆️ Import Users", "a CSV or JSONL file with a <code>user_id</code> column, optionally "
+              "<code>balance</code> and <code>joined_at</code>. Users who already exist are skipped."),
+    "settle": ("✅ Settle Payouts", "the withdrawals you have paid, with an <code>id</code> column, e.g. the "
+               "withdrawals export trimmed to the rows paid. They move to the users' payout history."),
+}
+BULK_PARSERS = {"codes": bulk.parse_codes, "users": bulk.parse_users, "settle": bulk.parse_withdrawal_ids}
+GENERATE_USAGE = ("Send <code>COUNT VALUE [MAX_USES] [EXPIRY] [PREFIX]</code>, e.g. <code>500 10</code> or "
+                  "<code>100 25 1 2025-12-31 DIWALI-</code>. Use <code>-</code> to skip MAX_USES or EXPIRY. "
+                  f"At most {bulk.MAX_GENERATED_CODES} codes at once.")
+
+BULK_TEXT = ("📦 <b>Bulk Operations</b>\n\nGenerate codes, import files or export data as CSV/JSONL. "
+             "Each operation is saved in one go, and an import with a bad row applies nothing.\n\n"
+             "Codes can also be generated with <code>/gencodes COUNT VALUE [MAX_USES] [EXPIRY] [PREFIX]</code>.")
+BULK_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🎲 Generate Codes", callback_data="admin_bulk_generate")]]
+    + build_menu([InlineKeyboardButton(label, callback_data=f"admin_bulk_import_{kind}")
+                  for kind, (label, _) in BULK_IMPORTS.items()], n_cols=2)
+    + [[InlineKeyboardButton(f"⬇️ {section.title()} {fmt.upper()}", callback_data=f"admin_export_{section}_{fmt}")
+        for fmt in bulk.FORMATS] for section in bulk.COLUMNS]
+    + [[back_button("admin")]]
+)
+
+async def generate_codes(message, args):
+    """Creates the codes described by `args` and replies with them as a CSV. Returns False on bad input."""
+    try:
+        count, value = int(args[0]), to_paise(args[1])
+        max_uses = int(args[2]) if len(args) > 2 and args[2] != "-" else None
+        expires_at = datetime.fromisoformat(args[3]).isoformat() if len(args) > 3 and args[3] != "-" else None
+        prefix = args[4] if len(args) > 4 else ""
+        if not 0 < count <= bulk.MAX_GENERATED_CODES or value <= 0 or (max_uses is not None and max_uses <= 0):
+            raise ValueError(args)
+    except (ValueError, IndexError):
+        await message.reply_text(f"❌ Invalid input. {GENERATE_USAGE}", reply_markup=BACK_TO_ADMIN_MARKUP, parse_mode=ParseMode.HTML)
+        return False
+
+    created = repo.add_codes([(code, value, max_uses, expires_at) for code in bulk.generate_codes(count, prefix=prefix)])
+    await save_data(urgent=True)
+    rows = [{"code": code, "value": value, "uses": 0, "max_uses": max_uses, "expires_at": expires_at} for code in created]
+    await message.reply_document(
+        document=bulk.dump("codes", rows), filename=f"codes-{datetime.now():%Y%m%d-%H%M%S}.csv",
+        caption=f"🎲 {len(created)} codes worth {CURRENCY_SYMBOL}{format_paise(value)} each.")
+    return True
+
+@admin_only
+async def admin_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text(BULK_TEXT, reply_markup=BULK_MARKUP, parse_mode=ParseMode.HTML)
+
+@admin_only
+async def admin_gencodes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/gencodes COUNT VALUE [MAX_USES] [EXPIRY] [PREFIX]"""
+    await generate_codes(update.message, context.args)
+
+@admin_only
+async def admin_bulk_generate_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text(f"🎲 <b>Generate Codes</b>\n\n{GENERATE_USAGE}", reply_markup=BACK_TO_ADMIN_MARKUP,
+                                  parse_mode=ParseMode.HTML)
+    return ADMIN_BULK_GENERATE
+
+@admin_only
+async def admin_bulk_generate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await generate_codes(update.message, update.message.text.split()):
+        return ADMIN_BULK_GENERATE
+    await show_admin_menu(update, context)
+    return ConversationHandler.END
+
+@admin_only
+async def admin_bulk_import_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    kind = query.data.rsplit("_", 1)[-1]
+    context.user_data["bulk_import"] = kind
+    label, description = BULK_IMPORTS[kind]
+    await query.edit_message_text(f"<b>{label}</b>\n\nSend {description}", reply_markup=BACK_TO_ADMIN_MARKUP,
+                                  parse_mode=ParseMode.HTML)
+    return ADMIN_BULK_IMPORT
+
+@admin_only
+async def admin_bulk_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Parses the whole file before applying any of it, then applies it in one transaction."""
+    document = update.message.document
+    kind = context.user_data["bulk_import"]
+    if document.file_size and document.file_size > bulk.MAX_IMPORT_BYTES:
+        await update.message.reply_text(f"❌ The file is too large; bots can download up to "
+                                        f"{bulk.MAX_IMPORT_BYTES // (1024 * 1024)} MB.", reply_markup=BACK_TO_ADMIN_MARKUP)
+        return ADMIN_BULK_IMPORT
+    data = await (await document.get_file()).download_as_bytearray()
+    try:
+        parsed = BULK_PARSERS[kind](bulk.read_rows(data, document.file_name or ""))
+    except (BulkError, UnicodeDecodeError) as e:
+        await update.message.reply_text(f"❌ {html.escape(str(e))}\nNothing was imported; fix the file and send it again.",
+                                        reply_markup=BACK_TO_ADMIN_MARKUP, parse_mode=ParseMode.HTML)
+        return ADMIN_BULK_IMPORT
+
+    if kind == "codes":
+        created = repo.add_codes(parsed)
+        await save_data(urgent=True)
+        text = f"✅ Imported {len(created)} codes; {len(parsed) - len(created)} already existed."
+    elif kind == "users":
+        created = await ledger.import_users(parsed)
+        text = f"✅ Imported {len(created)} users; {len(parsed) - len(created)} already existed."
+    else:
+        settled, missing = await ledger.settle(parsed)
+        text = (f"✅ Settled {len(settled)} withdrawals totalling "
+                f"{CURRENCY_SYMBOL}{format_paise(sum(request['amount'] for request in settled))}.")
+        if missing:
+            text += (f"\n⚠️ {len(missing)} were no longer pending (cancelled or already settled): "
+                     + ", ".join(f"<code>{html.escape(w_id)}</code>" for w_id in missing[:10]))
+    context.user_data.clear()
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
+    await show_admin_menu(update, context)
+    return ConversationHandler.END
+
+@admin_only
+async def admin_bulk_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Streams a whole section into a temporary file a page at a time and sends it as a document."""
+    query = update.callback_query
+    _, _, section, fmt = query.data.split("_")
+    await query.answer("Exporting…")
+    with tempfile.TemporaryFile() as out:
+        rows = await bulk.export(repo, section, fmt, out)
+        out.seek(0)
+        await query.message.reply_document(
+            document=out, filename=f"{section}-{datetime.now():%Y%m%d-%H%M%S}.{fmt}", caption=f"⬇️ {rows} {section}")
+
+
+# --- NAVIGATION ---
+async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Returns to the user menu, ending any conversation in progress."""
+    query = update.callback_query
+    await query.answer()
+    context.user_data.clear()
+    await show_user_menu(update, context)
+    return ConversationHandler.END
+
+@admin_only
+async def back_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Returns to the admin menu, ending any conversation in progress."""
+    query = update.callback_query
+    await query.answer()
+    context.user_data.clear()
+    await show_admin_menu(update, context)
+    return ConversationHandler.END
+
+
+# =========================================================================================
+# ==================================== BOT STARTUP ========================================
+# =========================================================================================
+
+async def post_init(application: Application) -> None:
+    """Starts background tasks once the application is running."""
+    global metrics_runner
+    await repo.start()
+    broadcaster.resume(application.bot)
+    if METRICS_PORT:
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+async def post_shutdown(application: Application) -> None:
+    """Stops background tasks and leaves a compacted snapshot behind."""
+    await broadcaster.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    profiler.stop()
+    await repo.close()
+
+def conversation_handler(name, **kwargs) -> ConversationHandler:
+    """A ConversationHandler whose states are shared by every worker when the storage is."""
+    if repo.shared:
+        from shared_state import SharedConversationHandler
+        return SharedConversationHandler(repo.conversation_store(name), name=name, **kwargs)
+    return ConversationHandler(name=name, **kwargs)
+
+def build_application(request=None) -> Application:
+    """Builds the application and registers every handler.
+
+    `request` replaces the HTTP layer used for Bot API calls, e.g. bench.py's fake Bot API.
+    """
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    # Only this process edits its messages unless the storage is shared with other workers
+    scheduler = OutboundScheduler(
+        InstrumentedRequest(request or HTTPXRequest(connection_pool_size=BOT_API_CONNECTIONS)),
+        slots=BOT_API_CONNECTIONS, max_retry_after=BOT_API_MAX_RETRY_AFTER,
+        remember_messages=0 if repo.shared else 10_000)
+    metrics.OUTBOUND_QUEUED.callback = scheduler.queued
+    builder = builder.request(scheduler)
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)  # Updates arrive through WebhookServer instead
+    if repo.shared:
+        from shared_state import shared_context_types
+        builder = builder.context_types(shared_context_types(repo))
+    application = builder.build()
+
+    back_handlers = [
+        CallbackQueryHandler(back_to_main, pattern="^back_to_main$"),
+        CallbackQueryHandler(back_to_admin, pattern="^back_to_admin$"),
+    ]
+    text_input = filters.TEXT & ~filters.COMMAND
+
+    redeem_conv = conversation_handler(
+        "redeem",
+        entry_points=[CallbackQueryHandler(redeem_start, pattern="^user_redeem$")],
+        states={REDEEM_CODE_STATE: [MessageHandler(text_input, redeem_code)]},
+        fallbacks=back_handlers,
+    )
+    withdraw_conv = conversation_handler(
+        "withdraw",
+        entry_points=[CallbackQueryHandler(withdraw_start, pattern="^user_withdraw$")],
+        states={
+            WITHDRAW_AMOUNT_STATE: [MessageHandler(text_input, withdraw_amount)],
+            WITHDRAW_UPI_STATE: [MessageHandler(text_input, withdraw_upi)],
+        },
+        fallbacks=back_handlers,
+    )
+    add_code_conv = conversation_handler(
+        "add_code",
+        entry_points=[CallbackQueryHandler(admin_add_code_start, pattern="^admin_add_code$")],
+        states={
+            ADMIN_ADD_CODE_TEXT: [MessageHandler(text_input, admin_add_code_text)],
+            ADMIN_ADD_CODE_VALUE: [MessageHandler(text_input, admin_add_code_value)],
+        },
+        fallbacks=back_handlers,
+    )
+    bulk_generate_conv = conversation_handler(
+        "bulk_generate",
+        entry_points=[CallbackQueryHandler(admin_bulk_generate_start, pattern="^admin_bulk_generate$")],
+        states={ADMIN_BULK_GENERATE: [MessageHandler(text_input, admin_bulk_generate)]},
+        fallbacks=back_handlers,
+    )
+    bulk_import_conv = conversation_handler(
+        "bulk_import",
+        entry_points=[CallbackQueryHandler(admin_bulk_import_start, pattern="^admin_bulk_import_(codes|users|settle)$")],
+        states={ADMIN_BULK_IMPORT: [MessageHandler(filters.Document.ALL, admin_bulk_import)]},
+        fallbacks=back_handlers,
+    )
+    send_message_conv = conversation_handler(
+        "send_message",
+        entry_points=[CallbackQueryHandler(admin_send_message_start, pattern="^admin_send_message$")],
+        states={
+            ADMIN_SEND_MESSAGE_CONFIRM: [
+                MessageHandler(text_input, admin_send_message_text),
+                CallbackQueryHandler(admin_send_message_confirm, pattern="^admin_broadcast_confirm$"),
+            ],
+        },
+        fallbacks=back_handlers,
+    )
+
+    application.add_handler(TypeHandler(Update, throttle_updates), group=-2)
+    if repo.shared:
+        application.add_handler(TypeHandler(Update, load_shared_state), group=-1)
+        application.add_handler(TypeHandler(Update, save_shared_state), group=1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("gencodes", admin_gencodes))
+    application.add_handler(redeem_conv)
+    application.add_handler(withdraw_conv)
+    application.add_handler(add_code_conv)
+    application.add_handler(bulk_generate_conv)
+    application.add_handler(bulk_import_conv)
+    application.add_handler(send_message_conv)
+    application.add_handler(CallbackQueryHandler(wallet_handler, pattern="^user_wallet$"))
+    application.add_handler(CallbackQueryHandler(earn_handler, pattern="^user_earn$"))
+    application.add_handler(CallbackQueryHandler(list_cancellable_withdrawals, pattern="^user_cancel_withdraw_list$"))
+    application.add_handler(CallbackQueryHandler(list_pending_withdrawals, pattern="^user_check_withdraw$"))
+    application.add_handler(CallbackQueryHandler(cancel_withdrawal, pattern="^user_cancel_withdraw_confirm_"))
+    application.add_handler(CallbackQueryHandler(support_handler, pattern="^user_support$"))
+    application.add_handler(CallbackQueryHandler(how_to_handler, pattern="^user_how_to$"))
+    application.add_handler(CallbackQueryHandler(admin_view_users, pattern=r"^(admin_view_users_\d+|avu\|.*)$"))
+    application.add_handler(CallbackQueryHandler(admin_view_withdrawals, pattern=r"^(admin_view_withdrawals_\d+|avw\|.*)$"))
+    application.add_handler(CallbackQueryHandler(admin_broadcast_cancel, pattern="^admin_broadcast_cancel$"))
+    application.add_handler(CallbackQueryHandler(admin_metrics, pattern="^admin_metrics$"))
+    application.add_handler(CallbackQueryHandler(admin_profiler, pattern="^admin_profiler$"))
+    application.add_handler(CallbackQueryHandler(admin_ledger, pattern="^admin_ledger$"))
+    application.add_handler(CallbackQueryHandler(admin_ledger_reconcile, pattern="^admin_ledger_(reconcile|repair)$"))
+    application.add_handler(CallbackQueryHandler(admin_bulk, pattern="^admin_bulk$"))
+    application.add_handler(CallbackQueryHandler(admin_bulk_export, pattern="^admin_export_(users|codes|withdrawals)_(csv|jsonl)$"))
+    application.add_handlers(back_handlers)
+
+    instrument_handlers(application)
+    metrics.UPDATE_QUEUE.callback = application.update_queue.qsize
+    return application
+
+def main() -> None:
+    """Starts the bot with long polling, or behind a webhook server when BOT_MODE=webhook."""
+    application = build_application()
+    if BOT_MODE == "webhook":
+        import asyncio
+        import secrets
+        from webhook import WebhookServer, serve
+
+        secret = WEBHOOK_SECRET
+        if not secret:
+            if not WEBHOOK_URL:
+                # Nothing registers the webhook, so whoever POSTs to it has to know the secret
+                raise SystemExit("BOT_MODE=webhook without WEBHOOK_URL needs WEBHOOK_SECRET")
+            secret = secrets.token_urlsafe(32)  # Handed to Telegram by set_webhook
+        server = WebhookServer(application, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                               secret_token=secret, drain_timeout=WEBHOOK_DRAIN_TIMEOUT,
+                               reuse_port=WEBHOOK_REUSE_PORT)
+        logger.info("Bot is starting in webhook mode...")
+        asyncio.run(serve(application, server, webhook_url=WEBHOOK_URL, max_connections=CONCURRENT_UPDATES))
+        return
+
+    logger.info("Bot is starting...")
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+if __name__ == "__main__":
+    main()
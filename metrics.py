@@ -0,0 +1,328 @@
+# metrics.py
+
+import bisect
+import collections
+import logging
+import sys
+import threading
+import time
+from functools import wraps
+
+from telegram.ext import ApplicationHandlerStop
+from telegram.request import BaseRequest
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers both sub-millisecond handlers and slow Bot API round-trips
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# --- METRIC TYPES ---
+# Only what the Prometheus text format needs, so the bot doesn't depend on a client library.
+def _label_text(names, values):
+    if not names:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = collections.defaultdict(float)
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] += amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0.0)
+
+    def items(self):
+        return list(self._values.items())
+
+    def samples(self):
+        for values, value in sorted(self._values.items()):
+            yield self.name, _label_text(self.labels, values), value
+
+class Gauge(Counter):
+    """A value that goes up and down, or a `callback` read at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), callback=None):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+
+    def set(self, value, *label_values):
+        self._values[label_values] = value
+
+    def dec(self, *label_values, amount=1):
+        self._values[label_values] -= amount
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                self._values[()] = float(self.callback())
+            except Exception:  # A broken callback must not break the whole scrape
+                logger.exception("Gauge %s callback failed", self.name)
+        return super().samples()
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, *label_values):
+        series = self._series.get(label_values)
+        return sum(series[:-1]) if series else 0
+
+    def quantile(self, q, *label_values):
+        """Upper bound of the bucket holding the q-quantile, or None without samples."""
+        series = self._series.get(label_values)
+        total = sum(series[:-1]) if series else 0
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), series):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return float("inf")
+
+    def label_values(self):
+        return list(self._series)
+
+    def samples(self):
+        for values, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", _label_text(self.labels + ("le",), values + (le,)), cumulative
+            yield f"{self.name}_sum", _label_text(self.labels, values), series[-1]
+            yield f"{self.name}_count", _label_text(self.labels, values), cumulative
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """The Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value:.17g}" if isinstance(value, float) else f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+HANDLER_SECONDS = REGISTRY.register(Histogram(
+    "bot_handler_seconds", "Time spent in each handler, Bot API calls included.", ["handler"]))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    "bot_handler_errors_total", "Handlers that raised.", ["handler", "error"]))
+HANDLERS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "bot_handlers_in_flight", "Handlers currently running."))
+API_SECONDS = REGISTRY.register(Histogram(
+    "bot_api_seconds", "Bot API round-trips by method.", ["method"]))
+API_ERRORS = REGISTRY.register(Counter(
+    "bot_api_errors_total", "Bot API calls answered with an error status, or not at all.", ["method", "status"]))
+FLUSH_SECONDS = REGISTRY.register(Histogram(
+    "bot_persistence_flush_seconds", "Journal flushes by the background writer."))
+FLUSH_RECORDS = REGISTRY.register(Counter(
+    "bot_persistence_records_total", "Journal records written."))
+FLUSH_BYTES = REGISTRY.register(Counter(
+    "bot_persistence_bytes_total", "Journal bytes written."))
+BUFFERED_RECORDS = REGISTRY.register(Gauge(
+    "bot_persistence_buffered_records", "Journal records waiting for the next flush."))
+UPDATE_QUEUE = REGISTRY.register(Gauge(
+    "bot_update_queue_depth", "Updates received but not yet picked up by a handler."))
+THROTTLED = REGISTRY.register(Counter(
+    "bot_throttled_total", "Updates dropped by the rate limiter, by action.", ["action"]))
+THROTTLE_BUCKETS = REGISTRY.register(Gauge(
+    "bot_throttle_buckets", "Token buckets held in memory by the rate limiter."))
+OUTBOUND_WAIT = REGISTRY.register(Histogram(
+    "bot_outbound_wait_seconds", "Time Bot API calls wait for a connection or a flood pause, by priority.", ["priority"]))
+OUTBOUND_QUEUED = REGISTRY.register(Gauge(
+    "bot_outbound_queued", "Bot API calls waiting for a connection."))
+FLOOD_WAITS = REGISTRY.register(Counter(
+    "bot_flood_waits_total", "Bot API calls answered with 429 Too Many Requests, by method.", ["method"]))
+EDITS_SKIPPED = REGISTRY.register(Counter(
+    "bot_edits_skipped_total", "Message edits not sent because they would change nothing."))
+
+
+# --- INSTRUMENTATION ---
+def instrumented(func, name=None):
+    """Wraps a handler callback to record its latency, errors and concurrency."""
+    name = name or getattr(func, "__name__", repr(func))
+
+    @wraps(func)
+    async def wrapped(*args, **kwargs):
+        HANDLERS_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except ApplicationHandlerStop:  # Control flow, e.g. the rate limiter dropping an update
+            raise
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+            HANDLERS_IN_FLIGHT.dec()
+    return wrapped
+
+def instrument_handlers(application):
+    """Wraps the callback of every handler registered so far, inside conversations too."""
+    def walk(handlers):
+        for handler in handlers:
+            if hasattr(handler, "entry_points"):  # ConversationHandler
+                walk(handler.entry_points)
+                for state_handlers in handler.states.values():
+                    walk(state_handlers)
+                walk(handler.fallbacks)
+            elif not getattr(handler.callback, "_instrumented", False):
+                handler.callback = instrumented(handler.callback)
+                handler.callback._instrumented = True
+
+    for handlers in application.handlers.values():
+        walk(handlers)
+
+def observe_flush(seconds, records, written):
+    """PersistenceService `on_flush` hook."""
+    FLUSH_SECONDS.observe(seconds)
+    FLUSH_RECORDS.inc(amount=records)
+    FLUSH_BYTES.inc(amount=written)
+
+
+class InstrumentedRequest(BaseRequest):
+    """Wraps the Bot API request layer to time every call by method."""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await self.inner.do_request(url, method, request_data=request_data, **kwargs)
+        except Exception as e:
+            API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, api_method)
+        if status >= 400:
+            API_ERRORS.inc(api_method, str(status))
+        return status, payload
+
+
+# --- SAMPLING PROFILER ---
+class SamplingProfiler:
+    """Samples the event loop thread's stack every `interval` seconds from a helper thread.
+
+    Cheap enough to switch on in production for a minute. Stacks are counted in the
+    "collapsed" format (frame;frame;frame count) that flame graph tools read.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.started_at = None
+        self._target = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return False
+        self.samples.clear()
+        self.started_at = time.time()
+        self._target = threading.get_ident()  # Called from the event loop thread
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if not self.is_running():
+            return False
+        self._stop.set()
+        self._thread.join()
+        return True
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
+
+    def top(self, n=10):
+        """The `n` innermost frames seen most often, as (frame, share of samples)."""
+        total = sum(self.samples.values()) or 1
+        leaves = collections.Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return [(frame, count / total) for frame, count in leaves.most_common(n)]
+
+
+# --- HTTP ENDPOINT ---
+async def start_metrics_server(host, port):
+    """Serves REGISTRY on http://host:port/metrics. Returns the runner, or None if the port is taken."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.warning("Metrics endpoint not started on %s:%d: %s", host, port, e)
+        await runner.cleanup()
+        return None
+    logger.info("Metrics on http://%s:%d/metrics", host, port)
+    return runner
@@ -0,0 +1,35 @@
+# money.py
+
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+# Balances, code values and withdrawal amounts are integer paise everywhere below the
+# handlers. Rupees only exist in what admins and users type and in what they are shown.
+PAISE_PER_RUPEE = 100
+
+
+def to_paise(amount):
+    """Parses a rupee amount ("12.5", Decimal("12.50"), 12) into integer paise.
+
+    Raises ValueError for anything that isn't a finite number with at most two decimals,
+    so "10.005" is refused instead of being rounded behind the user's back.
+    """
+    try:
+        value = Decimal(str(amount).strip())
+    except InvalidOperation:
+        raise ValueError(f"Not an amount: {amount!r}") from None
+    if not value.is_finite():
+        raise ValueError(f"Not an amount: {amount!r}")
+    paise = value * PAISE_PER_RUPEE
+    if paise != paise.to_integral_value():
+        raise ValueError(f"More than two decimals: {amount!r}")
+    return int(paise)
+
+def paise_from_float(rupees):
+    """Converts a float rupee value stored by an older version, rounding away float noise."""
+    return int((Decimal(repr(float(rupees))) * PAISE_PER_RUPEE).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def format_paise(paise):
+    """12345 -> "123.45", exactly, for display next to the currency symbol."""
+    sign = "-" if paise < 0 else ""
+    rupees, rest = divmod(abs(int(paise)), PAISE_PER_RUPEE)
+    return f"{sign}{rupees}.{rest:02d}"
@@ -0,0 +1,232 @@
+# outbound.py
+
+import asyncio
+import collections
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+from telegram.request import BaseRequest
+
+from metrics import EDITS_SKIPPED, FLOOD_WAITS, OUTBOUND_WAIT
+
+logger = logging.getLogger(__name__)
+
+# Lower goes first. Interactive is the default, so only background senders have to say so.
+URGENT, INTERACTIVE, NOTIFY, BULK = 0, 1, 2, 3
+PRIORITY_NAMES = ("urgent", "interactive", "notify", "bulk")
+_PRIORITY = contextvars.ContextVar("outbound_priority", default=INTERACTIVE)
+
+# Calls the user is watching a spinner for; they go ahead of everything else
+URGENT_METHODS = ("answerCallbackQuery",)
+# What a message shows; an edit that repeats these for the same message changes nothing
+CONTENT_FIELDS = ("text", "parse_mode", "entities", "reply_markup", "link_preview_options", "disable_web_page_preview")
+# Other calls that change a message, after which its remembered content is stale
+MESSAGE_CHANGES = ("editMessageReplyMarkup", "editMessageCaption", "editMessageMedia", "deleteMessage")
+
+
+@contextmanager
+def outbound_priority(priority):
+    """Sends the Bot API calls made inside the block, in this task, at `priority`."""
+    token = _PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+def _retry_after(payload):
+    try:
+        return float(json.loads(payload)["parameters"]["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class OutboundScheduler(BaseRequest):
+    """Queues every Bot API call through `slots` connections, highest priority first.
+
+    `slots` should match the connection pool of `inner`, so calls wait here, in priority
+    order, rather than in the pool, where the first to ask wins. A 429 on a call to a chat
+    pauses that chat for the `retry_after` Telegram asks for, without holding a connection;
+    a 429 on a call to no chat, or on `global_after` chats paused at once, is the bot's
+    own limit and pauses every call. Calls paused for at most `max_retry_after` are then
+    retried once, and longer waits are left to the caller.
+
+    Edits that would leave a message as it is are answered from memory: the content each
+    recent message was sent or edited with is kept, up to `remember_messages`, so repeating
+    it skips the round-trip and the "message is not modified" error. Only use that when this
+    process is the only one editing the bot's messages.
+    """
+
+    def __init__(self, inner, slots=64, max_retry_after=30.0, remember_messages=10_000, global_after=3):
+        self.inner = inner
+        self.slots = slots
+        self.max_retry_after = max_retry_after
+        self.remember_messages = remember_messages
+        self.global_after = global_after
+        self._in_flight = 0
+        self._waiting = []  # Heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._chats_paused_until = {}  # chat_id -> monotonic time
+        self._messages = collections.OrderedDict()  # (chat_id, message_id) or inline id -> (content, payload)
+        self.flood_waits = 0
+        self.edits_skipped = 0
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    def queued(self):
+        return sum(1 for *_, future in self._waiting if not future.done())
+
+    def paused_for(self):
+        return max(self._paused_until - time.monotonic(), 0.0)
+
+    def stats(self):
+        return {"in_flight": self._in_flight, "queued": self.queued(), "paused_for": self.paused_for(),
+                "paused_chats": len(self._paused_chats()), "flood_waits": self.flood_waits,
+                "edits_skipped": self.edits_skipped}
+
+    # --- Slots ---
+    async def _acquire(self, priority):
+        if self._in_flight < self.slots and not self._waiting:
+            self._in_flight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()  # Handed a slot just as we were cancelled
+            raise
+
+    def _release(self):
+        while self._waiting:
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                future.set_result(None)  # The slot passes straight to the next caller
+                return
+        self._in_flight -= 1
+
+    # --- Flood control ---
+    def _paused_chats(self):
+        now = time.monotonic()
+        return [chat for chat, until in self._chats_paused_until.items() if until > now]
+
+    def _pause(self, chat, retry_after):
+        now = time.monotonic()
+        until = now + retry_after
+        if chat is not None:
+            self._chats_paused_until = {c: t for c, t in self._chats_paused_until.items() if t > now}
+            self._chats_paused_until[chat] = max(self._chats_paused_until.get(chat, 0.0), until)
+            if len(self._chats_paused_until) < self.global_after:
+                return False
+        self._paused_until = max(self._paused_until, until)
+        return True
+
+    async def _wait_out_chat_pause(self, chat):
+        while (delay := self._chats_paused_until.get(chat, 0.0) - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    async def _wait_out_pause(self):
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+    # --- Messages ---
+    def _message_key(self, params):
+        if "inline_message_id" in params:
+            return params["inline_message_id"]
+        if "chat_id" in params and "message_id" in params:
+            return (str(params["chat_id"]), str(params["message_id"]))
+        return None
+
+    def _remember(self, key, content, payload):
+        self._messages[key] = (content, payload)
+        self._messages.move_to_end(key)
+        if len(self._messages) > self.remember_messages:
+            self._messages.popitem(last=False)
+
+    def _remember_sent(self, content, payload):
+        try:
+            message = json.loads(payload)["result"]
+            key = (str(message["chat"]["id"]), str(message["message_id"]))
+        except (ValueError, KeyError, TypeError):
+            return
+        self._remember(key, content, payload)
+
+    # --- Requests ---
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        priority = _PRIORITY.get()
+        if api_method in URGENT_METHODS:
+            priority = URGENT
+        elif request_data is not None and request_data.contains_files:
+            priority = max(priority, NOTIFY)  # Uploads hold a connection for long
+
+        key = content = None
+        if self.remember_messages and request_data is not None and api_method in ("sendMessage", "editMessageText", *MESSAGE_CHANGES):
+            params = request_data.json_parameters
+            key = self._message_key(params)
+            if api_method in MESSAGE_CHANGES:
+                if key is not None:
+                    self._messages.pop(key, None)
+                key = None
+            else:
+                content = tuple(params.get(field) for field in CONTENT_FIELDS)
+                remembered = self._messages.get(key) if key is not None else None
+                if remembered is not None and remembered[0] == content:
+                    self.edits_skipped += 1
+                    EDITS_SKIPPED.inc()
+                    return 200, remembered[1]
+
+        status, payload = await self._send(url, method, request_data, priority, kwargs)
+        if content is not None:
+            if key is None:
+                if 200 <= status < 300 and priority == INTERACTIVE:  # Not every broadcast recipient
+                    self._remember_sent(content, payload)
+            elif 200 <= status < 300:
+                self._remember(key, content, payload)
+            else:
+                self._messages.pop(key, None)
+        return status, payload
+
+    async def _send(self, url, method, request_data, priority, kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        chat = request_data.json_parameters.get("chat_id") if request_data is not None else None
+        retried = False
+        while True:
+            queued_at = time.perf_counter()
+            if chat is not None:
+                await self._wait_out_chat_pause(chat)  # Other chats keep the connections meanwhile
+            await self._acquire(priority)
+            try:
+                await self._wait_out_pause()
+                OUTBOUND_WAIT.observe(time.perf_counter() - queued_at, PRIORITY_NAMES[priority])
+                status, payload = await self.inner.do_request(url, method, request_data=request_data, **kwargs)
+            finally:
+                self._release()
+            if status != 429:
+                return status, payload
+            retry_after = _retry_after(payload)
+            self.flood_waits += 1
+            FLOOD_WAITS.inc(api_method)
+            if retry_after is None or retry_after > self.max_retry_after:
+                return status, payload
+            if self._pause(chat, retry_after):
+                logger.warning("Flood control on %s, pausing Bot API calls for %ss", api_method, retry_after)
+            else:
+                logger.info("Flood control on %s, pausing chat %s for %ss", api_method, chat, retry_after)
+            if retried:
+                return status, payload
+            retried = True
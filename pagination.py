@@ -0,0 +1,136 @@
+# pagination.py
+
+import base64
+import uuid
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+# A page of records plus the cursors needed to fetch its neighbours.
+# `first`/`last` are (key, id) tuples, or None when the page is empty.
+Page = namedtuple("Page", "items first last has_prev has_next")
+
+EPOCH = datetime(1970, 1, 1)
+
+
+# --- SORT ORDERS ---
+class SortOrder:
+    """How one listing is sorted.
+
+    Records are ordered ascending by (key, id). Descending orders negate a numeric key, so
+    every backend only ever seeks forwards or backwards through an ascending index.
+    `sql` is the matching column expression for the SQLite backend.
+    """
+
+    def __init__(self, code, label, key, sql, numeric):
+        self.code = code  # One letter, used in callback_data
+        self.label = label
+        self.key = key
+        self.sql = sql
+        self.numeric = numeric
+
+    def encode_key(self, key):
+        return repr(key) if self.numeric else _encode_timestamp(key)
+
+    def decode_key(self, text):
+        return float(text) if self.numeric else _decode_timestamp(text)
+
+
+USER_ORDERS = {
+    "b": SortOrder("b", "💰 Balance", key=lambda user: -user["balance"], sql="-balance", numeric=True),
+    "j": SortOrder("j", "📅 Join Date", key=lambda user: user.get("joined_at", ""), sql="joined_at", numeric=False),
+}
+WITHDRAWAL_ORDERS = {
+    "t": SortOrder("t", "🕒 Oldest", key=lambda w: w["timestamp"], sql="timestamp", numeric=False),
+    "a": SortOrder("a", "💵 Amount", key=lambda w: -w["amount"], sql="-amount", numeric=True),
+}
+
+
+# --- CURSOR ENCODING ---
+# Callback data is limited to 64 bytes, so ISO timestamps and UUIDs are packed:
+# "avw|a|n|-1500.0|u<22 chars>" is at most ~55 bytes.
+def _encode_timestamp(iso):
+    try:
+        micros = (datetime.fromisoformat(iso) - EPOCH) // timedelta(microseconds=1)
+    except (TypeError, ValueError):
+        micros = None
+    if micros is not None and micros >= 0 and _decode_timestamp(f"t{micros:x}") == iso:
+        return f"t{micros:x}"
+    return f"r{iso}"  # Not round-trippable (e.g. has a timezone); keep it verbatim
+
+def _decode_timestamp(text):
+    if text.startswith("t"):
+        return (EPOCH + timedelta(microseconds=int(text[1:], 16))).isoformat()
+    return text[1:]
+
+def _encode_id(item_id):
+    try:
+        packed = uuid.UUID(item_id).bytes
+    except ValueError:
+        return f"r{item_id}"
+    if str(uuid.UUID(bytes=packed)) != item_id:
+        return f"r{item_id}"
+    return "u" + base64.urlsafe_b64encode(packed).decode("ascii").rstrip("=")
+
+def _decode_id(text):
+    if text.startswith("u"):
+        return str(uuid.UUID(bytes=base64.urlsafe_b64decode(text[1:] + "==")))
+    return text[1:]
+
+def encode_cursor(prefix, order, backwards, cursor):
+    """Builds callback_data like "avu|b|n|<key>|<id>" for the page after/before `cursor`."""
+    key, item_id = cursor
+    return f"{prefix}|{order.code}|{'p' if backwards else 'n'}|{order.encode_key(key)}|{_encode_id(item_id)}"
+
+def decode_page_request(data, orders, default_code):
+    """Parses callback_data into (order, backwards, cursor).
+
+    Accepts the legacy "admin_view_users_0" form and "avu|b" (first page of an order) as
+    well as full cursors from `encode_cursor`.
+    """
+    parts = data.split("|", 4)
+    if len(parts) < 2:
+        return orders[default_code], False, None
+    order = orders.get(parts[1], orders[default_code])
+    if len(parts) < 5:
+        return order, False, None
+    return order, parts[2] == "p", (order.decode_key(parts[3]), _decode_id(parts[4]))
+
+
+# --- IN-MEMORY INDEX ---
+class SortedIndex:
+    """Sorted list of (key, id) pairs.
+
+    Updates cost a binary search plus a memmove; reading a page from a cursor costs
+    O(log n + page size), however many records there are.
+    """
+
+    def __init__(self, pairs=()):
+        self._pairs = sorted(pairs)
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def add(self, key, item_id):
+        insort(self._pairs, (key, item_id))
+
+    def discard(self, key, item_id):
+        i = bisect_left(self._pairs, (key, item_id))
+        if i < len(self._pairs) and self._pairs[i] == (key, item_id):
+            del self._pairs[i]
+
+    def page(self, cursor=None, backwards=False, limit=10):
+        """Returns (pairs, has_prev, has_next) for the page after (or before) `cursor`."""
+        if backwards:
+            end = bisect_left(self._pairs, cursor) if cursor is not None else len(self._pairs)
+            start = max(end - limit, 0)
+        else:
+            start = bisect_right(self._pairs, cursor) if cursor is not None else 0
+            end = min(start + limit, len(self._pairs))
+        return self._pairs[start:end], start > 0, end < len(self._pairs)
+
+
+def make_page(pairs, items, has_prev, has_next):
+    if not pairs:
+        return Page([], None, None, has_prev, has_next)
+    return Page(items, pairs[0], pairs[-1], has_prev, has_next)
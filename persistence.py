@@ -0,0 +1,580 @@
+# persistence.py
+
+import asyncio
+import copy
+import gc
+import json
+import logging
+import os
+import re
+import time
+import zlib
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_SUFFIX = ".journal"
+ROTATED_SUFFIX = ".journal.1"
+SEQ_KEY = "_seq"  # Last journal sequence number folded into the snapshot
+CORRUPT_SUFFIX = ".corrupt"
+# First line of a snapshot; snapshots written before it existed are plain JSON
+SNAPSHOT_HEADER = b"#snapshot v2 crc32=%08x size=%d\n"
+_HEADER_RE = re.compile(rb"#snapshot v2 crc32=([0-9a-f]{8}) size=(\d+)\n")
+
+
+class SnapshotError(Exception):
+    """Snapshots exist but none of them can be read; starting empty would lose every record."""
+
+
+# --- LOW-LEVEL FILE HELPERS ---
+def atomic_write_bytes(path, payload):
+    """Writes bytes to `path` via a temp file + fsync + rename, so readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    _write_synced(tmp_path, payload)
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+def _write_synced(path, payload):
+    with open(path, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _fsync_dir(directory):
+    """Makes a rename durable. Not supported on every platform, so failures are ignored."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _replace_if_exists(src, dst):
+    try:
+        os.replace(src, dst)
+    except FileNotFoundError:
+        pass
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+@contextmanager
+def _gc_paused():
+    """Parsing allocates millions of objects that all survive; collections in between are wasted."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+# --- JOURNAL OPERATIONS ---
+def _resolve(data, path):
+    """Walks all but the last path element and returns (container, last_key)."""
+    node = data
+    for key in path[:-1]:
+        node = node[key]
+    return node, path[-1]
+
+def apply_op(data, op, path, value=None):
+    """Applies a single journal operation to the in-memory state."""
+    container, key = _resolve(data, path)
+    if op == "set":
+        container[key] = value
+    elif op == "del":
+        container.pop(key, None)
+    elif op == "incr":
+        container[key] = container.get(key, 0) + value
+    elif op == "append":
+        container.setdefault(key, []).append(value)
+    elif op == "add":
+        container[key].add(value)
+    elif op == "remove":
+        items = container.get(key, [])
+        if value in items:  # Ignore removals that were already applied
+            items.remove(value)
+    else:
+        raise ValueError(f"Unknown journal op: {op!r}")
+
+
+class Journal:
+    """Write-ahead journal of state mutations, periodically compacted into a JSON snapshot.
+
+    Every mutation goes through `apply`, which updates the in-memory state and buffers one
+    compact JSON line for `<snapshot>.journal`; `write_pending` puts buffered lines on disk.
+    `compact` folds the journal into the snapshot with an atomic rename, and `load` rebuilds
+    state from snapshot plus journal.
+
+    `object_hook` and `default` are passed to the JSON decoder and encoder for both the
+    snapshot and journal records, so callers can keep richer types in memory. `pack` and
+    `unpack` convert the state to and from a more compact snapshot layout, and `validate`
+    raises ValueError for a snapshot that parses but doesn't have the expected shape.
+
+    Records reach the disk unsynced unless `fsync` is set, or a write asks for `sync`, so
+    a power cut can lose the last moments of records that nobody waited for.
+
+    Compaction never blocks mutations for long: `begin_compaction` copies each top-level
+    section of the state, which is all the snapshot shares with it, and until
+    `end_compaction` every record `apply` is about to change in place (a user, a code) is
+    first replaced by a deep copy, so `finish_compaction` can serialize the snapshot from
+    another thread while the state keeps changing.
+
+    Snapshots start with a header carrying their size and CRC-32, checked before parsing.
+    Each compaction keeps the snapshot it replaces as `<snapshot>.bak1`, with the journal
+    records written since as `<snapshot>.bak1.journal`, and shifts older ones up to
+    `backups`. If the snapshot can't be read, `load` moves it aside and starts from the
+    newest good backup, replaying the journals that followed it, so nothing is lost.
+    """
+
+    def __init__(self, snapshot_path, compact_every=5000, fsync=False, object_hook=None, default=None,
+                 pack=None, unpack=None, validate=None, backups=3):
+        self.snapshot_path = snapshot_path
+        self.journal_path = snapshot_path + JOURNAL_SUFFIX
+        self.rotated_path = snapshot_path + ROTATED_SUFFIX
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.object_hook = object_hook
+        self.default = default
+        self.pack = pack
+        self.unpack = unpack
+        self.validate = validate
+        self.backups = backups
+        self.recovered_from = None  # Path of the backup `load` fell back to, if any
+        self.data = None
+        self.seq = 0
+        self.pending_records = 0  # Records written since the last compaction
+        self.unsynced = False  # Records written since the last fsync
+        self._buffer = []  # Encoded records not yet handed to write_pending
+        self._file = None
+        self._unshared = None  # While compacting: (section, key) of records no longer in the snapshot
+
+    # --- Startup ---
+    def backup_paths(self, n):
+        """(snapshot, journal) of backup `n`; 1 is the newest."""
+        path = f"{self.snapshot_path}.bak{n}"
+        return path, path + JOURNAL_SUFFIX
+
+    def load(self, default_factory):
+        """Loads the newest readable snapshot and replays the journal records written after it.
+
+        Raises SnapshotError rather than starting from `default_factory` when snapshot files
+        exist but none can be read.
+        """
+        data, backup = self._load_snapshot()
+        if data is None:
+            data = default_factory()
+        self.seq = data.pop(SEQ_KEY, 0)
+
+        # A backup also needs the journals of every compaction after it
+        journals = [self.backup_paths(n)[1] for n in range(backup, 0, -1)] + [self.rotated_path, self.journal_path]
+        replayed = 0
+        with _gc_paused():
+            for path in journals:
+                for record in self._read_journal(path, repair=path == self.journal_path):
+                    if record["seq"] <= self.seq:
+                        continue  # Already folded into the snapshot by an interrupted compaction
+                    if record["seq"] != self.seq + 1:
+                        logger.error("Journal records %d-%d are missing before %s", self.seq + 1, record["seq"] - 1, path)
+                    apply_op(data, record["op"], record["path"], record.get("value"))
+                    self.seq = record["seq"]
+                    replayed += 1
+        if replayed:
+            logger.info("Replayed %d journal records on top of %s", replayed, self.snapshot_path)
+        gc.freeze()  # Loaded state lives as long as the process; keep it out of future collections
+
+        self.data = data
+        self.pending_records = replayed
+        if backup:
+            self.pending_records = max(replayed, self.compact_every)  # Write a good snapshot soon
+        self._file = open(self.journal_path, "ab")
+        return data
+
+    def _load_snapshot(self):
+        """Returns (data, backup number) of the newest snapshot that reads and validates.
+
+        A damaged snapshot is only moved aside to `<snapshot>.corrupt` once a backup has
+        loaded in its place, so the next compaction doesn't rotate it into the backups.
+        Without a good backup every file stays where it is, and a `.corrupt` file left by
+        an earlier start counts as a snapshot that can't be read.
+        """
+        candidates = [(self.snapshot_path, 0)] + [(self.backup_paths(n)[0], n) for n in range(1, self.backups + 1)]
+        corrupt_path = self.snapshot_path + CORRUPT_SUFFIX
+        damaged = [corrupt_path] if os.path.exists(corrupt_path) else []
+        for path, backup in candidates:
+            try:
+                data = self._read_snapshot(path)
+            except FileNotFoundError:
+                continue
+            except ValueError as e:
+                damaged.append(path)
+                logger.error("Snapshot %s is unusable: %s", path, e)
+                continue
+            if backup:
+                self.recovered_from = path
+                logger.warning("Recovering from backup %s", path)
+                if self.snapshot_path in damaged:
+                    os.replace(self.snapshot_path, corrupt_path)
+                    logger.error("Moved %s to %s", self.snapshot_path, corrupt_path)
+            return data, backup
+        if damaged:
+            raise SnapshotError(f"No readable snapshot of {self.snapshot_path} ({', '.join(damaged)} "
+                                f"can't be used); restore one by hand before starting")
+        return None, 0
+
+    def _read_snapshot(self, path):
+        """Reads and checks one snapshot. Raises ValueError if it's damaged or malformed."""
+        with open(path, "rb") as f:
+            raw = f.read()
+        match = _HEADER_RE.match(raw)
+        start = 0
+        if match is not None:
+            start = match.end()
+            crc, size = int(match.group(1), 16), int(match.group(2))
+            if len(raw) - start != size:
+                raise ValueError(f"expected {size} bytes after the header, found {len(raw) - start}")
+            if zlib.crc32(memoryview(raw)[start:]) != crc:
+                raise ValueError("checksum mismatch")
+        elif raw.startswith(b"#"):
+            raise ValueError("unreadable header")
+        text = raw.decode("utf-8")
+        del raw
+        with _gc_paused():
+            data, end = json.JSONDecoder(object_hook=self.object_hook).raw_decode(text, start)
+            if text[end:].strip():
+                raise ValueError(f"unexpected data after the snapshot at character {end}")
+            if not isinstance(data, dict):
+                raise ValueError("not a JSON object")
+            if self.unpack is not None:
+                try:
+                    data = self.unpack(data)
+                except (KeyError, TypeError) as e:
+                    raise ValueError(f"malformed snapshot: {e!r}") from None
+        if self.validate is not None:
+            self.validate(data)
+        return data
+
+    def _read_journal(self, path, repair=True):
+        """Yields journal records, truncating a torn trailing line left by a crash.
+
+        Backup journals are only read, never repaired.
+        """
+        try:
+            f = open(path, "rb+" if repair else "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            offset = 0
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete record")
+                    record = json.loads(line, object_hook=self.object_hook)
+                except ValueError:
+                    # Anything after a bad record was appended after a crash we can't trust.
+                    logger.warning("Truncating corrupt journal tail in %s at byte %d", path, offset)
+                    if repair:
+                        f.truncate(offset)
+                    return
+                offset += len(line)
+                yield record
+
+    # --- Mutations ---
+    def apply(self, op, path, value=None):
+        """Applies a mutation to the in-memory state and buffers it for the journal."""
+        path = list(path)
+        if self._unshared is not None:
+            self._unshare(op, path)
+        apply_op(self.data, op, path, value)
+        self.seq += 1
+        record = {"seq": self.seq, "op": op, "path": path}
+        if value is not None:
+            record["value"] = value
+        self._buffer.append(self._dumps(record) + "\n")
+        self.pending_records += 1
+
+    def _unshare(self, op, path):
+        """Swaps the record `path` changes in place for a copy the running compaction doesn't see."""
+        if len(path) < 3:
+            if op == "set" and len(path) == 2:
+                self._unshared.add(tuple(path))  # A new record, made after the snapshot
+            return
+        record = tuple(path[:2])
+        if record in self._unshared:
+            return
+        section = self.data[path[0]]
+        if path[1] in section:
+            section[path[1]] = copy.deepcopy(section[path[1]])
+        self._unshared.add(record)
+
+    def buffered(self):
+        """Number of records applied in memory but not yet taken for writing."""
+        return len(self._buffer)
+
+    def take_pending(self):
+        """Hands over the buffered records. Must run on the thread that mutates state."""
+        lines, self._buffer = self._buffer, []
+        return lines
+
+    def restore_pending(self, lines):
+        """Puts back records whose write failed so the next flush retries them."""
+        self._buffer[:0] = lines
+
+    def write_pending(self, lines, sync=False):
+        """Writes taken records to the journal file. Safe to call from a worker thread.
+
+        With `sync`, or `fsync` set, they and every record written before are fsynced too.
+        """
+        payload = "".join(lines).encode("utf-8")
+        self._file.write(payload)
+        self._file.flush()
+        if self.fsync or sync:
+            os.fsync(self._file.fileno())
+            self.unsynced = False
+        elif payload:
+            self.unsynced = True
+        return len(payload)
+
+    def flush(self, sync=False):
+        """Synchronously writes every buffered record."""
+        self.write_pending(self.take_pending(), sync)
+
+    def _dumps(self, obj):
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=self.default)
+
+    def needs_compaction(self):
+        return self.pending_records >= self.compact_every
+
+    # --- Compaction ---
+    def begin_compaction(self):
+        """Rotates the journal and takes a copy-on-write snapshot of the current state.
+
+        Must run on the thread that mutates state, with no `write_pending` in flight. Returns
+        the snapshot, which `finish_compaction` can then serialize and write from any thread;
+        call `end_compaction` on this thread once it's done.
+        """
+        self.flush(sync=True)  # The rotated journal is closed, so fsync it while we can
+        self._file.close()
+        if os.path.exists(self.rotated_path):
+            # A previous compaction failed before writing its snapshot; keep those records.
+            with open(self.rotated_path, "ab") as dst, open(self.journal_path, "rb") as src:
+                dst.write(src.read())
+            os.remove(self.journal_path)
+        elif os.path.exists(self.journal_path):
+            os.replace(self.journal_path, self.rotated_path)
+        self._file = open(self.journal_path, "ab")
+
+        snapshot = {key: copy.copy(section) for key, section in self.data.items()}
+        snapshot[SEQ_KEY] = self.seq
+        self.pending_records = 0
+        self._unshared = set()
+        return snapshot
+
+    def end_compaction(self):
+        """Stops copying records on write once the snapshot is serialized."""
+        self._unshared = None
+
+    def finish_compaction(self, snapshot):
+        """Serializes `snapshot` and atomically replaces the snapshot file with it.
+
+        The old snapshot and the rotated journal are kept as backup 1.
+
+        Every step leaves files `load` can start from: until the new snapshot is in place,
+        the old one is either still there or is backup 1, and the rotated journal is replayed
+        from wherever it is at the time.
+        """
+        if self.pack is not None:
+            snapshot = self.pack(snapshot)
+        body = self._dumps(snapshot).encode("utf-8")
+        payload = SNAPSHOT_HEADER % (zlib.crc32(body), len(body)) + body
+        del body
+        tmp_path = f"{self.snapshot_path}.tmp"
+        _write_synced(tmp_path, payload)
+        if self.backups:
+            oldest_snapshot, oldest_journal = self.backup_paths(self.backups)
+            _remove_if_exists(oldest_snapshot)
+            _remove_if_exists(oldest_journal)
+            for n in range(self.backups - 1, 0, -1):
+                for src, dst in zip(self.backup_paths(n), self.backup_paths(n + 1)):
+                    _replace_if_exists(src, dst)
+            newest_snapshot, newest_journal = self.backup_paths(1)
+            _replace_if_exists(self.snapshot_path, newest_snapshot)
+            os.replace(tmp_path, self.snapshot_path)
+            _replace_if_exists(self.rotated_path, newest_journal)
+        else:
+            os.replace(tmp_path, self.snapshot_path)
+            _remove_if_exists(self.rotated_path)
+        _fsync_dir(os.path.dirname(os.path.abspath(self.snapshot_path)))
+
+    def compact(self):
+        """Synchronously folds the journal into the snapshot."""
+        try:
+            self.finish_compaction(self.begin_compaction())
+        finally:
+            self.end_compaction()
+
+    def close(self):
+        if self._file is not None:
+            self.flush(sync=True)
+            self._file.close()
+            self._file = None
+
+
+# --- BACKGROUND WRITER ---
+class PersistenceService:
+    """Single background writer that coalesces journal records into batched flushes.
+
+    Handlers mutate state through `Journal.apply` and then call `mark_dirty`, which returns a
+    future resolved once those records are on disk. Records are flushed every
+    `flush_interval` seconds, as soon as `flush_every` records are buffered, or immediately
+    after an urgent mark; a flush with urgent waiters is also fsynced. File I/O, and the
+    serialization of a compaction, run in the default executor, so the event loop never
+    blocks on disk; flushes carry on while a compaction is written. `on_flush(seconds,
+    records, bytes)` is called after every flush.
+    """
+
+    def __init__(self, journal, flush_interval=0.5, flush_every=500, on_flush=None):
+        self.journal = journal
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self.on_flush = on_flush
+        self.flushes = 0
+        self.records_written = 0
+        self.bytes_written = 0
+        self.last_flush_seconds = 0.0
+        self._waiters = []
+        self._callbacks = []
+        self._sync = False  # Some waiter needs the next flush fsynced
+        self._flushing = False
+        self._stopping = False
+        self._wake = None
+        self._task = None
+        self._compaction = None
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the writer once its current flush and compaction are done, then runs a final one of each."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        await self._task
+        self._task = None
+        await self._flush()
+        await self._compact()
+
+    def mark_dirty(self, urgent=False):
+        """Returns a future resolved when every mutation applied so far is durable.
+
+        Money-moving handlers pass `urgent=True` and await the future before replying;
+        everything else can ignore it and let the interval flush pick the records up.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if not self.journal.buffered() and not self._flushing and not (urgent and self.journal.unsynced):
+            future.set_result(None)
+            return future
+        self._waiters.append(future)
+        self._sync = self._sync or urgent
+        if self._wake is not None and (urgent or self.journal.buffered() >= self.flush_every):
+            self._wake.set()
+        return future
+
+    def after_flush(self, callback):
+        """Calls `callback()` on the event loop once every mutation applied so far is written.
+
+        For side effects kept outside the journal that must never get ahead of it.
+        """
+        if not self.journal.buffered() and not self._flushing:
+            _call_all([callback])
+            return
+        self._callbacks.append(callback)
+
+    async def flush(self):
+        """Forces an immediate flush and waits for it."""
+        await self.mark_dirty(urgent=True)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self._flush()
+            if self.journal.needs_compaction() and (self._compaction is None or self._compaction.done()):
+                self._compaction = asyncio.create_task(self._compact())
+        if self._compaction is not None:
+            await self._compaction
+
+    async def _flush(self):
+        lines = self.journal.take_pending()
+        waiters, self._waiters = self._waiters, []
+        callbacks, self._callbacks = self._callbacks, []
+        sync, self._sync = self._sync, False
+        if not lines and not (sync and self.journal.unsynced):
+            _call_all(callbacks)
+            _resolve_all(waiters)
+            return
+
+        started = time.perf_counter()
+        self._flushing = True
+        try:
+            written = await asyncio.get_running_loop().run_in_executor(
+                None, self.journal.write_pending, lines, sync)
+        except OSError as e:
+            logger.exception("Journal flush failed; will retry %d records", len(lines))
+            self.journal.restore_pending(lines)
+            self._callbacks[:0] = callbacks
+            _resolve_all(waiters, e)
+            return
+        finally:
+            self._flushing = False
+
+        self.flushes += 1
+        self.records_written += len(lines)
+        self.bytes_written += written
+        self.last_flush_seconds = time.perf_counter() - started
+        if self.on_flush is not None:
+            self.on_flush(self.last_flush_seconds, len(lines), written)
+        _call_all(callbacks)
+        _resolve_all(waiters)
+
+    async def _compact(self):
+        snapshot = self.journal.begin_compaction()
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.journal.finish_compaction, snapshot)
+        except OSError:
+            logger.exception("Journal compaction failed; records stay in the rotated journal")
+        else:
+            logger.info("Compacted journal into %s", self.journal.snapshot_path)
+        finally:
+            self.journal.end_compaction()
+
+def _call_all(callbacks):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception:
+            logger.exception("After-flush callback %r failed", callback)
+
+def _resolve_all(futures, error=None):
+    for future in futures:
+        if future.done():
+            continue
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
@@ -0,0 +1,39 @@
+# render_cache.py
+
+from collections import defaultdict
+
+
+class RenderCache:
+    """Memoizes rendered screens (text + reply markup) until the data they show changes.
+
+    Each entry names the data sections it depends on, e.g. "links" or "config". Markups are
+    immutable telegram objects, so one instance can be shared by every request.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._dependents = defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build, depends_on=()):
+        """Returns the cached value for `key`, calling `build()` on a miss."""
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            value = self._entries[key] = build()
+            for section in depends_on:
+                self._dependents[section].add(key)
+            return value
+        self.hits += 1
+        return value
+
+    def invalidate(self, section):
+        """Drops every entry that depends on `section`."""
+        for key in self._dependents.pop(section, ()):
+            self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._dependents.clear()
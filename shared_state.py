@@ -0,0 +1,961 @@
+# shared_state.py
+
+import asyncio
+import collections
+import contextvars
+import json
+import logging
+import sqlite3
+import struct
+import sys
+import uuid
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta
+
+import redis
+from redis.exceptions import WatchError
+from telegram.ext import CallbackContext, ContextTypes, ConversationHandler
+
+from money import paise_from_float
+from pagination import USER_ORDERS, WITHDRAWAL_ORDERS, make_page
+from storage import (Repository, code_metadata, empty_data, json_journal, ledger_summary, unlogged_rows,
+                     upgrade_to_paise, _code_row, _done_future)
+
+logger = logging.getLogger(__name__)
+
+
+_memory_servers = {}
+
+def connect(url):
+    """Opens a Redis client.
+
+    "memory://" gives a new in-process fakeredis server instead, and "memory://<name>" the
+    one every client of this process opened with that name shares.
+    """
+    if url.startswith("memory://"):
+        import fakeredis
+        name = url[len("memory://"):]
+        if not name:
+            return fakeredis.FakeRedis(decode_responses=True)
+        server = _memory_servers.setdefault(name, fakeredis.FakeServer())
+        return fakeredis.FakeRedis(server=server, decode_responses=True)
+    return redis.Redis.from_url(url, decode_responses=True)
+
+
+# --- INDEX MEMBERS ---
+# Sorted listings are kept in lexicographic sorted sets whose members are "<key>\0<id>", so
+# Redis orders them by (key, id) exactly like pagination.SortedIndex. Numeric keys are
+# written as the hex of their IEEE bits, flipped so that byte order equals numeric order.
+_SIGN = 1 << 63
+_MASK = (1 << 64) - 1
+
+def _encode_sort_key(order, key):
+    if not order.numeric:
+        return key
+    bits = struct.unpack(">Q", struct.pack(">d", key + 0.0))[0]  # + 0.0 folds -0.0 into 0.0
+    return f"{(bits ^ _MASK) if bits & _SIGN else (bits | _SIGN):016x}"
+
+def _decode_sort_key(order, text):
+    if not order.numeric:
+        return text
+    bits = int(text, 16)
+    bits = (bits & ~_SIGN) if bits & _SIGN else (bits ^ _MASK)
+    return struct.unpack(">d", struct.pack(">Q", bits))[0]
+
+def _member(order, key, item_id):
+    return f"{_encode_sort_key(order, key)}\0{item_id}"
+
+def _split_member(order, member):
+    key, _, item_id = member.rpartition("\0")
+    return _decode_sort_key(order, key), item_id
+
+def _stream_id(entry_id):
+    """Stream ids ("<ms>-<seq>") as comparable tuples."""
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq)
+
+
+# --- LOCKS ---
+class RedisLock:
+    """Async lock held in Redis, shared by every worker.
+
+    Acquired with SET NX and a TTL, so a crashed worker can't hold it for longer than `ttl`.
+    Released only by the owner, checked under WATCH since no Lua is needed that way. Each
+    round trip runs in a worker thread, and the event loop sleeps between attempts.
+    """
+
+    def __init__(self, client, key, ttl=10.0, poll=0.005):
+        self.client = client
+        self.key = key
+        self.ttl = ttl
+        self.poll = poll
+        self._token = None
+
+    def _try_acquire(self, token):
+        return self.client.set(self.key, token, nx=True, px=int(self.ttl * 1000))
+
+    def _release(self, token):
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                if pipe.get(self.key) == token:
+                    pipe.multi()
+                    pipe.delete(self.key)
+                    pipe.execute()
+            except WatchError:
+                pass  # Expired and taken by someone else meanwhile
+
+    async def __aenter__(self):
+        token = uuid.uuid4().hex
+        delay = self.poll
+        while not await asyncio.to_thread(self._try_acquire, token):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        self._token = token
+        return self
+
+    async def __aexit__(self, *exc_info):
+        token, self._token = self._token, None
+        await asyncio.to_thread(self._release, token)
+
+
+# --- SHARED HANDLER STATE ---
+class _Prefetched:
+    """The hashes read for the update being handled, and the writes it made to them since.
+
+    `hashes` maps a key to (fields, complete): the raw values fetched, None where a field
+    is missing, and whether that is the whole hash or just the fields asked for.
+    """
+
+    def __init__(self):
+        self.hashes = {}
+        self.writes = []  # (key, field, raw); a None field deletes the hash, a None raw the field
+
+# Set by RedisRepository.prefetch() in the task handling an update
+_PREFETCHED = contextvars.ContextVar("shared_state_prefetched", default=None)
+
+
+class RedisDict(MutableMapping):
+    """A dict kept in one Redis hash, with JSON-encoded values.
+
+    Inside an update that `RedisRepository.prefetch()` loaded this hash for, reads are
+    answered from what it fetched and writes wait for `RedisRepository.flush()`, so a
+    handler never blocks the event loop on Redis. Anywhere else each access is a round trip.
+    """
+
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+
+    def _field(self, key):
+        return key
+
+    def _key(self, field):
+        return field
+
+    def _prefetched(self):
+        prefetched = _PREFETCHED.get()
+        if prefetched is None or self.key not in prefetched.hashes:
+            return None, None
+        return prefetched, prefetched.hashes[self.key]
+
+    def _raw(self, field):
+        _, known = self._prefetched()
+        if known is not None and (known[1] or field in known[0]):
+            return known[0].get(field)
+        return self.client.hget(self.key, field)
+
+    def _write(self, field, raw):
+        prefetched, known = self._prefetched()
+        if known is None:
+            if raw is None:
+                self.client.hdel(self.key, field)
+            else:
+                self.client.hset(self.key, field, raw)
+            return
+        known[0][field] = raw
+        prefetched.writes.append((self.key, field, raw))
+
+    def __getitem__(self, key):
+        raw = self._raw(self._field(key))
+        if raw is None:
+            raise KeyError(key)
+        return json.loads(raw)
+
+    def __setitem__(self, key, value):
+        self._write(self._field(key), json.dumps(value))
+
+    def __delitem__(self, key):
+        field = self._field(key)
+        _, known = self._prefetched()
+        if known is None:
+            if not self.client.hdel(self.key, field):
+                raise KeyError(key)
+        elif self._raw(field) is None:
+            raise KeyError(key)
+        else:
+            self._write(field, None)
+
+    def __contains__(self, key):
+        return self._raw(self._field(key)) is not None
+
+    def _fields(self):
+        _, known = self._prefetched()
+        if known is not None and known[1]:
+            return [field for field, raw in known[0].items() if raw is not None]
+        return self.client.hkeys(self.key)
+
+    def __iter__(self):
+        return (self._key(field) for field in self._fields())
+
+    def __len__(self):
+        _, known = self._prefetched()
+        if known is not None and known[1]:
+            return len(self._fields())
+        return self.client.hlen(self.key)
+
+    def clear(self):
+        prefetched, known = self._prefetched()
+        if known is None:
+            self.client.delete(self.key)
+            return
+        prefetched.hashes[self.key] = ({}, True)
+        prefetched.writes.append((self.key, None, None))
+
+
+class ConversationStates(RedisDict):
+    """ConversationHandler state per (chat_id, user_id) key, shared by every worker.
+
+    Only plain states are shared. The PendingState of a non-blocking handler wraps a task
+    of this process, so it stays in a local dict until it resolves.
+    """
+
+    def __init__(self, client, key):
+        super().__init__(client, key)
+        self._local = {}
+
+    def _field(self, key):
+        return ":".join(map(str, key))
+
+    def _key(self, field):
+        return tuple(int(part) for part in field.split(":"))
+
+    def __getitem__(self, key):
+        if key in self._local:
+            return self._local[key]
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        if isinstance(value, (int, str)):
+            self._local.pop(key, None)
+            super().__setitem__(key, value)
+        else:
+            self._local[key] = value
+
+    def __delitem__(self, key):
+        if self._local.pop(key, None) is None:
+            super().__delitem__(key)
+        else:
+            self._write(self._field(key), None)
+
+    def __contains__(self, key):
+        return key in self._local or super().__contains__(key)
+
+
+class SharedConversationHandler(ConversationHandler):
+    """ConversationHandler reading and writing its states through `conversations` on every update.
+
+    PTB persistence only loads conversations at startup and saves them periodically, so a
+    step landing on another worker would see a stale state; this swaps the handler's
+    in-memory dict for a shared mapping instead. Register `RedisRepository.prefetch()` and
+    `flush()` around the handler groups so that mapping is read and written off the loop.
+    """
+
+    def __init__(self, conversations, **kwargs):
+        super().__init__(**kwargs)
+        self._conversations = conversations
+
+
+def shared_context_types(repo):
+    """ContextTypes whose `context.user_data` lives in the shared store."""
+
+    class SharedCallbackContext(CallbackContext):
+        @property
+        def user_data(self):
+            if self._user_id is None:
+                return None
+            return repo.user_data_store(self._user_id)
+
+    return ContextTypes(context=SharedCallbackContext)
+
+
+# --- REDIS BACKEND ---
+class RedisRepository(Repository):
+    """Storage shared by several worker processes through Redis.
+
+    Every method is atomic on its own (WATCH/MULTI where it reads before writing). Redis has
+    no rollback, so `transaction()` groups nothing; instead the ledger holds a `lock()` per
+    user across workers, which keeps each check and its writes together. Config and links
+    are cached per worker and invalidated over pub/sub when any worker changes them, which
+    also fires the repository listeners, so rendered menus refresh everywhere.
+
+    Methods block on the network, so the ledger calls them from a worker thread (the client
+    is thread-safe), and handlers reach their conversation states and user_data through
+    `prefetch()` and `flush()`.
+
+    Money is stored as integer paise in "paise" fields; a hash still holding "balance",
+    "value" or "amount" is float rupees from before the ledger, converted at startup. The
+    transaction log is the stream "tx", appended in the same MULTI as the balance it changes.
+    """
+
+    shared = True
+
+    def __init__(self, client, default_config, prefix="bot:"):
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+        self._cache = {}
+        self._pubsub = None
+        self._pubsub_thread = None
+        self._channel = prefix + "invalidate"
+        self._conversations = []
+        for key, value in default_config.items():
+            client.hsetnx(self._k("config"), key, json.dumps(value))
+        if client.get(self._k("schema")) != "paise":
+            self._upgrade_to_paise()
+
+    def _k(self, *parts):
+        return self.prefix + ":".join(parts)
+
+    def _index(self, kind, code):
+        return self._k("idx", kind, code)
+
+    def _page(self, kind, order, cursor, backwards, limit, load):
+        index = self._index(kind, order.code)
+        after = "(" + _member(order, *cursor) if cursor is not None else None
+        if backwards:
+            members = self.client.zrange(index, after or "+", "-", desc=True, bylex=True, offset=0, num=limit + 1)
+            more = len(members) > limit
+            members = members[:limit][::-1]
+        else:
+            members = self.client.zrange(index, after or "-", "+", bylex=True, offset=0, num=limit + 1)
+            more = len(members) > limit
+            members = members[:limit]
+        pairs = [_split_member(order, member) for member in members]
+
+        # Probe the side we didn't fetch
+        if backwards:
+            edge = members[-1] if members else (after and after[1:])
+            beyond = bool(edge) and bool(self.client.zrange(index, "(" + edge, "+", bylex=True, offset=0, num=1))
+        else:
+            edge = members[0] if members else (after and after[1:])
+            beyond = bool(edge) and bool(
+                self.client.zrange(index, "(" + edge, "-", desc=True, bylex=True, offset=0, num=1))
+        items = load([item_id for _, item_id in pairs])
+        kept = [(pair, item) for pair, item in zip(pairs, items) if item is not None]
+        pairs, items = [pair for pair, _ in kept], [item for _, item in kept]
+        if backwards:
+            return make_page(pairs, items, more, beyond)
+        return make_page(pairs, items, beyond, more)
+
+    def _reindex(self, pipe, kind, orders, item_id, old, new):
+        for code, order in orders.items():
+            old_member = _member(order, order.key(old), item_id) if old is not None else None
+            new_member = _member(order, order.key(new), item_id) if new is not None else None
+            if old_member == new_member:
+                continue
+            if old_member is not None:
+                pipe.zrem(self._index(kind, code), old_member)
+            if new_member is not None:
+                pipe.zadd(self._index(kind, code), {new_member: 0})
+
+    def _upgrade_to_paise(self):
+        """Converts float rupees written before the ledger into paise and opens the log.
+
+        Each user, code and withdrawal is converted in its own WATCH/MULTI and only while it
+        still has its old field, so workers starting together can all run this safely.
+        """
+        stream = self._k("tx")
+        for member, _ in self.client.zscan_iter(self._index("u", "j")):
+            user_id = _split_member(USER_ORDERS["j"], member)[1]
+            key = self._k("u", user_id)
+
+            def convert_user(pipe):
+                raw = pipe.hgetall(key)
+                if not raw or "paise" in raw:
+                    return
+                old = {"balance": float(raw["balance"]), "joined_at": raw.get("joined_at", "")}
+                new = dict(old, balance=paise_from_float(old["balance"]))
+                pipe.multi()
+                pipe.hset(key, "paise", new["balance"])
+                pipe.hdel(key, "balance")
+                self._reindex(pipe, "u", USER_ORDERS, user_id, old, new)
+                if new["balance"]:
+                    pipe.xadd(stream, self._entry(user_id, new["balance"], new["balance"], "opening"))
+
+            self.client.transaction(convert_user, key)
+
+        for key in self.client.scan_iter(match=self._k("c", "*")):
+            def convert_code(pipe):
+                raw = pipe.hgetall(key)
+                if not raw or "paise" in raw:
+                    return
+                pipe.multi()
+                pipe.hset(key, "paise", paise_from_float(raw["value"]))
+                pipe.hdel(key, "value")
+
+            self.client.transaction(convert_code, key)
+
+        for member, _ in self.client.zscan_iter(self._index("w", "t")):
+            withdrawal_id = _split_member(WITHDRAWAL_ORDERS["t"], member)[1]
+            key = self._k("w", withdrawal_id)
+
+            def convert_withdrawal(pipe):
+                raw = pipe.hgetall(key)
+                if not raw or "paise" in raw:
+                    return
+                old = dict(raw, amount=float(raw["amount"]))
+                new = dict(raw, amount=paise_from_float(old["amount"]))
+                pipe.multi()
+                pipe.hset(key, "paise", new["amount"])
+                pipe.hdel(key, "amount")
+                self._reindex(pipe, "w", WITHDRAWAL_ORDERS, withdrawal_id, old, new)
+
+            self.client.transaction(convert_withdrawal, key)
+        self.client.set(self._k("schema"), "paise")
+        logger.info("Converted Redis balances to paise under %s", self.prefix)
+
+    # --- Users ---
+    @staticmethod
+    def _user(user_id, raw):
+        if not raw:
+            return None
+        balance = int(raw["paise"]) if "paise" in raw else paise_from_float(raw["balance"])
+        return {"user_id": str(user_id), "balance": balance, "joined_at": raw.get("joined_at", "")}
+
+    def _load_users(self, user_ids):
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hgetall(self._k("u", user_id))
+        return [self._user(user_id, raw) for user_id, raw in zip(user_ids, pipe.execute())]
+
+    def get_user(self, user_id):
+        return self._user(user_id, self.client.hgetall(self._k("u", str(user_id))))
+
+    def ensure_user(self, user_id):
+        user_id_str = str(user_id)
+        key = self._k("u", user_id_str)
+        if self.client.exists(key):
+            return False
+
+        def create(pipe):
+            if pipe.exists(key):
+                return False
+            user = {"balance": 0, "joined_at": datetime.now().isoformat()}
+            pipe.multi()
+            pipe.hset(key, mapping={"paise": user["balance"], "joined_at": user["joined_at"]})
+            self._reindex(pipe, "u", USER_ORDERS, user_id_str, None, user)
+            return True
+
+        return self.client.transaction(create, key, value_from_callable=True)
+
+    def count_users(self):
+        return self.client.zcard(self._index("u", "j"))
+
+    def list_user_ids(self, offset, limit):
+        order = USER_ORDERS["j"]  # Join order, so new users land after a broadcast's cursor
+        members = self.client.zrange(self._index("u", "j"), offset, offset + limit - 1)
+        return [_split_member(order, member)[1] for member in members]
+
+    def page_users(self, order, cursor=None, backwards=False, limit=10):
+        return self._page("u", order, cursor, backwards, limit, self._load_users)
+
+    def _set_balance(self, user_id, balance, delta, kind, ref=None):
+        """Stores the balance and appends its log entry in one MULTI."""
+        key = self._k("u", user_id)
+
+        def write(pipe):
+            old = self._user(user_id, pipe.hgetall(key))
+            new = dict(old, balance=old["balance"] + delta if balance is None else balance)
+            pipe.multi()
+            pipe.hset(key, "paise", new["balance"])
+            pipe.xadd(self._k("tx"), self._entry(user_id, delta, new["balance"], kind, ref))
+            self._reindex(pipe, "u", USER_ORDERS, user_id, old, new)
+            return new["balance"]
+
+        return self.client.transaction(write, key, value_from_callable=True)
+
+    def adjust_balance(self, user_id, delta, kind="adjust", ref=None):
+        user_id_str = str(user_id)
+        self.ensure_user(user_id_str)
+        return self._set_balance(user_id_str, None, delta, kind, ref)
+
+    def delete_user(self, user_id):
+        user_id_str = str(user_id)
+        key = self._k("u", user_id_str)
+
+        def delete(pipe):
+            old = self._user(user_id_str, pipe.hgetall(key))
+            if old is None:
+                return
+            pipe.multi()
+            pipe.delete(key, self._k("ud", user_id_str), self._k("rc", user_id_str), self._k("wh", user_id_str))
+            self._reindex(pipe, "u", USER_ORDERS, user_id_str, old, None)
+
+        self.client.transaction(delete, key)
+
+    def get_history(self, user_id):
+        user_id_str = str(user_id)
+        return {"redeemed_codes": self.client.lrange(self._k("rc", user_id_str), 0, -1),
+                "withdrawal_history": [json.loads(raw) for raw in self.client.lrange(self._k("wh", user_id_str), 0, -1)]}
+
+    # --- Ledger ---
+    @staticmethod
+    def _entry(user_id, amount, balance, kind, ref=None):
+        return {"user_id": user_id, "amount": amount, "balance": balance, "kind": kind, "ref": ref or "",
+                "created_at": datetime.now().isoformat()}
+
+    def transactions_after(self, after=None, limit=1000):
+        entries = self.client.xrange(self._k("tx"), f"({after}" if after else "-", "+", count=limit)
+        return [{"id": entry_id, "user_id": fields["user_id"], "amount": int(fields["amount"]),
+                 "balance": int(fields["balance"]), "kind": fields["kind"], "ref": fields["ref"] or None,
+                 "created_at": fields["created_at"]} for entry_id, fields in entries]
+
+    def _fold(self, totals, after, until=None, user_id=None):
+        """Adds the amounts logged after entry `after` (up to `until`) to `totals`. Returns the last id."""
+        while True:
+            entries = self.transactions_after(after, 5000)
+            if until is not None:
+                entries = [e for e in entries if _stream_id(e["id"]) <= _stream_id(until)]
+            if not entries:
+                return after
+            for entry in entries:
+                if user_id is None or entry["user_id"] == user_id:
+                    totals[entry["user_id"]] += entry["amount"]
+            after = entries[-1]["id"]
+
+    def ledger_summary(self, days=7):
+        # Streams can't be aggregated server-side, so this folds over the log in batches
+        since = (datetime.now() - timedelta(days=days - 1)).date().isoformat()
+        kinds, per_day = {}, {}
+        after = None
+        while True:
+            entries = self.transactions_after(after, 5000)
+            if not entries:
+                break
+            for entry in entries:
+                amount = entry["amount"]
+                count, net = kinds.get(entry["kind"], (0, 0))
+                kinds[entry["kind"]] = (count + 1, net + amount)
+                if entry["created_at"] >= since:
+                    day = entry["created_at"][:10]
+                    count, credits, debits = per_day.get(day, (0, 0, 0))
+                    per_day[day] = (count + 1, credits + max(amount, 0), debits + max(-amount, 0))
+            after = entries[-1]["id"]
+        return ledger_summary(kinds, [(day,) + per_day[day] for day in sorted(per_day)])
+
+    def reconcile_pages(self, limit=500):
+        """See Repository.reconcile_pages.
+
+        The log's totals are folded first, keeping one int per user. Each page of users is
+        then read in one MULTI with the stream's last id, and the entries up to that id are
+        folded in before comparing, so writes from other workers meanwhile can't show up
+        as mismatches.
+        """
+        totals = collections.defaultdict(int)
+        position = self._fold(totals, None)
+        yield 0, []
+        seen = set()
+        offset = 0
+        while True:
+            members = self.client.zrange(self._index("u", "j"), offset, offset + limit - 1)
+            if not members:
+                break
+            offset += len(members)
+            user_ids = [_split_member(USER_ORDERS["j"], member)[1] for member in members]
+            pipe = self.client.pipeline()
+            for user_id in user_ids:
+                pipe.hgetall(self._k("u", user_id))
+            pipe.xrevrange(self._k("tx"), "+", "-", count=1)
+            *raws, last = pipe.execute()
+            if last:
+                position = self._fold(totals, position, until=last[0][0])
+            mismatches = []
+            for user_id, raw in zip(user_ids, raws):
+                user = self._user(user_id, raw)
+                if user is None:
+                    continue
+                seen.add(user_id)
+                if user["balance"] != totals.get(user_id, 0):
+                    mismatches.append((user_id, user["balance"], totals.get(user_id, 0)))
+            yield len(user_ids), mismatches
+        yield 0, [(user_id, 0, total) for user_id, total in totals.items()
+                  if total and user_id not in seen and self.get_user(user_id) is None]
+
+    def rebuild_balance(self, user_id):
+        user_id_str = str(user_id)
+        self.ensure_user(user_id_str)
+        totals = collections.defaultdict(int)
+        self._fold(totals, None, user_id=user_id_str)
+        return self._set_balance(user_id_str, totals[user_id_str], 0, "reconcile")
+
+    # --- Codes ---
+    @staticmethod
+    def _code(raw):
+        if not raw:
+            return None
+        max_uses = raw.get("max_uses")
+        value = int(raw["paise"]) if "paise" in raw else paise_from_float(raw["value"])
+        return code_metadata(value, int(raw.get("uses", 0)),
+                             int(max_uses) if max_uses is not None else None, raw.get("expires_at"))
+
+    def get_code(self, code):
+        return self._code(self.client.hgetall(self._k("c", code)))
+
+    def add_code(self, code, value, max_uses=None, expires_at=None):
+        code_info = {"paise": value, "uses": 0}
+        if max_uses is not None:
+            code_info["max_uses"] = max_uses
+        if expires_at is not None:
+            code_info["expires_at"] = expires_at
+        pipe = self.client.pipeline()
+        pipe.delete(self._k("c", code), self._k("r", code))
+        pipe.hset(self._k("c", code), mapping=code_info)
+        pipe.execute()
+
+    def has_redeemed(self, code, user_id):
+        return bool(self.client.sismember(self._k("r", code), str(user_id)))
+
+    def record_redemption(self, code, user_id):
+        key = self._k("r", code)
+
+        def record(pipe):
+            if pipe.sismember(key, str(user_id)):
+                return
+            pipe.multi()
+            pipe.sadd(key, str(user_id))
+            pipe.hincrby(self._k("c", code), "uses", 1)
+            pipe.rpush(self._k("rc", str(user_id)), code)
+
+        self.client.transaction(record, key)
+
+    # --- Links & config ---
+    def _cached(self, section, load):
+        try:
+            return self._cache[section]
+        except KeyError:
+            value = self._cache[section] = load()
+            return value
+
+    def _invalidate(self, section):
+        self._cache.pop(section, None)
+        self._changed(section)
+
+    def _publish(self, section):
+        self._invalidate(section)
+        self.client.publish(self._channel, section)
+
+    def get_links(self):
+        links = self._cached("links", lambda: [json.loads(raw) for raw in self.client.lrange(self._k("links"), 0, -1)])
+        return [dict(link) for link in links]
+
+    def add_link(self, title, url):
+        self.client.rpush(self._k("links"), json.dumps({"title": title, "url": url}))
+        self._publish("links")
+
+    def get_config(self, key):
+        config = self._cached("config", lambda: {
+            name: json.loads(raw) for name, raw in self.client.hgetall(self._k("config")).items()})
+        return config.get(key)
+
+    def set_config(self, key, value):
+        self.client.hset(self._k("config"), key, json.dumps(value))
+        self._publish("config")
+
+    # --- Withdrawals ---
+    @staticmethod
+    def _withdrawal(raw):
+        if not raw:
+            return None
+        request = dict(raw)
+        paise = request.pop("paise", None)
+        request["amount"] = int(paise) if paise is not None else paise_from_float(request["amount"])
+        return request
+
+    def _load_withdrawals(self, withdrawal_ids):
+        pipe = self.client.pipeline(transaction=False)
+        for withdrawal_id in withdrawal_ids:
+            pipe.hgetall(self._k("w", withdrawal_id))
+        return [self._withdrawal(raw) for raw in pipe.execute()]
+
+    def create_withdrawal(self, request):
+        pipe = self.client.pipeline()
+        fields = {key: value for key, value in request.items() if key != "amount"}
+        pipe.hset(self._k("w", request["id"]), mapping=dict(fields, paise=request["amount"]))
+        pipe.sadd(self._k("uw", request["user_id"]), request["id"])
+        self._reindex(pipe, "w", WITHDRAWAL_ORDERS, request["id"], None, request)
+        pipe.execute()
+
+    def get_withdrawal(self, withdrawal_id):
+        return self._withdrawal(self.client.hgetall(self._k("w", withdrawal_id)))
+
+    def get_user_withdrawals(self, user_id):
+        requests = self._load_withdrawals(list(self.client.smembers(self._k("uw", str(user_id)))))
+        return sorted((r for r in requests if r is not None), key=lambda r: r["timestamp"])
+
+    def delete_withdrawal(self, withdrawal_id):
+        key = self._k("w", withdrawal_id)
+
+        def delete(pipe):
+            request = self._withdrawal(pipe.hgetall(key))
+            if request is None:
+                return None
+            pipe.multi()
+            pipe.delete(key)
+            pipe.srem(self._k("uw", request["user_id"]), withdrawal_id)
+            self._reindex(pipe, "w", WITHDRAWAL_ORDERS, withdrawal_id, request, None)
+            return request
+
+        return self.client.transaction(delete, key, value_from_callable=True)
+
+    def count_withdrawals(self):
+        return self.client.zcard(self._index("w", "t"))
+
+    def page_withdrawals(self, order, cursor=None, backwards=False, limit=10):
+        return self._page("w", order, cursor, backwards, limit, self._load_withdrawals)
+
+    # --- Bulk ---
+    # Each batch is one MULTI, WATCHing every key it creates or removes. The existence
+    # checks go through a separate pipeline so they cost one round-trip, not one per key.
+    def _existing(self, keys):
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.exists(key)
+        return {key for key, found in zip(keys, pipe.execute()) if found}
+
+    def add_codes(self, codes):
+        unique = {}
+        for code in codes:
+            unique.setdefault(code[0], code)  # The first row for a code wins, as on the other backends
+        codes = list(unique.values())
+        if not codes:
+            return []
+        keys = [self._k("c", code) for code, _, _, _ in codes]
+
+        def write(pipe):
+            existing = self._existing(keys)
+            pipe.multi()
+            created = []
+            for key, (code, value, max_uses, expires_at) in zip(keys, codes):
+                if key in existing:
+                    continue
+                code_info = {"paise": value, "uses": 0}
+                if max_uses is not None:
+                    code_info["max_uses"] = max_uses
+                if expires_at is not None:
+                    code_info["expires_at"] = expires_at
+                pipe.delete(self._k("r", code))
+                pipe.hset(key, mapping=code_info)
+                created.append(code)
+            return created
+
+        return self.client.transaction(write, *keys, value_from_callable=True)
+
+    def add_users(self, users):
+        unique = {}
+        for user_id, balance, joined_at in users:
+            unique.setdefault(str(user_id), (str(user_id), balance, joined_at))
+        users = list(unique.values())
+        if not users:
+            return []
+        keys = [self._k("u", user_id) for user_id, _, _ in users]
+
+        def write(pipe):
+            existing = self._existing(keys)
+            pipe.multi()
+            created = []
+            for key, (user_id, balance, joined_at) in zip(keys, users):
+                if key in existing:
+                    continue
+                user = {"balance": balance, "joined_at": joined_at or datetime.now().isoformat()}
+                pipe.hset(key, mapping={"paise": balance, "joined_at": user["joined_at"]})
+                if balance:
+                    pipe.xadd(self._k("tx"), self._entry(user_id, balance, balance, "import"))
+                self._reindex(pipe, "u", USER_ORDERS, user_id, None, user)
+                created.append(user_id)
+            return created
+
+        return self.client.transaction(write, *keys, value_from_callable=True)
+
+    def settle_withdrawals(self, withdrawal_ids):
+        withdrawal_ids = list(dict.fromkeys(withdrawal_ids))
+        if not withdrawal_ids:
+            return [], []
+        keys = [self._k("w", withdrawal_id) for withdrawal_id in withdrawal_ids]
+
+        def write(pipe):
+            requests = self._load_withdrawals(withdrawal_ids)
+            pipe.multi()
+            settled, missing = [], []
+            for key, withdrawal_id, request in zip(keys, withdrawal_ids, requests):
+                if request is None:
+                    missing.append(withdrawal_id)
+                    continue
+                pipe.delete(key)
+                pipe.srem(self._k("uw", request["user_id"]), withdrawal_id)
+                pipe.rpush(self._k("wh", request["user_id"]), json.dumps(request))
+                self._reindex(pipe, "w", WITHDRAWAL_ORDERS, withdrawal_id, request, None)
+                settled.append(request)
+            return settled, missing
+
+        return self.client.transaction(write, *keys, value_from_callable=True)
+
+    def _code_pages(self, limit):
+        prefix = self._k("c", "")
+        batch = []
+        for key in self.client.scan_iter(match=prefix + "*", count=limit):
+            batch.append(key[len(prefix):])
+            if len(batch) >= limit:
+                yield self._code_rows(batch)
+                batch = []
+        if batch:
+            yield self._code_rows(batch)
+
+    def _code_rows(self, codes):
+        pipe = self.client.pipeline(transaction=False)
+        for code in codes:
+            pipe.hgetall(self._k("c", code))
+        return [_code_row(code, self._code(raw)) for code, raw in zip(codes, pipe.execute()) if raw]
+
+    # --- Shared handler state ---
+    def lock(self, name):
+        return RedisLock(self.client, self._k("lock", name))
+
+    def conversation_store(self, name):
+        store = ConversationStates(self.client, self._k("conv", name))
+        self._conversations.append(store)
+        return store
+
+    def user_data_store(self, user_id):
+        return RedisDict(self.client, self._k("ud", str(user_id)))
+
+    async def prefetch(self, update):
+        """Reads the update's conversation states and user_data in one round trip, in a thread.
+
+        Handlers for the update, in the same task, then read them without blocking and
+        leave their writes for `flush()`.
+        """
+        chat, user = update.effective_chat, update.effective_user
+        fields = [(store.key, f"{chat.id}:{user.id}") for store in self._conversations] if chat and user else []
+        user_data = self._k("ud", str(user.id)) if user else None
+
+        def read():
+            pipe = self.client.pipeline(transaction=False)
+            for key, field in fields:
+                pipe.hget(key, field)
+            if user_data is not None:
+                pipe.hgetall(user_data)
+            return pipe.execute()
+
+        prefetched = _Prefetched()
+        results = await asyncio.to_thread(read) if fields or user_data else []
+        for (key, field), raw in zip(fields, results):
+            prefetched.hashes[key] = ({field: raw}, False)
+        if user_data is not None:
+            prefetched.hashes[user_data] = (results[-1], True)
+        _PREFETCHED.set(prefetched)
+
+    async def flush(self):
+        """Writes what the update's handlers changed since `prefetch()`, in one MULTI."""
+        prefetched = _PREFETCHED.get()
+        if prefetched is None or not prefetched.writes:
+            return
+        writes, prefetched.writes = prefetched.writes, []
+
+        def write():
+            with self.client.pipeline() as pipe:
+                for key, field, raw in writes:
+                    if field is None:
+                        pipe.delete(key)
+                    elif raw is None:
+                        pipe.hdel(key, field)
+                    else:
+                        pipe.hset(key, field, raw)
+                pipe.execute()
+
+        await asyncio.to_thread(write)
+
+    # --- Durability ---
+    def commit(self, urgent=False):
+        return _done_future()  # Durability is Redis' own (appendonly/save settings)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+
+        def on_message(message):
+            loop.call_soon_threadsafe(self._invalidate, message["data"])
+
+        self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{self._channel: on_message})
+        self._pubsub_thread = self._pubsub.run_in_thread(sleep_time=0.5, daemon=True)
+        self._cache.clear()  # Anything cached before subscribing may have missed an invalidation
+
+    async def close(self):
+        if self._pubsub_thread is not None:
+            self._pubsub_thread.stop()
+            self._pubsub_thread.join(timeout=2)
+            self._pubsub.close()
+        self.client.close()
+
+
+# --- MIGRATION ---
+def migrate_json_to_redis(json_path, url, prefix="bot:", ledger_path=None):
+    """One-shot import of data.json (plus any unflushed journal and transaction log) into Redis.
+
+    Without a transaction log, the stream is opened with the imported balances.
+    """
+    journal = json_journal(json_path)
+    data = journal.load(empty_data)
+    journal.close()
+    upgrade_to_paise(data)
+
+    repo = RedisRepository(connect(url), default_config={}, prefix=prefix)
+    pipe = repo.client.pipeline(transaction=False)
+    for user_id, user in data["users"].items():
+        record = {"balance": user["balance"], "joined_at": user.get("joined_at", "")}
+        pipe.hset(repo._k("u", user_id), mapping={"paise": record["balance"], "joined_at": record["joined_at"]})
+        repo._reindex(pipe, "u", USER_ORDERS, user_id, None, record)
+    if ledger_path is not None:
+        source = sqlite3.connect(f"file:{ledger_path}?mode=ro", uri=True)
+        rows = {row[0]: row for row in source.execute(
+            "SELECT id, user_id, amount, balance, kind, ref, created_at FROM transactions ORDER BY id")}
+        source.close()
+        rows.update((row[0], row) for row in unlogged_rows(data))
+        for _, user_id, amount, balance, kind, ref, created_at in sorted(rows.values()):
+            pipe.xadd(repo._k("tx"), dict(repo._entry(user_id, amount, balance, kind, ref), created_at=created_at))
+    else:
+        for user_id, user in data["users"].items():
+            if user["balance"]:
+                pipe.xadd(repo._k("tx"), repo._entry(user_id, user["balance"], user["balance"], "opening"))
+    for code, info in data["codes"].items():
+        code_info = {"paise": info["value"], "uses": len(info["used_by"])}
+        code_info.update({k: info[k] for k in ("max_uses", "expires_at") if info.get(k) is not None})
+        pipe.hset(repo._k("c", code), mapping=code_info)
+        if len(info["used_by"]):
+            pipe.sadd(repo._k("r", code), *info["used_by"])
+    pipe.delete(repo._k("links"))
+    for link in data["links"]:
+        pipe.rpush(repo._k("links"), json.dumps(link))
+    for key, value in data["config"].items():
+        pipe.hset(repo._k("config"), key, json.dumps(value))
+    pipe.execute()
+    for request in data["pending_withdrawals"].values():
+        repo.create_withdrawal(request)
+    logger.info("Migrated %d users and %d codes from %s to %s",
+                len(data["users"]), len(data["codes"]), json_path, url)
+
+
+if __name__ == "__main__":
+    # Usage: python shared_state.py data.json redis://localhost:6379/0 [ledger.db]
+    logging.basicConfig(level=logging.INFO)
+    migrate_json_to_redis(sys.argv[1], sys.argv[2], ledger_path=sys.argv[3] if len(sys.argv) > 3 else None)
@@ -0,0 +1,1512 @@
+# storage.py
+
+import asyncio
+import base64
+import json
+import logging
+import os
+import sqlite3
+import sys
+import zlib
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from itertools import islice
+
+from money import paise_from_float
+from pagination import USER_ORDERS, WITHDRAWAL_ORDERS, SortedIndex, make_page
+from persistence import Journal
+
+logger = logging.getLogger(__name__)
+
+
+def _done_future():
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(None)
+    return future
+
+
+# --- CODE REDEMPTION INDEX ---
+class RedemptionSet:
+    """Ids of the users who redeemed a code, with O(1) membership checks.
+
+    Kept as a set of ints in memory. On disk it's a base64 string of the sorted ids,
+    delta- and varint-encoded, then zlib-compressed, so a code redeemed by 100k users costs
+    a few hundred KB instead of a multi-MB list of quoted strings.
+    """
+
+    __slots__ = ("_ids",)
+
+    def __init__(self, user_ids=()):
+        self._ids = {int(user_id) for user_id in user_ids}
+
+    def __contains__(self, user_id):
+        return int(user_id) in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return (str(user_id) for user_id in self._ids)
+
+    def __deepcopy__(self, memo):
+        copied = RedemptionSet()
+        copied._ids = set(self._ids)  # Ints, so a shallow copy of the set is enough
+        return copied
+
+    def add(self, user_id):
+        self._ids.add(int(user_id))
+
+    append = add  # Replays journal records written when used_by was a list
+
+    def encode(self):
+        out = bytearray()
+        previous = 0
+        for user_id in sorted(self._ids):
+            delta = user_id - previous
+            previous = user_id
+            while delta >= 0x80:
+                out.append((delta & 0x7F) | 0x80)
+                delta >>= 7
+            out.append(delta)
+        return base64.b64encode(zlib.compress(bytes(out))).decode("ascii")
+
+    @classmethod
+    def decode(cls, packed):
+        result = cls()
+        if not packed:
+            return result
+        raw = zlib.decompress(base64.b64decode(packed))
+        user_id = shift = delta = 0
+        for byte in raw:
+            delta |= (byte & 0x7F) << shift
+            if byte & 0x80:
+                shift += 7
+                continue
+            user_id += delta
+            result._ids.add(user_id)
+            delta = shift = 0
+        return result
+
+    @classmethod
+    def from_stored(cls, stored):
+        """Accepts the packed string or the legacy list of user id strings."""
+        if isinstance(stored, cls):
+            return stored
+        if isinstance(stored, str):
+            return cls.decode(stored)
+        return cls(stored)
+
+# --- USER RECORDS ---
+class UserRecord:
+    """One user of the JSON layout, without a per-user dict and lists.
+
+    At a million users, a dict plus three mostly empty lists per user dominated RSS; this
+    keeps the hot fields in slots. Pending withdrawal ids are held only while there are
+    some. Redeemed codes and withdrawal history live in the HistoryStore on disk, so the
+    record only carries them when they were found inline in an older snapshot or journal,
+    until JsonRepository moves them out at startup.
+
+    Dict-style access keeps working for journal replay and the pagination sort keys.
+    """
+
+    __slots__ = ("balance", "joined_at", "pending_withdrawals", "legacy_history")
+
+    def __init__(self, balance=0.0, joined_at="", pending_withdrawals=None):
+        self.balance = balance
+        self.joined_at = joined_at
+        self.pending_withdrawals = pending_withdrawals or None
+        self.legacy_history = None
+
+    def __getitem__(self, key):
+        if key == "balance":
+            return self.balance
+        if key == "joined_at":
+            return self.joined_at
+        if key == "pending_withdrawals":
+            if self.pending_withdrawals is None:
+                self.pending_withdrawals = []  # The caller is about to append to it
+            return self.pending_withdrawals
+        if key in HistoryStore.KINDS:
+            if self.legacy_history is None:
+                self.legacy_history = {}
+            return self.legacy_history.setdefault(key, [])
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == "balance":
+            self.balance = value
+        elif key == "joined_at":
+            self.joined_at = value
+        elif key == "pending_withdrawals":
+            self.pending_withdrawals = list(value) or None
+        elif key in HistoryStore.KINDS:
+            if self.legacy_history is None:
+                self.legacy_history = {}
+            self.legacy_history[key] = list(value)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in ("balance", "joined_at", "pending_withdrawals") or key in HistoryStore.KINDS
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    setdefault = get  # apply_op's "append" only ever targets existing fields
+
+    def to_dict(self):
+        record = {"balance": self.balance, "joined_at": self.joined_at}
+        if self.pending_withdrawals:
+            record["pending_withdrawals"] = self.pending_withdrawals
+        if self.legacy_history:
+            record.update(self.legacy_history)
+        return record
+
+    @classmethod
+    def from_dict(cls, obj):
+        record = cls(obj.get("balance", 0.0), obj.get("joined_at", ""), obj.get("pending_withdrawals"))
+        history = {kind: obj[kind] for kind in HistoryStore.KINDS if obj.get(kind)}
+        if history:
+            record.legacy_history = history
+        return record
+
+def decode_json_object(obj):
+    """JSON object_hook: turns code entries' `used_by` into RedemptionSets and users into UserRecords."""
+    if "value" in obj and "used_by" in obj:
+        obj["used_by"] = RedemptionSet.from_stored(obj["used_by"])
+    elif "balance" in obj:
+        return UserRecord.from_dict(obj)
+    return obj
+
+def encode_json_object(obj):
+    """JSON default: packs RedemptionSets and UserRecords."""
+    if isinstance(obj, RedemptionSet):
+        return obj.encode()
+    if isinstance(obj, UserRecord):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# Snapshot layout of the users: parallel lists instead of an object per user, which makes
+# data.json about a third of the size and parses twice as fast. Pending withdrawal ids and
+# not yet moved inline history are kept for the few users that have them.
+def pack_snapshot(data):
+    """Journal `pack`: the state with its users as columns."""
+    snapshot = dict(data)
+    users = snapshot.pop("users")
+    extra = {}
+    for user_id, user in users.items():
+        if user.pending_withdrawals or user.legacy_history:
+            fields = {"pending_withdrawals": user.pending_withdrawals} if user.pending_withdrawals else {}
+            fields.update(user.legacy_history or {})
+            extra[user_id] = fields
+    snapshot["user_columns"] = {
+        "ids": list(users),
+        "paise": [user.balance for user in users.values()],
+        "joined": [user.joined_at for user in users.values()],
+        "extra": extra,
+    }
+    return snapshot
+
+def unpack_snapshot(snapshot):
+    """Journal `unpack`: rebuilds the UserRecords of `pack_snapshot`. Older snapshots pass through."""
+    columns = snapshot.pop("user_columns", None)
+    if columns is None:
+        return snapshot
+    ids, balances, joined = columns["ids"], columns["paise"], columns["joined"]
+    if not len(ids) == len(balances) == len(joined):
+        raise ValueError("user columns differ in length")
+    snapshot["users"] = users = dict(zip(ids, map(UserRecord, balances, joined)))
+    for user_id, fields in columns["extra"].items():
+        user = users[user_id]
+        for key, value in fields.items():
+            user[key] = value
+    return snapshot
+
+def validate_data(data):
+    """Journal `validate`: raises ValueError unless every section has the expected type."""
+    for section, kind in (("users", dict), ("codes", dict), ("links", list), ("config", dict),
+                          ("pending_withdrawals", dict), ("ledger", dict)):
+        if section in data and not isinstance(data[section], kind):
+            raise ValueError(f"section {section!r} is a {type(data[section]).__name__}, not a {kind.__name__}")
+    for user_id, user in data.get("users", {}).items():
+        if not isinstance(user, UserRecord) or not isinstance(user.balance, (int, float)):
+            raise ValueError(f"user {user_id!r} has no numeric balance")
+
+def json_journal(path, **kwargs):
+    """The Journal of the JSON backend's data.json."""
+    return Journal(path, object_hook=decode_json_object, default=encode_json_object,
+                   pack=pack_snapshot, unpack=unpack_snapshot, validate=validate_data, **kwargs)
+
+# --- HISTORY ---
+class HistoryStore:
+    """Per-user history lists of the JSON backend, kept in a small SQLite file.
+
+    Redeemed codes and completed withdrawals only ever grow and are only read when a user
+    opens a wallet or withdrawal screen, so they are appended here instead of being held in
+    every user record. Entries are numbered per list, which keeps re-importing the same
+    inline history from an older snapshot idempotent.
+    """
+
+    KINDS = ("redeemed_codes", "withdrawal_history")
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "user_id TEXT NOT NULL, kind TEXT NOT NULL, pos INTEGER NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (user_id, kind, pos)) WITHOUT ROWID")
+
+    def append(self, user_id, kind, value):
+        self._conn.execute(
+            "INSERT INTO history (user_id, kind, pos, value) "
+            "SELECT :u, :k, COALESCE(MAX(pos) + 1, 0), :v FROM history WHERE user_id = :u AND kind = :k",
+            {"u": str(user_id), "k": kind, "v": json.dumps(value)})
+
+    def append_many(self, entries):
+        """Appends (user_id, kind, value) entries in one transaction."""
+        self._conn.execute("BEGIN")
+        try:
+            for user_id, kind, value in entries:
+                self.append(user_id, kind, value)
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def import_lists(self, entries):
+        """Stores (user_id, kind, values) lists found inline in an older data.json."""
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO history (user_id, kind, pos, value) VALUES (?, ?, ?, ?)",
+                ((str(user_id), kind, pos, json.dumps(value))
+                 for user_id, kind, values in entries for pos, value in enumerate(values)))
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def load(self, user_id):
+        """Returns {kind: [values, oldest first]} for every kind."""
+        history = {kind: [] for kind in self.KINDS}
+        rows = self._conn.execute(
+            "SELECT kind, value FROM history WHERE user_id = ? ORDER BY kind, pos", (str(user_id),))
+        for kind, value in rows:
+            history.setdefault(kind, []).append(json.loads(value))
+        return history
+
+    def iter_all(self):
+        """Yields (user_id, kind, value) for every entry."""
+        for user_id, kind, value in self._conn.execute("SELECT user_id, kind, value FROM history ORDER BY user_id, kind, pos"):
+            yield user_id, kind, json.loads(value)
+
+    def delete(self, user_id):
+        self._conn.execute("DELETE FROM history WHERE user_id = ?", (str(user_id),))
+
+    def close(self):
+        self._conn.close()
+
+# --- TRANSACTION LOG ---
+TRANSACTIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    balance INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    ref TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_user ON transactions (user_id);
+CREATE INDEX IF NOT EXISTS transactions_time ON transactions (created_at);
+CREATE TRIGGER IF NOT EXISTS transactions_no_update BEFORE UPDATE ON transactions
+BEGIN SELECT RAISE(ABORT, 'transactions are append-only'); END;
+CREATE TRIGGER IF NOT EXISTS transactions_no_delete BEFORE DELETE ON transactions
+BEGIN SELECT RAISE(ABORT, 'transactions are append-only'); END;
+"""
+
+class TransactionLog:
+    """Append-only log of every credit and debit, amounts in integer paise.
+
+    One row per balance change, never updated or deleted (triggers refuse both), carrying
+    the user's balance after it. The balances the repositories store are a materialized
+    view of this log, so they can be checked against it or rebuilt from it, and reports
+    aggregate over it in SQL instead of walking every user.
+
+    The SQLite backend passes its own connection, so a balance and its row commit together.
+    The JSON backend keeps the log in a file of its own, opened with `open`.
+    """
+
+    def __init__(self, conn, path):
+        self.path = path
+        self._conn = conn
+        conn.executescript(TRANSACTIONS_SCHEMA)
+
+    @classmethod
+    def open(cls, path):
+        conn = sqlite3.connect(path, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return cls(conn, path)
+
+    @contextmanager
+    def batch(self):
+        """One transaction around many appends, for a log with a connection of its own."""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def append(self, user_id, amount, balance, kind, ref=None):
+        """Records one balance change and returns its id."""
+        return self._conn.execute(
+            "INSERT INTO transactions (user_id, amount, balance, kind, ref, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (str(user_id), amount, balance, kind, ref, datetime.now().isoformat())).lastrowid
+
+    def insert(self, rows):
+        """Writes (id, user_id, amount, balance, kind, ref, created_at) rows with their ids.
+
+        Rows already in the log are skipped, so the same rows can be written again.
+        """
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO transactions (id, user_id, amount, balance, kind, ref, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def append_openings(self, balances):
+        """Opens the log with the (user_id, paise) balances carried over from before it existed.
+
+        Users who already have an opening row are skipped, so an interrupted upgrade can
+        simply run again.
+        """
+        now = datetime.now().isoformat()
+        self._conn.executemany(
+            "INSERT INTO transactions (user_id, amount, balance, kind, ref, created_at) "
+            "SELECT ?1, ?2, ?2, 'opening', NULL, ?3 "
+            "WHERE NOT EXISTS (SELECT 1 FROM transactions WHERE user_id = ?1 AND kind = 'opening')",
+            ((str(user_id), paise, now) for user_id, paise in balances if paise))
+
+    def copy_from(self, path):
+        """Appends every row of another log file, keeping ids. Used when migrating backends."""
+        source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO transactions (id, user_id, amount, balance, kind, ref, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                source.execute("SELECT id, user_id, amount, balance, kind, ref, created_at FROM transactions ORDER BY id"))
+        finally:
+            source.close()
+
+    def last_id(self):
+        return self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0]
+
+    def entries_after(self, after_id=0, limit=1000):
+        rows = self._conn.execute(
+            "SELECT id, user_id, amount, balance, kind, ref, created_at FROM transactions "
+            "WHERE id > ? ORDER BY id LIMIT ?", (after_id or 0, limit))
+        return [dict(row) for row in rows]
+
+    def totals(self, user_ids):
+        """{user_id: sum of amounts} for the given users. Users without rows are left out."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        rows = self._conn.execute(
+            f"SELECT user_id, SUM(amount) FROM transactions WHERE user_id IN ({','.join('?' * len(user_ids))}) "
+            "GROUP BY user_id", user_ids)
+        return {row[0]: row[1] for row in rows}
+
+    def total_pages(self, limit=500):
+        """Yields lists of (user_id, sum of amounts) for every user in the log, by user id."""
+        after = ""
+        while True:
+            rows = self._conn.execute(
+                "SELECT user_id, SUM(amount) FROM transactions WHERE user_id > ? "
+                "GROUP BY user_id ORDER BY user_id LIMIT ?", (after, limit)).fetchall()
+            if not rows:
+                return
+            yield [(row[0], row[1]) for row in rows]
+            after = rows[-1][0]
+
+    def summary(self, days=7):
+        """Totals by kind over the whole log, and credits/debits per day over the last `days` days.
+
+        Opens its own read-only connection, so it can run in a worker thread while handlers
+        keep appending.
+        """
+        since = (datetime.now() - timedelta(days=days - 1)).date().isoformat()
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            kinds = {kind: (count, amount) for kind, count, amount in conn.execute(
+                "SELECT kind, COUNT(*), SUM(amount) FROM transactions GROUP BY kind")}
+            per_day = conn.execute(
+                "SELECT substr(created_at, 1, 10) AS day, COUNT(*), SUM(MAX(amount, 0)), -SUM(MIN(amount, 0)) "
+                "FROM transactions WHERE created_at >= ? GROUP BY day ORDER BY day", (since,)).fetchall()
+        finally:
+            conn.close()
+        return ledger_summary(kinds, per_day)
+
+    def close(self):
+        self._conn.close()
+
+def ledger_summary(kinds, per_day):
+    """The dict Repository.ledger_summary returns.
+
+    `kinds` maps each kind to (count, net paise); `per_day` lists (ISO day, count, credits,
+    debits) oldest first, debits as a positive number.
+    """
+    return {
+        "count": sum(count for count, _ in kinds.values()),
+        "net": sum(amount for _, amount in kinds.values()),
+        "kinds": kinds,
+        "days": [tuple(row) for row in per_day],
+    }
+
+def _reconcile_pages(balance_pages, log, exists, unlogged=dict):
+    """Compares stored balances with the log's totals, one page of users at a time.
+
+    `balance_pages` yields {user_id: stored balance} dicts. Each page and its log totals are
+    read without yielding in between, so both include the same changes even while handlers
+    run between pages; `unlogged()` returns {user_id: paise} of rows on their way to the
+    log, counted as logged. Afterwards, log entries of users who are no longer stored must
+    net to zero. Yields (users checked, [(user_id, stored, logged)]).
+    """
+    for stored in balance_pages:
+        logged = log.totals(stored)
+        for user_id, amount in unlogged().items():
+            if user_id in stored:
+                logged[user_id] = logged.get(user_id, 0) + amount
+        yield len(stored), [(user_id, balance, logged.get(user_id, 0)) for user_id, balance in stored.items()
+                            if balance != logged.get(user_id, 0)]
+    for page in log.total_pages():
+        yield 0, [(user_id, 0, total) for user_id, total in page if total and not exists(user_id)]
+
+def code_metadata(value, uses, max_uses=None, expires_at=None):
+    """The dict Repository.get_code returns. `remaining` is None for unlimited codes."""
+    return {
+        "value": value,
+        "uses": uses,
+        "max_uses": max_uses,
+        "remaining": None if max_uses is None else max(max_uses - uses, 0),
+        "expires_at": expires_at,
+    }
+
+def _code_row(code, metadata):
+    """A code's export row: its metadata without the derived `remaining`."""
+    return {"code": code, **{key: metadata[key] for key in ("value", "uses", "max_uses", "expires_at")}}
+
+
+# --- REPOSITORY INTERFACE ---
+class Repository:
+    """Storage interface for users, codes, links, config and withdrawals.
+
+    Handlers only talk to this interface, never to the backing data structure. Values handed
+    out are copies or small dicts, so mutating them has no effect; every change goes through
+    a method. Wrap multi-step balance changes in `transaction()`.
+    """
+
+    shared = False  # True when several worker processes use the same storage
+
+    def __init__(self):
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Registers `callback(section)`, called after "links" or "config" change."""
+        self._listeners.append(callback)
+
+    def _changed(self, section):
+        for callback in self._listeners:
+            callback(section)
+
+    # --- Users ---
+    def get_user(self, user_id):
+        """Returns {"user_id", "balance", "joined_at"} or None."""
+        raise NotImplementedError
+
+    def ensure_user(self, user_id):
+        """Creates the user if needed. Returns True if the user is new."""
+        raise NotImplementedError
+
+    def count_users(self):
+        raise NotImplementedError
+
+    def list_user_ids(self, offset, limit):
+        raise NotImplementedError
+
+    def page_users(self, order, cursor=None, backwards=False, limit=10):
+        """Returns a pagination.Page of user dicts after (or before) `cursor` in `order`."""
+        raise NotImplementedError
+
+    def adjust_balance(self, user_id, delta, kind="adjust", ref=None):
+        """Adds `delta` paise to the user's balance and returns the new balance.
+
+        Every change is also logged as an immutable `kind` transaction ("redeem", "withdraw",
+        "refund"...), with `ref` naming what caused it, such as the code or withdrawal id.
+        """
+        raise NotImplementedError
+
+    def delete_user(self, user_id):
+        raise NotImplementedError
+
+    def get_history(self, user_id):
+        """Returns {"redeemed_codes": [codes], "withdrawal_history": [request dicts]}, oldest first.
+
+        Read on demand by the wallet and withdrawal screens; nothing else needs history.
+        """
+        raise NotImplementedError
+
+    # --- Ledger ---
+    def transactions_after(self, after=None, limit=1000):
+        """Returns up to `limit` transactions logged after the one with id `after`, oldest first.
+
+        Each is a dict with id, user_id, amount, balance (after it), kind, ref and created_at.
+        """
+        raise NotImplementedError
+
+    def ledger_summary(self, days=7):
+        """Aggregates the transaction log (see `ledger_summary`). Safe to call from a worker thread."""
+        raise NotImplementedError
+
+    def reconcile_pages(self, limit=500):
+        """Yields (users checked, [(user_id, stored balance, logged total)]) a page at a time.
+
+        Each page is consistent on its own; callers may let other work run between pages.
+        """
+        raise NotImplementedError
+
+    def rebuild_balance(self, user_id):
+        """Sets the stored balance to the log's total for the user, logging the repair. Returns it."""
+        raise NotImplementedError
+
+    # --- Codes ---
+    def get_code(self, code):
+        """Returns the code's metadata (see `code_metadata`) or None. Values are in paise."""
+        raise NotImplementedError
+
+    def add_code(self, code, value, max_uses=None, expires_at=None):
+        """Creates a code worth `value` paise. `expires_at` is an ISO timestamp string."""
+        raise NotImplementedError
+
+    def has_redeemed(self, code, user_id):
+        raise NotImplementedError
+
+    def record_redemption(self, code, user_id):
+        raise NotImplementedError
+
+    # --- Links & config ---
+    def get_links(self):
+        """Returns a list of {"title", "url"} dicts."""
+        raise NotImplementedError
+
+    def add_link(self, title, url):
+        raise NotImplementedError
+
+    def get_config(self, key):
+        raise NotImplementedError
+
+    def set_config(self, key, value):
+        raise NotImplementedError
+
+    # --- Withdrawals ---
+    def create_withdrawal(self, request):
+        """Stores a pending withdrawal request dict (id, user_id, amount in paise, upi, timestamp)."""
+        raise NotImplementedError
+
+    def get_withdrawal(self, withdrawal_id):
+        """Returns the pending request dict or None."""
+        raise NotImplementedError
+
+    def get_user_withdrawals(self, user_id):
+        """Returns the user's pending request dicts, oldest first."""
+        raise NotImplementedError
+
+    def delete_withdrawal(self, withdrawal_id):
+        """Removes a pending request and returns it, or None if it was already gone."""
+        raise NotImplementedError
+
+    def count_withdrawals(self):
+        raise NotImplementedError
+
+    def page_withdrawals(self, order, cursor=None, backwards=False, limit=10):
+        """Returns a pagination.Page of pending request dicts after (or before) `cursor`."""
+        raise NotImplementedError
+
+    # --- Bulk ---
+    # One write per batch rather than per item: a single transaction (or MULTI), and one
+    # commit by the caller afterwards.
+    def add_codes(self, codes):
+        """Creates (code, value, max_uses, expires_at) codes, skipping existing ones. Returns those created."""
+        raise NotImplementedError
+
+    def add_users(self, users):
+        """Creates (user_id, balance, joined_at) users that don't exist yet. Returns the ids created.
+
+        A non-zero balance is logged as an "import" transaction.
+        """
+        raise NotImplementedError
+
+    def settle_withdrawals(self, withdrawal_ids):
+        """Marks pending requests as paid out and moves them to their users' withdrawal history.
+
+        Balances don't change; they were debited when the request was made. Returns
+        (settled request dicts, ids that weren't pending).
+        """
+        raise NotImplementedError
+
+    def export_pages(self, section, limit=1000):
+        """Yields the rows of "users", "codes" or "withdrawals" as lists of dicts, a page at a time."""
+        if section == "codes":
+            yield from self._code_pages(limit)
+            return
+        if section == "users":
+            fetch = lambda cursor: self.page_users(USER_ORDERS["j"], cursor, limit=limit)
+        else:
+            fetch = lambda cursor: self.page_withdrawals(WITHDRAWAL_ORDERS["t"], cursor, limit=limit)
+        cursor = None
+        while True:
+            page = fetch(cursor)
+            if page.items:
+                yield page.items
+            if not page.has_next:
+                return
+            cursor = page.last
+
+    def _code_pages(self, limit):
+        """Yields lists of {"code", "value", "uses", "max_uses", "expires_at"} dicts."""
+        raise NotImplementedError
+
+    # --- Durability ---
+    @contextmanager
+    def transaction(self):
+        """Groups several changes into one atomic unit where the backend supports rollback."""
+        yield
+
+    def lock(self, name):
+        """Async context manager serializing `name` across every worker sharing this storage.
+
+        A single process needs nothing beyond the ledger's own locks.
+        """
+        return nullcontext()
+
+    def commit(self, urgent=False):
+        """Returns a future resolved once all changes so far are durable."""
+        raise NotImplementedError
+
+    async def start(self):
+        """Starts any background work the backend needs."""
+
+    async def close(self):
+        """Flushes and releases the backend."""
+
+
+# --- JSON BACKEND ---
+class JsonRepository(Repository):
+    """The original data.json layout, persisted through the journal and background writer.
+
+    Mutations run synchronously on the event loop thread, so a transaction only has to
+    make sure nothing awaits between its steps. Sorted indexes for the admin listings are
+    kept up to date by every mutation below; the user indexes, by far the largest, are
+    only built when an admin first pages through the users, not at startup.
+
+    Users are held as UserRecords; their history lists are in `history`, a HistoryStore.
+    Each balance change journals its row for `transactions`, a TransactionLog of its own,
+    in `data["ledger"]["unlogged"]`, next to the rest of the operation, and the row is only
+    copied to the log once the journal has it on disk. A crash therefore loses whole
+    operations or nothing, and startup copies any rows still unlogged. `data["ledger"]["seq"]`
+    is the last row id the journal includes; log rows after it, which versions that logged
+    before journaling could leave, re-apply their balance at startup.
+    """
+
+    def __init__(self, journal, persistence, default_factory, history, transactions):
+        super().__init__()
+        self.journal = journal
+        self.persistence = persistence
+        self.history = history
+        self.transactions = transactions
+        self.data = journal.load(default_factory)
+        upgraded = upgrade_to_paise(self.data)
+        self._move_legacy_history()
+        if upgraded:
+            self._open_ledger()
+        self._catch_up_ledger()
+        self._user_indexes = None
+        self._withdrawal_indexes = {
+            code: SortedIndex((order.key(w), w_id) for w_id, w in self.data["pending_withdrawals"].items())
+            for code, order in WITHDRAWAL_ORDERS.items()
+        }
+
+    def _move_legacy_history(self):
+        """Moves history still inline in the snapshot or journal into the HistoryStore.
+
+        The records keep no copy, so the next compaction writes data.json without it.
+        """
+        entries = []
+        for user_id, user in self.data["users"].items():
+            if user.legacy_history:
+                entries.extend((user_id, kind, values) for kind, values in user.legacy_history.items())
+                user.legacy_history = None
+        if entries:
+            self.history.import_lists(entries)
+            logger.info("Moved %d inline history lists to %s", len(entries), self.history.path)
+
+    def _open_ledger(self):
+        """Logs the balances converted by `upgrade_to_paise` as opening entries.
+
+        The snapshot is compacted straight away, so journal records written in rupees are
+        never replayed on top of paise.
+        """
+        users = self.data["users"]
+        with self.transactions.batch():
+            self.transactions.append_openings((user_id, user.balance) for user_id, user in users.items())
+        self.data["ledger"]["seq"] = self.transactions.last_id()
+        self.journal.compact()
+        logger.info("Converted balances to paise and opened the transaction log for %d users", len(users))
+
+    def _catch_up_ledger(self):
+        """Brings the transaction log and the journal back in step after a crash.
+
+        Journaled rows the log misses are written to it. Log rows the journal misses re-apply
+        the balance they carry, which is harmless for rows the journal did include.
+        """
+        ledger = self.data["ledger"]
+        if "unlogged" not in ledger:
+            self.journal.apply("set", ("ledger", "unlogged"), {})
+        for key in list(ledger["unlogged"]):
+            self._write_log(key)
+        users = self.data["users"]
+        caught_up = 0
+        while True:
+            entries = self.transactions.entries_after(self.data["ledger"]["seq"])
+            if not entries:
+                break
+            for entry in entries:
+                if entry["user_id"] not in users:
+                    self.journal.apply("set", ("users", entry["user_id"]), UserRecord(0, entry["created_at"]))
+                self.journal.apply("set", ("users", entry["user_id"], "balance"), entry["balance"])
+            self.journal.apply("set", ("ledger", "seq"), entries[-1]["id"])
+            caught_up += len(entries)
+        if caught_up:
+            logger.info("Re-applied %d transactions logged after the journal", caught_up)
+        self._last_entry_id = max(self.transactions.last_id(), ledger["seq"])
+
+    def _entry(self, user_id, amount, balance, kind, ref=None):
+        """A new log row, as a list so the JSON object_hook leaves it alone."""
+        self._last_entry_id += 1
+        return [self._last_entry_id, user_id, amount, balance, kind, ref, datetime.now().isoformat()]
+
+    def _log(self, rows):
+        """Journals log rows; they reach `transactions` once the journal has them on disk."""
+        key = str(rows[0][0])
+        self.journal.apply("set", ("ledger", "unlogged", key), rows)
+        self.persistence.after_flush(lambda: self._write_log(key))
+
+    def _write_log(self, key):
+        rows = self.data["ledger"]["unlogged"].get(key)
+        if rows is None:
+            return
+        try:
+            with self.transactions.batch():
+                self.transactions.insert(rows)
+        except sqlite3.Error:
+            logger.exception("Could not write transactions %s to %s; retrying at the next start",
+                             key, self.transactions.path)
+            return
+        self.journal.apply("del", ("ledger", "unlogged", key))
+
+    def _unlogged(self):
+        return [row for rows in self.data["ledger"]["unlogged"].values() for row in rows]
+
+    def _unlogged_totals(self):
+        totals = {}
+        for _, user_id, amount, *_ in self._unlogged():
+            totals[user_id] = totals.get(user_id, 0) + amount
+        return totals
+
+    def _build_user_indexes(self):
+        self._user_indexes = {
+            code: SortedIndex((order.key(user), user_id) for user_id, user in self.data["users"].items())
+            for code, order in USER_ORDERS.items()
+        }
+
+    def _index_user(self, user_id, add=True):
+        if self._user_indexes is None:
+            return  # Built from the current users when first needed
+        user = self.data["users"][user_id]
+        for code, order in USER_ORDERS.items():
+            index = self._user_indexes[code]
+            (index.add if add else index.discard)(order.key(user), user_id)
+
+    def _index_withdrawal(self, request, add=True):
+        for code, order in WITHDRAWAL_ORDERS.items():
+            index = self._withdrawal_indexes[code]
+            (index.add if add else index.discard)(order.key(request), request["id"])
+
+    # --- Users ---
+    def get_user(self, user_id):
+        user = self.data["users"].get(str(user_id))
+        if user is None:
+            return None
+        return {"user_id": str(user_id), "balance": user["balance"], "joined_at": user.get("joined_at", "")}
+
+    def ensure_user(self, user_id):
+        user_id_str = str(user_id)
+        if user_id_str in self.data["users"]:
+            return False
+        self.journal.apply("set", ("users", user_id_str), UserRecord(0, datetime.now().isoformat()))
+        self._index_user(user_id_str)
+        return True
+
+    def count_users(self):
+        return len(self.data["users"])
+
+    def list_user_ids(self, offset, limit):
+        return list(islice(self.data["users"], offset, offset + limit))
+
+    def page_users(self, order, cursor=None, backwards=False, limit=10):
+        if self._user_indexes is None:
+            self._build_user_indexes()
+        pairs, has_prev, has_next = self._user_indexes[order.code].page(cursor, backwards, limit)
+        return make_page(pairs, [self.get_user(user_id) for _, user_id in pairs], has_prev, has_next)
+
+    def _set_balance(self, user_id, balance, delta, kind, ref=None):
+        """Journals the log row first, then the new balance and the log position."""
+        entry = self._entry(user_id, delta, balance, kind, ref)
+        entry_id = entry[0]
+        self._log([entry])
+        self._index_user(user_id, add=False)
+        self.journal.apply("set", ("users", user_id, "balance"), balance)
+        self.journal.apply("set", ("ledger", "seq"), entry_id)
+        self._index_user(user_id)
+        return balance
+
+    def adjust_balance(self, user_id, delta, kind="adjust", ref=None):
+        user_id_str = str(user_id)
+        self.ensure_user(user_id_str)
+        return self._set_balance(user_id_str, self.data["users"][user_id_str].balance + delta, delta, kind, ref)
+
+    def delete_user(self, user_id):
+        user_id_str = str(user_id)
+        if user_id_str not in self.data["users"]:
+            return
+        self._index_user(user_id_str, add=False)
+        self.journal.apply("del", ("users", user_id_str))
+        self.history.delete(user_id_str)
+
+    def get_history(self, user_id):
+        return self.history.load(user_id)
+
+    # --- Ledger ---
+    def transactions_after(self, after=None, limit=1000):
+        entries = {entry["id"]: entry for entry in self.transactions.entries_after(after, limit)}
+        for row in self._unlogged():
+            if row[0] > (after or 0):
+                entries[row[0]] = dict(zip(("id", "user_id", "amount", "balance", "kind", "ref", "created_at"), row))
+        return [entries[entry_id] for entry_id in sorted(entries)[:limit]]
+
+    def ledger_summary(self, days=7):
+        return self.transactions.summary(days)  # Rows written in the last flush interval may be missing
+
+    def reconcile_pages(self, limit=500):
+        users = self.data["users"]
+        user_ids = list(users)  # Users created later are covered by the log pass at the end
+
+        def pages():
+            for start in range(0, len(user_ids), limit):
+                yield {user_id: users[user_id].balance for user_id in user_ids[start:start + limit] if user_id in users}
+
+        return _reconcile_pages(pages(), self.transactions, users.__contains__, self._unlogged_totals)
+
+    def rebuild_balance(self, user_id):
+        user_id_str = str(user_id)
+        self.ensure_user(user_id_str)
+        total = (self.transactions.totals([user_id_str]).get(user_id_str, 0)
+                 + self._unlogged_totals().get(user_id_str, 0))
+        return self._set_balance(user_id_str, total, 0, "reconcile")
+
+    # --- Codes ---
+    def get_code(self, code):
+        code_info = self.data["codes"].get(code)
+        if code_info is None:
+            return None
+        return code_metadata(code_info["value"], len(code_info["used_by"]),
+                             code_info.get("max_uses"), code_info.get("expires_at"))
+
+    def add_code(self, code, value, max_uses=None, expires_at=None):
+        code_info = {"value": value, "used_by": RedemptionSet()}
+        if max_uses is not None:
+            code_info["max_uses"] = max_uses
+        if expires_at is not None:
+            code_info["expires_at"] = expires_at
+        self.journal.apply("set", ("codes", code), code_info)
+
+    def has_redeemed(self, code, user_id):
+        return user_id in self.data["codes"][code]["used_by"]
+
+    def record_redemption(self, code, user_id):
+        user_id_str = str(user_id)
+        self.journal.apply("add", ("codes", code, "used_by"), user_id_str)
+        self.history.append(user_id_str, "redeemed_codes", code)
+
+    # --- Links & config ---
+    def get_links(self):
+        return [dict(link) for link in self.data["links"]]
+
+    def add_link(self, title, url):
+        self.journal.apply("append", ("links",), {"title": title, "url": url})
+        self._changed("links")
+
+    def get_config(self, key):
+        return self.data["config"].get(key)
+
+    def set_config(self, key, value):
+        self.journal.apply("set", ("config", key), value)
+        self._changed("config")
+
+    # --- Withdrawals ---
+    def create_withdrawal(self, request):
+        self.journal.apply("set", ("pending_withdrawals", request["id"]), request)
+        self.journal.apply("append", ("users", request["user_id"], "pending_withdrawals"), request["id"])
+        self._index_withdrawal(request)
+
+    def get_withdrawal(self, withdrawal_id):
+        request = self.data["pending_withdrawals"].get(withdrawal_id)
+        return dict(request) if request is not None else None
+
+    def get_user_withdrawals(self, user_id):
+        user = self.data["users"].get(str(user_id))
+        if user is None:
+            return []
+        pending = self.data["pending_withdrawals"]
+        return [dict(pending[w_id]) for w_id in user.pending_withdrawals or () if w_id in pending]
+
+    def delete_withdrawal(self, withdrawal_id):
+        request = self.get_withdrawal(withdrawal_id)
+        if request is None:
+            return None
+        if request["user_id"] in self.data["users"]:
+            self.journal.apply("remove", ("users", request["user_id"], "pending_withdrawals"), withdrawal_id)
+        self.journal.apply("del", ("pending_withdrawals", withdrawal_id))
+        self._index_withdrawal(request, add=False)
+        return request
+
+    def count_withdrawals(self):
+        return len(self.data["pending_withdrawals"])
+
+    def page_withdrawals(self, order, cursor=None, backwards=False, limit=10):
+        pairs, has_prev, has_next = self._withdrawal_indexes[order.code].page(cursor, backwards, limit)
+        return make_page(pairs, [self.get_withdrawal(w_id) for _, w_id in pairs], has_prev, has_next)
+
+    # --- Bulk ---
+    def add_codes(self, codes):
+        created = []
+        for code, value, max_uses, expires_at in codes:
+            if code not in self.data["codes"]:
+                self.add_code(code, value, max_uses, expires_at)
+                created.append(code)
+        return created
+
+    def add_users(self, users):
+        users_data = self.data["users"]
+        new, seen = [], set()
+        for user_id, balance, joined_at in users:
+            user_id_str = str(user_id)
+            if user_id_str not in users_data and user_id_str not in seen:
+                seen.add(user_id_str)
+                new.append((user_id_str, balance, joined_at or datetime.now().isoformat()))
+        entries = [self._entry(user_id, balance, balance, "import") for user_id, balance, _ in new if balance]
+        if entries:
+            self._log(entries)
+        for user_id, balance, joined_at in new:
+            self.journal.apply("set", ("users", user_id), UserRecord(balance, joined_at))
+            self._index_user(user_id)
+        if entries:
+            self.journal.apply("set", ("ledger", "seq"), entries[-1][0])
+        return [user_id for user_id, _, _ in new]
+
+    def settle_withdrawals(self, withdrawal_ids):
+        settled, missing = [], []
+        for withdrawal_id in dict.fromkeys(withdrawal_ids):
+            request = self.delete_withdrawal(withdrawal_id)
+            (settled if request is not None else missing).append(request or withdrawal_id)
+        self.history.append_many((request["user_id"], "withdrawal_history", request) for request in settled)
+        return settled, missing
+
+    def _code_pages(self, limit):
+        codes = list(self.data["codes"])  # Codes created meanwhile are left for the next export
+        for start in range(0, len(codes), limit):
+            yield [_code_row(code, self.get_code(code)) for code in codes[start:start + limit] if code in self.data["codes"]]
+
+    # --- Durability ---
+    def commit(self, urgent=False):
+        return self.persistence.mark_dirty(urgent=urgent)
+
+    async def start(self):
+        self.persistence.start()
+
+    async def close(self):
+        await self.persistence.stop()
+        self.journal.close()
+        self.history.close()
+        self.transactions.close()
+
+
+# --- SQLITE BACKEND ---
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    balance INTEGER NOT NULL DEFAULT 0,
+    joined_at TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS users_by_balance ON users (-balance, user_id);
+CREATE TABLE IF NOT EXISTS codes (
+    code TEXT PRIMARY KEY,
+    value INTEGER NOT NULL,
+    uses INTEGER NOT NULL DEFAULT 0,
+    max_uses INTEGER,
+    expires_at TEXT
+);
+CREATE TABLE IF NOT EXISTS redemptions (
+    code TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (code, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS redemptions_user ON redemptions (user_id);
+CREATE TABLE IF NOT EXISTS links (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    url TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS config (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS withdrawals (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    upi TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending'
+);
+CREATE INDEX IF NOT EXISTS withdrawals_user_status ON withdrawals (user_id, status);
+CREATE INDEX IF NOT EXISTS withdrawals_status ON withdrawals (status, timestamp, id);
+CREATE INDEX IF NOT EXISTS withdrawals_by_amount ON withdrawals (status, -amount, id);
+"""
+
+class SQLiteRepository(Repository):
+    """Indexed SQLite storage in WAL mode.
+
+    Every statement outside `transaction()` commits on its own. Only the rows a handler
+    touches are read, so memory and startup time don't grow with history. Money columns
+    are INTEGER paise, and the transaction log lives in the same database.
+    """
+
+    def __init__(self, path, default_config):
+        super().__init__()
+        self.path = path
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SQLITE_SCHEMA)
+        self.transactions = TransactionLog(self._conn, path)
+        self._depth = 0
+        self._upgrade_schema()
+        with self.transaction():
+            for key, value in default_config.items():
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO config (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def _upgrade_schema(self):
+        """Adds columns introduced after a database was created."""
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(codes)")}
+        if "uses" not in columns:
+            self._conn.execute("ALTER TABLE codes ADD COLUMN uses INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute(
+                "UPDATE codes SET uses = (SELECT COUNT(*) FROM redemptions r WHERE r.code = codes.code)")
+        if "max_uses" not in columns:
+            self._conn.execute("ALTER TABLE codes ADD COLUMN max_uses INTEGER")
+        if "expires_at" not in columns:
+            self._conn.execute("ALTER TABLE codes ADD COLUMN expires_at TEXT")
+        columns = {row["name"]: row["type"] for row in self._conn.execute("PRAGMA table_info(users)")}
+        if "joined_at" not in columns:
+            self._conn.execute("ALTER TABLE users ADD COLUMN joined_at TEXT NOT NULL DEFAULT ''")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS users_by_joined ON users (joined_at, user_id)")
+        if columns["balance"] == "REAL":
+            self._convert_to_paise()
+
+    def _convert_to_paise(self):
+        """Turns the REAL rupee columns of a database from before the ledger into INTEGER paise.
+
+        Runs in one transaction with the opening entries of the transaction log.
+        """
+        conn = self._conn
+        with self.transaction():
+            conn.execute("DROP INDEX IF EXISTS users_by_balance")
+            conn.execute("DROP INDEX IF EXISTS withdrawals_by_amount")
+            for table, column in (("users", "balance"), ("codes", "value"), ("withdrawals", "amount")):
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN paise INTEGER NOT NULL DEFAULT 0")
+                conn.execute(f"UPDATE {table} SET paise = CAST(ROUND({column} * 100) AS INTEGER)")
+                conn.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+                conn.execute(f"ALTER TABLE {table} RENAME COLUMN paise TO {column}")
+            self.transactions.append_openings(
+                conn.execute("SELECT user_id, balance FROM users WHERE balance != 0").fetchall())
+        conn.executescript(SQLITE_SCHEMA)  # Recreates the two indexes
+        logger.info("Converted %s to integer paise and opened the transaction log", self.path)
+
+    def _page(self, table, id_column, columns, where, order, cursor, backwards, limit):
+        """Keyset pagination over an index on (order.sql, id_column)."""
+        expr = order.sql
+        op, direction = ("<", "DESC") if backwards else (">", "ASC")
+        params = {"n": limit + 1}
+        seek = ""
+        if cursor is not None:
+            # The first term lets SQLite seek into the index instead of scanning it
+            seek = f"AND {expr} {op}= :k AND ({expr} {op} :k OR {id_column} {op} :i)"
+            params["k"], params["i"] = cursor
+        rows = self._conn.execute(
+            f"SELECT {columns}, {expr} AS sort_key FROM {table} WHERE {where} {seek} "
+            f"ORDER BY {expr} {direction}, {id_column} {direction} LIMIT :n", params).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+        pairs = [(row["sort_key"], row[id_column]) for row in rows]
+        items = [{key: row[key] for key in row.keys() if key != "sort_key"} for row in rows]
+
+        # The LIMIT n+1 trick covers the direction we fetched; probe the other side
+        if backwards:
+            edge, op = (pairs[-1] if pairs else cursor), ">"
+        else:
+            edge, op = (pairs[0] if pairs else cursor), "<"
+        beyond = edge is not None and self._one(
+            f"SELECT 1 FROM {table} WHERE {where} AND {expr} {op}= :k AND ({expr} {op} :k OR {id_column} {op} :i) LIMIT 1",
+            {"k": edge[0], "i": edge[1]}) is not None
+        if backwards:
+            return make_page(pairs, items, more, beyond)
+        return make_page(pairs, items, beyond, more)
+
+    def _one(self, sql, params=()):
+        return self._conn.execute(sql, params).fetchone()
+
+    # --- Users ---
+    def get_user(self, user_id):
+        row = self._one("SELECT user_id, balance, joined_at FROM users WHERE user_id = ?", (str(user_id),))
+        return dict(row) if row is not None else None
+
+    def ensure_user(self, user_id):
+        cursor = self._conn.execute(
+            "INSERT OR IGNORE INTO users (user_id, joined_at) VALUES (?, ?)", (str(user_id), datetime.now().isoformat()))
+        return cursor.rowcount == 1
+
+    def count_users(self):
+        return self._one("SELECT COUNT(*) FROM users")[0]
+
+    def list_user_ids(self, offset, limit):
+        rows = self._conn.execute(
+            "SELECT user_id FROM users ORDER BY rowid LIMIT ? OFFSET ?", (limit, offset))
+        return [row[0] for row in rows]
+
+    def page_users(self, order, cursor=None, backwards=False, limit=10):
+        return self._page("users", "user_id", "user_id, balance, joined_at", "1",
+                          order, cursor, backwards, limit)
+
+    def adjust_balance(self, user_id, delta, kind="adjust", ref=None):
+        user_id_str = str(user_id)
+        with self.transaction():
+            self.ensure_user(user_id_str)
+            self._conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (delta, user_id_str))
+            balance = self._one("SELECT balance FROM users WHERE user_id = ?", (user_id_str,))[0]
+            self.transactions.append(user_id_str, delta, balance, kind, ref)
+            return balance
+
+    def delete_user(self, user_id):
+        self._conn.execute("DELETE FROM users WHERE user_id = ?", (str(user_id),))
+
+    def get_history(self, user_id):
+        user_id_str = str(user_id)
+        codes = [row[0] for row in self._conn.execute(
+            "SELECT code FROM redemptions WHERE user_id = ? ORDER BY code", (user_id_str,))]
+        payouts = [dict(row) for row in self._conn.execute(
+            "SELECT id, user_id, amount, upi, timestamp FROM withdrawals "
+            "WHERE user_id = ? AND status = 'completed' ORDER BY timestamp", (user_id_str,))]
+        return {"redeemed_codes": codes, "withdrawal_history": payouts}
+
+    # --- Ledger ---
+    def transactions_after(self, after=None, limit=1000):
+        return self.transactions.entries_after(after, limit)
+
+    def ledger_summary(self, days=7):
+        return self.transactions.summary(days)
+
+    def reconcile_pages(self, limit=500):
+        def pages():
+            after = ""
+            while True:
+                rows = self._conn.execute(
+                    "SELECT user_id, balance FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                    (after, limit)).fetchall()
+                if not rows:
+                    return
+                yield {row[0]: row[1] for row in rows}
+                after = rows[-1][0]
+
+        return _reconcile_pages(pages(), self.transactions, lambda user_id: self.get_user(user_id) is not None)
+
+    def rebuild_balance(self, user_id):
+        user_id_str = str(user_id)
+        with self.transaction():
+            self.ensure_user(user_id_str)
+            total = self.transactions.totals([user_id_str]).get(user_id_str, 0)
+            self._conn.execute("UPDATE users SET balance = ? WHERE user_id = ?", (total, user_id_str))
+            self.transactions.append(user_id_str, 0, total, "reconcile")
+            return total
+
+    # --- Codes ---
+    def get_code(self, code):
+        row = self._one("SELECT value, uses, max_uses, expires_at FROM codes WHERE code = ?", (code,))
+        return code_metadata(*row) if row is not None else None
+
+    def add_code(self, code, value, max_uses=None, expires_at=None):
+        self._conn.execute(
+            "INSERT INTO codes (code, value, max_uses, expires_at) VALUES (?, ?, ?, ?)",
+            (code, value, max_uses, expires_at))
+
+    def has_redeemed(self, code, user_id):
+        return self._one(
+            "SELECT 1 FROM redemptions WHERE code = ? AND user_id = ?", (code, str(user_id))) is not None
+
+    def record_redemption(self, code, user_id):
+        with self.transaction():
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO redemptions (code, user_id) VALUES (?, ?)", (code, str(user_id)))
+            if cursor.rowcount == 1:
+                self._conn.execute("UPDATE codes SET uses = uses + 1 WHERE code = ?", (code,))
+
+    # --- Links & config ---
+    def get_links(self):
+        return [dict(row) for row in self._conn.execute("SELECT title, url FROM links ORDER BY id")]
+
+    def add_link(self, title, url):
+        self._conn.execute("INSERT INTO links (title, url) VALUES (?, ?)", (title, url))
+        self._changed("links")
+
+    def get_config(self, key):
+        row = self._one("SELECT value FROM config WHERE key = ?", (key,))
+        return json.loads(row[0]) if row is not None else None
+
+    def set_config(self, key, value):
+        self._conn.execute(
+            "INSERT INTO config (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (key, json.dumps(value)))
+        self._changed("config")
+
+    # --- Withdrawals ---
+    def create_withdrawal(self, request):
+        self._conn.execute(
+            "INSERT INTO withdrawals (id, user_id, amount, upi, timestamp) VALUES (?, ?, ?, ?, ?)",
+            (request["id"], request["user_id"], request["amount"], request["upi"], request["timestamp"]))
+
+    def get_withdrawal(self, withdrawal_id):
+        row = self._one(
+            "SELECT id, user_id, amount, upi, timestamp FROM withdrawals WHERE id = ? AND status = 'pending'",
+            (withdrawal_id,))
+        return dict(row) if row is not None else None
+
+    def get_user_withdrawals(self, user_id):
+        rows = self._conn.execute(
+            "SELECT id, user_id, amount, upi, timestamp FROM withdrawals "
+            "WHERE user_id = ? AND status = 'pending' ORDER BY timestamp", (str(user_id),))
+        return [dict(row) for row in rows]
+
+    def delete_withdrawal(self, withdrawal_id):
+        with self.transaction():
+            request = self.get_withdrawal(withdrawal_id)
+            if request is not None:
+                self._conn.execute("DELETE FROM withdrawals WHERE id = ?", (withdrawal_id,))
+            return request
+
+    def count_withdrawals(self):
+        return self._one("SELECT COUNT(*) FROM withdrawals WHERE status = 'pending'")[0]
+
+    def page_withdrawals(self, order, cursor=None, backwards=False, limit=10):
+        return self._page("withdrawals", "id", "id, user_id, amount, upi, timestamp", "status = 'pending'",
+                          order, cursor, backwards, limit)
+
+    # --- Bulk ---
+    def add_codes(self, codes):
+        created = []
+        with self.transaction():
+            for code, value, max_uses, expires_at in codes:
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO codes (code, value, max_uses, expires_at) VALUES (?, ?, ?, ?)",
+                    (code, value, max_uses, expires_at))
+                if cursor.rowcount == 1:
+                    created.append(code)
+        return created
+
+    def add_users(self, users):
+        created = []
+        with self.transaction():
+            for user_id, balance, joined_at in users:
+                user_id_str = str(user_id)
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO users (user_id, balance, joined_at) VALUES (?, ?, ?)",
+                    (user_id_str, balance, joined_at or datetime.now().isoformat()))
+                if cursor.rowcount == 1:
+                    created.append(user_id_str)
+                    if balance:
+                        self.transactions.append(user_id_str, balance, balance, "import")
+        return created
+
+    def settle_withdrawals(self, withdrawal_ids):
+        settled, missing = [], []
+        with self.transaction():
+            for withdrawal_id in dict.fromkeys(withdrawal_ids):
+                request = self.get_withdrawal(withdrawal_id)
+                if request is None:
+                    missing.append(withdrawal_id)
+                    continue
+                self._conn.execute("UPDATE withdrawals SET status = 'completed' WHERE id = ?", (withdrawal_id,))
+                settled.append(request)
+        return settled, missing
+
+    def _code_pages(self, limit):
+        after = ""
+        while True:
+            rows = self._conn.execute(
+                "SELECT code, value, uses, max_uses, expires_at FROM codes WHERE code > ? ORDER BY code LIMIT ?",
+                (after, limit)).fetchall()
+            if not rows:
+                return
+            yield [dict(row) for row in rows]
+            after = rows[-1]["code"]
+
+    # --- Durability ---
+    @contextmanager
+    def transaction(self):
+        if self._depth:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._depth = 1
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        else:
+            self._conn.execute("COMMIT")
+        finally:
+            self._depth = 0
+
+    def commit(self, urgent=False):
+        return _done_future()  # Statements are committed as they run
+
+    async def close(self):
+        self._conn.close()
+
+
+# --- MIGRATION ---
+def empty_data():
+    """Sections of the JSON layout, with no config defaults."""
+    return {"users": {}, "codes": {}, "links": [], "config": {}, "pending_withdrawals": {}}
+
+def unlogged_rows(data):
+    """Log rows a JSON layout journaled but didn't copy to its transaction log yet, oldest first."""
+    return sorted(row for rows in data.get("ledger", {}).get("unlogged", {}).values() for row in rows)
+
+def upgrade_to_paise(data):
+    """Converts the float rupees of a data.json from before the ledger into integer paise, in place.
+
+    Balances, code values and withdrawal amounts, pending or in inline history, are
+    converted. Returns False if `data` already has a "ledger" section.
+    """
+    if "ledger" in data:
+        return False
+    for user in data["users"].values():
+        user.balance = paise_from_float(user.balance)
+        for request in (user.legacy_history or {}).get("withdrawal_history", ()):
+            if isinstance(request, dict):
+                request["amount"] = paise_from_float(request["amount"])
+    for info in data["codes"].values():
+        info["value"] = paise_from_float(info["value"])
+    for request in data["pending_withdrawals"].values():
+        request["amount"] = paise_from_float(request["amount"])
+    data["ledger"] = {"units": "paise", "seq": 0}
+    return True
+
+def migrate_json_to_sqlite(json_path, db_path, history_path=None, ledger_path=None):
+    """One-shot import of data.json (plus any unflushed journal, history and transaction log) into SQLite.
+
+    Without a transaction log, one is opened with the imported balances.
+    """
+    journal = json_journal(json_path)
+    data = journal.load(empty_data)
+    journal.close()
+    upgrade_to_paise(data)
+    payouts = [(user_id, r) for user_id, user in data["users"].items()
+               for r in (user.legacy_history or {}).get("withdrawal_history", ())]
+    if history_path is not None and os.path.exists(history_path):
+        history = HistoryStore(history_path)
+        payouts.extend((user_id, r) for user_id, kind, r in history.iter_all() if kind == "withdrawal_history")
+        history.close()
+
+    repo = SQLiteRepository(db_path, default_config={})
+    conn = repo._conn
+    with repo.transaction():
+        conn.executemany(
+            "INSERT OR REPLACE INTO users (user_id, balance, joined_at) VALUES (?, ?, ?)",
+            ((user_id, user["balance"], user.get("joined_at", "")) for user_id, user in data["users"].items()))
+        conn.executemany(
+            "INSERT OR REPLACE INTO codes (code, value, uses, max_uses, expires_at) VALUES (?, ?, ?, ?, ?)",
+            ((code, info["value"], len(info["used_by"]), info.get("max_uses"), info.get("expires_at"))
+             for code, info in data["codes"].items()))
+        conn.executemany(
+            "INSERT OR IGNORE INTO redemptions (code, user_id) VALUES (?, ?)",
+            ((code, user_id) for code, info in data["codes"].items() for user_id in info["used_by"]))
+        conn.execute("DELETE FROM links")
+        conn.executemany(
+            "INSERT INTO links (title, url) VALUES (?, ?)",
+            ((link["title"], link["url"]) for link in data["links"]))
+        conn.executemany(
+            "INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)",
+            ((key, json.dumps(value)) for key, value in data["config"].items()))
+        conn.executemany(
+            "INSERT OR REPLACE INTO withdrawals (id, user_id, amount, upi, timestamp) VALUES (?, ?, ?, ?, ?)",
+            ((r["id"], r["user_id"], r["amount"], r["upi"], r["timestamp"])
+             for r in data["pending_withdrawals"].values()))
+        conn.executemany(
+            "INSERT OR IGNORE INTO withdrawals (id, user_id, amount, upi, timestamp, status) "
+            "VALUES (?, ?, ?, ?, ?, 'completed')",
+            ((r["id"], user_id, r["amount"], r["upi"], r["timestamp"])
+             for user_id, r in payouts if isinstance(r, dict)))
+        if ledger_path is not None and os.path.exists(ledger_path):
+            repo.transactions.copy_from(ledger_path)
+            repo.transactions.insert(unlogged_rows(data))
+        else:
+            repo.transactions.append_openings((user_id, user.balance) for user_id, user in data["users"].items())
+    conn.close()
+    logger.info("Migrated %d users and %d codes from %s to %s",
+                len(data["users"]), len(data["codes"]), json_path, db_path)
+
+
+if __name__ == "__main__":
+    # Usage: python storage.py data.json data.db [history.db [ledger.db]]
+    logging.basicConfig(level=logging.INFO)
+    migrate_json_to_sqlite(*sys.argv[1:5])
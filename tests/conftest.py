@@ -0,0 +1,26 @@
+# tests/conftest.py
+
+import importlib
+import os
+import sys
+
+import pytest
+
+# The bot's modules live at the repository root, next to main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def main(request, tmp_path, monkeypatch):
+    """A freshly imported main.py keeping its data in `tmp_path`.
+
+    Uses the JSON backend unless parametrized indirectly with another STORAGE_BACKEND; "redis"
+    gets an in-process fakeredis server.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("STORAGE_BACKEND", getattr(request, "param", "json"))
+    monkeypatch.setenv("REDIS_URL", "memory://")
+    monkeypatch.setenv("METRICS_PORT", "0")
+    sys.modules.pop("main", None)
+    yield importlib.import_module("main")
+    sys.modules.pop("main", None)
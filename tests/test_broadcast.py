@@ -0,0 +1,80 @@
+# tests/test_broadcast.py
+
+import asyncio
+import json
+
+import pytest
+from telegram.error import RetryAfter
+
+from broadcast import BATCH_SIZE, Broadcaster
+
+USERS = 2 * BATCH_SIZE + 50
+FIRST_USER_ID = 1_000_000
+
+
+class FakeBot:
+    """Records who got the broadcast; `on_send` runs after each delivery."""
+
+    def __init__(self, on_send=lambda user_id: None):
+        self.received = []
+        self.on_send = on_send
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.received.append(str(chat_id))
+        self.on_send(str(chat_id))
+
+    async def edit_message_text(self, **kwargs):
+        raise RetryAfter(5)  # Progress edits failing must not end the job
+
+
+def add_users(repo):
+    user_ids = [str(FIRST_USER_ID + i) for i in range(USERS)]
+    with repo.transaction():
+        for user_id in user_ids:
+            repo.ensure_user(user_id)
+    return user_ids
+
+
+def broadcast(broadcaster, bot, resume=False):
+    async def run():
+        if resume:
+            assert broadcaster.resume(bot)
+        else:
+            broadcaster.start(bot, "hello", admin_chat_id=1, progress_message_id=1)
+        await broadcaster._task
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("main", ["json", "sqlite"], indirect=True)
+def test_deleting_users_mid_broadcast_skips_nobody(main, tmp_path):
+    repo = main.repo
+    user_ids = add_users(repo)
+    sent_before = set()
+
+    def delete_earlier(user_id):
+        # Users already sent to leave while the job runs, shifting any offset-based cursor
+        for earlier in sent_before:
+            repo.delete_user(earlier)
+        sent_before.clear()
+        sent_before.add(user_id)
+
+    bot = FakeBot(delete_earlier)
+    broadcaster = Broadcaster(repo, str(tmp_path / "broadcast.json"), rate=1e6)
+    broadcast(broadcaster, bot)
+    assert sorted(bot.received) == user_ids
+    assert broadcaster.job["status"] == "done" and broadcaster.job["sent"] == USERS
+
+
+@pytest.mark.parametrize("main", ["json", "sqlite"], indirect=True)
+def test_resumes_an_offset_checkpoint(main, tmp_path):
+    repo = main.repo
+    user_ids = add_users(repo)
+    state_path = tmp_path / "broadcast.json"
+    state_path.write_text(json.dumps({
+        "id": "old", "text": "hello", "admin_chat_id": 1, "progress_message_id": 1, "cursor": BATCH_SIZE,
+        "total": USERS, "sent": BATCH_SIZE, "failed": 0, "blocked_total": 0, "blocked": [],
+        "started_at": 0, "status": "running"}))
+
+    bot = FakeBot()
+    broadcast(Broadcaster(repo, str(state_path), rate=1e6), bot, resume=True)
+    assert sorted(bot.received) == sorted(set(user_ids) - set(repo.list_user_ids(0, BATCH_SIZE)))
@@ -0,0 +1,116 @@
+# tests/test_ledger_stress.py
+"""Thousands of concurrent redeem, withdraw and cancel updates through the real handlers.
+
+Every update goes through `Application.update_queue` with `concurrent_updates=True`, so
+updates for the same user race each other as they would in production. Balances plus
+pending withdrawals must add up to what was put in plus what was redeemed, and a capped
+code must stop at its cap.
+"""
+
+import asyncio
+
+import pytest
+
+from bench import FakeBotAPI, UpdateFactory
+
+USERS = 900  # A third redeem the open code, a third the capped one, a third withdraw
+FIRST_USER_ID = 1_000_000
+START_BALANCE = 1000  # Paise
+PENDING = 200  # Paise, one pending withdrawal per user before the burst
+WITHDRAW = "3"  # Rupees the withdrawing half asks for during the burst
+UNLIMITED_VALUE, CAPPED_VALUE, CAP = 100, 50, 100
+REPEATS = 4  # Copies of each code and each cancel a user fires at once
+DRAIN_TIMEOUT = 120  # Seconds; a deadlock fails the test instead of hanging it
+
+
+async def drain(application, updates):
+    for update in updates:
+        application.update_queue.put_nowait(update)
+    await asyncio.wait_for(application.update_queue.join(), DRAIN_TIMEOUT)
+
+
+async def stress(main):
+    repo, ledger = main.repo, main.ledger
+    user_ids = [str(FIRST_USER_ID + i) for i in range(USERS)]
+    # A redeem ends the conversation, so each user goes for one code
+    open_redeemers, capped_redeemers, withdrawers = user_ids[0::3], user_ids[1::3], user_ids[2::3]
+    codes = dict.fromkeys(open_redeemers, "OPEN") | dict.fromkeys(capped_redeemers, "CAPPED")
+    errors = []
+
+    async def on_error(update, context):
+        errors.append(context.error)
+
+    application = main.build_application(request=FakeBotAPI())
+    application.add_error_handler(on_error)
+    await application.initialize()
+    try:
+        await main.post_init(application)
+        await application.start()
+        try:
+            with repo.transaction():
+                for user_id in user_ids:
+                    repo.adjust_balance(user_id, START_BALANCE)
+                repo.add_code("OPEN", UNLIMITED_VALUE)
+                repo.add_code("CAPPED", CAPPED_VALUE, max_uses=CAP)
+            pending = {}
+            for user_id in user_ids:
+                request, _ = await ledger.withdraw(user_id, PENDING, "before@upi")
+                pending[user_id] = request["id"]
+
+            # Put every user in the conversation state the burst needs
+            factory = UpdateFactory(application.bot)
+            await drain(application, [factory.callback(u, "user_redeem") for u in codes] +
+                        [factory.callback(u, "user_withdraw") for u in withdrawers])
+            await drain(application, [factory.text(u, WITHDRAW) for u in withdrawers])
+
+            burst = []
+            for user_id in user_ids:
+                cancel = f"user_cancel_withdraw_confirm_{pending[user_id]}"
+                burst += [factory.callback(user_id, cancel) for _ in range(REPEATS)]
+                if user_id in codes:
+                    burst += [factory.text(user_id, codes[user_id]) for _ in range(REPEATS)]
+                else:
+                    burst.append(factory.text(user_id, "burst@upi"))
+            assert len(burst) > 5000
+            await drain(application, burst)
+            await main.save_data(urgent=True)
+            assert errors == []
+            assert_conserved(repo, open_redeemers, capped_redeemers, withdrawers, pending)
+        finally:
+            await application.stop()
+    finally:
+        await application.shutdown()
+        await main.post_shutdown(application)
+
+
+def assert_conserved(repo, open_redeemers, capped_redeemers, withdrawers, pending):
+    capped = repo.get_code("CAPPED")
+    assert capped["uses"] == CAP and capped["remaining"] == 0
+    assert repo.get_code("OPEN")["uses"] == len(open_redeemers)
+    capped_users = {u for u in capped_redeemers if repo.has_redeemed("CAPPED", u)}
+    assert len(capped_users) == CAP
+
+    total = 0
+    for user_id in open_redeemers + capped_redeemers:
+        if user_id in capped_users:
+            expected = START_BALANCE + CAPPED_VALUE
+        elif user_id in capped_redeemers:
+            expected = START_BALANCE
+        else:
+            expected = START_BALANCE + UNLIMITED_VALUE
+        assert repo.get_user(user_id)["balance"] == expected
+        assert repo.get_user_withdrawals(user_id) == []
+        total += expected
+    for user_id in withdrawers:
+        assert repo.get_user(user_id)["balance"] == START_BALANCE - 300
+        assert [w["amount"] for w in repo.get_user_withdrawals(user_id)] == [300]
+        assert repo.get_withdrawal(pending[user_id]) is None
+        total += START_BALANCE
+    assert total == USERS * START_BALANCE + UNLIMITED_VALUE * len(open_redeemers) + CAPPED_VALUE * CAP
+
+
+@pytest.mark.parametrize("main", ["json", "sqlite", "redis"], indirect=True)
+def test_concurrent_updates_conserve_money(main):
+    main.CONCURRENT_UPDATES = True
+    main.throttle.rules = {kind: (1e6, 1e6) for kind in ("callback", "message", "command", "redeem")}
+    asyncio.run(stress(main))
@@ -0,0 +1,94 @@
+# tests/test_outbound.py
+
+import asyncio
+import json
+import time
+
+from telegram.request import BaseRequest, RequestData
+from telegram.request._requestparameter import RequestParameter
+
+from outbound import OutboundScheduler
+
+URL = "https://api.telegram.org/bot1:x/"
+
+
+class ScriptedAPI(BaseRequest):
+    """Answers calls in-process; `flooded` chats get one 429 each, with `retry_after`."""
+
+    def __init__(self, flooded=(), retry_after=0.3, delay=0.0):
+        self.flooded = set(flooded)
+        self.retry_after = retry_after
+        self.delay = delay
+        self.calls = []  # (api method, chat_id, monotonic time)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        chat = request_data.json_parameters.get("chat_id") if request_data else None
+        self.calls.append((url.rsplit("/", 1)[-1], chat, time.monotonic()))
+        await asyncio.sleep(self.delay)
+        if chat in self.flooded:
+            self.flooded.discard(chat)
+            return 429, json.dumps({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                    "parameters": {"retry_after": self.retry_after}}).encode()
+        return 200, json.dumps({"ok": True, "result": {"chat": chat}}).encode()
+
+
+def call(scheduler, api_method, **params):
+    data = RequestData([RequestParameter.from_input(key, value) for key, value in params.items()])
+    return scheduler.do_request(URL + api_method, "POST", request_data=data)
+
+
+def test_flood_pauses_only_that_chat():
+    async def run():
+        api = ScriptedAPI(flooded={"1"})
+        scheduler = OutboundScheduler(api, slots=2)
+        started = time.monotonic()
+        flooded = asyncio.create_task(call(scheduler, "sendMessage", chat_id=1, text="a"))
+        await asyncio.sleep(0.01)
+        assert (await call(scheduler, "sendMessage", chat_id=2, text="b"))[0] == 200
+        assert time.monotonic() - started < 0.2  # Not held back by chat 1
+        assert scheduler.stats()["paused_chats"] == 1 and scheduler.paused_for() == 0
+        assert (await flooded)[0] == 200
+        assert time.monotonic() - started >= 0.3  # Retried after retry_after
+        return api.calls
+    calls = asyncio.run(run())
+    assert [chat for _, chat, _ in calls] == ["1", "2", "1"]
+
+
+def test_flood_on_many_chats_pauses_everything():
+    async def run():
+        api = ScriptedAPI(flooded={"1", "2"})
+        scheduler = OutboundScheduler(api, slots=4, global_after=2)
+        started = time.monotonic()
+        flooded = [asyncio.create_task(call(scheduler, "sendMessage", chat_id=chat, text="x")) for chat in (1, 2)]
+        await asyncio.sleep(0.01)
+        assert scheduler.paused_for() > 0
+        assert (await call(scheduler, "sendMessage", chat_id=3, text="y"))[0] == 200
+        waited = time.monotonic() - started
+        return [status for status, _ in await asyncio.gather(*flooded)], waited
+    statuses, waited = asyncio.run(run())
+    assert statuses == [200, 200]
+    assert waited >= 0.3
+
+
+def test_callback_answers_jump_the_queue_and_return_the_real_result():
+    async def run():
+        api = ScriptedAPI(delay=0.05)
+        scheduler = OutboundScheduler(api, slots=1)
+        sends = [asyncio.create_task(call(scheduler, "sendMessage", chat_id=chat, text="x")) for chat in range(3)]
+        await asyncio.sleep(0.01)
+        answer = await call(scheduler, "answerCallbackQuery", callback_query_id="q")
+        await asyncio.gather(*sends)
+        return answer, [name for name, _, _ in api.calls]
+    (status, payload), order = asyncio.run(run())
+    assert status == 200 and json.loads(payload)["result"] == {"chat": None}
+    assert order == ["sendMessage", "answerCallbackQuery", "sendMessage", "sendMessage"]
@@ -0,0 +1,252 @@
+# tests/test_persistence.py
+
+import asyncio
+import os
+import time
+
+import pytest
+
+from ledger import AlreadyRedeemed, Ledger, WithdrawalNotFound
+from persistence import CORRUPT_SUFFIX, PersistenceService, SnapshotError
+from storage import HistoryStore, JsonRepository, TransactionLog, UserRecord, empty_data, json_journal
+
+
+def open_repo(directory):
+    journal = json_journal(str(directory / "data.json"), backups=2)
+    return JsonRepository(journal, PersistenceService(journal), empty_data,
+                          history=HistoryStore(str(directory / "history.db")),
+                          transactions=TransactionLog.open(str(directory / "ledger.db")))
+
+def close_repo(repo):
+    repo.journal.close()
+    repo.history.close()
+    repo.transactions.close()
+
+def drop_backups(directory):
+    for path in directory.glob("data.json.bak*"):
+        path.unlink()
+
+def damage(path):
+    raw = bytearray(path.read_bytes())
+    raw[-5] ^= 1
+    path.write_bytes(bytes(raw))
+
+
+@pytest.fixture
+def saved(tmp_path):
+    """A data.json holding one user with 700 paise, a code and some config, compacted once."""
+    repo = open_repo(tmp_path)
+    repo.ensure_user("1")
+    repo.adjust_balance("1", 700)
+    repo.add_code("CODE", 100)
+    repo.set_config("support_info", "@help")
+    repo.journal.compact()
+    close_repo(repo)
+    return tmp_path
+
+
+def test_corrupt_snapshot_without_backup_refuses_every_start(saved):
+    drop_backups(saved)
+    snapshot = saved / "data.json"
+    damage(snapshot)
+    damaged = snapshot.read_bytes()
+    for _ in range(2):
+        with pytest.raises(SnapshotError):
+            open_repo(saved)
+        assert snapshot.read_bytes() == damaged  # Left where it was for a human to restore
+        assert not os.path.exists(str(snapshot) + CORRUPT_SUFFIX)
+
+
+def test_leftover_corrupt_file_refuses_start(saved):
+    drop_backups(saved)
+    snapshot = saved / "data.json"
+    os.replace(snapshot, str(snapshot) + CORRUPT_SUFFIX)
+    with pytest.raises(SnapshotError):
+        open_repo(saved)
+
+
+def test_corrupt_snapshot_falls_back_to_backup_and_journals(saved):
+    repo = open_repo(saved)
+    repo.adjust_balance("1", 50)
+    repo.journal.compact()  # data.json.bak1 is the snapshot from the fixture
+    repo.journal.apply("set", ("users", "2"), UserRecord(10, "t"))
+    close_repo(repo)
+    damage(saved / "data.json")
+
+    for _ in range(2):  # The second start no longer has data.json at all
+        repo = open_repo(saved)
+        assert repo.journal.recovered_from == str(saved / "data.json.bak1")
+        assert repo.get_user("1")["balance"] == 750
+        assert repo.get_user("2")["balance"] == 10
+        assert repo.get_code("CODE")["value"] == 100
+        assert repo.get_config("support_info") == "@help"
+        close_repo(repo)
+    assert os.path.exists(str(saved / "data.json") + CORRUPT_SUFFIX)
+
+
+def test_legacy_snapshot_without_header_loads(tmp_path):
+    (tmp_path / "data.json").write_text(
+        '{"users": {"1": {"balance": 7, "joined_at": "t"}}, "codes": {}, "links": [], "config": {},'
+        ' "pending_withdrawals": {}, "ledger": {"units": "paise", "seq": 0}}')
+    repo = open_repo(tmp_path)
+    assert repo.get_user("1")["balance"] == 7
+    close_repo(repo)
+
+
+def test_mutations_during_compaction_stay_out_of_the_snapshot(saved):
+    repo = open_repo(saved)
+    journal = repo.journal
+    snapshot = journal.begin_compaction()
+    repo.adjust_balance("1", 50)
+    repo.create_withdrawal({"id": "w1", "user_id": "1", "amount": 200, "upi": "a@upi", "timestamp": "t"})
+    repo.record_redemption("CODE", "1")
+    repo.ensure_user("2")
+    repo.set_config("support_info", "@other")
+    journal.finish_compaction(snapshot)  # What a worker thread does meanwhile
+    journal.end_compaction()
+
+    # The snapshot holds the state compaction began with
+    written = json_journal(str(saved / "data.json"))._read_snapshot(str(saved / "data.json"))
+    assert written["users"]["1"].balance == 700 and not written["users"]["1"].pending_withdrawals
+    assert "2" not in written["users"] and "w1" not in written["pending_withdrawals"]
+    assert "1" not in written["codes"]["CODE"]["used_by"]
+    assert written["config"]["support_info"] == "@help"
+
+    # ...and the journal everything after it
+    close_repo(repo)
+    repo = open_repo(saved)
+    assert repo.get_user("1")["balance"] == 750 and repo.get_user("2") is not None
+    assert [w["id"] for w in repo.get_user_withdrawals("1")] == ["w1"]
+    assert repo.has_redeemed("CODE", "1") and repo.get_config("support_info") == "@other"
+    close_repo(repo)
+
+
+def test_stop_waits_for_an_inflight_flush(saved, monkeypatch):
+    repo = open_repo(saved)
+    write_pending = repo.journal.write_pending
+
+    def slow_write(lines, sync=False):
+        time.sleep(0.2)
+        return write_pending(lines, sync)
+
+    monkeypatch.setattr(repo.journal, "write_pending", slow_write)
+
+    async def run():
+        repo.persistence.start()
+        repo.adjust_balance("1", 25)
+        durable = repo.persistence.mark_dirty(urgent=True)
+        await asyncio.sleep(0.05)  # The flush is now in the executor
+        await asyncio.wait_for(repo.persistence.stop(), 5)
+        assert durable.done() and durable.exception() is None
+
+    asyncio.run(run())
+    close_repo(repo)
+    repo = open_repo(saved)
+    assert repo.get_user("1")["balance"] == 725
+    close_repo(repo)
+
+
+def test_only_waited_for_flushes_are_fsynced(saved, monkeypatch):
+    repo = open_repo(saved)
+    fsyncs = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: fsyncs.append(fd) or real_fsync(fd))
+
+    async def run():
+        service = repo.persistence
+        service.start()
+        repo.adjust_balance("1", 1)
+        service.mark_dirty()
+        await service._flush()
+        assert fsyncs == [] and repo.journal.unsynced
+
+        await service.mark_dirty(urgent=True)  # Nothing buffered, but the last write isn't synced
+        assert len(fsyncs) == 1 and not repo.journal.unsynced
+
+        repo.adjust_balance("1", 1)
+        await service.mark_dirty(urgent=True)
+        assert len(fsyncs) == 2
+        await service.stop()
+
+    asyncio.run(run())
+    close_repo(repo)
+
+
+# --- Crash recovery of ledger operations ---
+def run_unflushed(repo, operation):
+    """Runs a Ledger coroutine whose commit returns without flushing, as if the process died there."""
+    async def no_flush(urgent=False):
+        pass
+
+    repo.commit = no_flush
+    return asyncio.run(operation(Ledger(repo)))
+
+def flush_and_log(repo):
+    asyncio.run(repo.persistence._flush())
+
+def crash(repo, flushed):
+    """Kills the repo: buffered records are lost; with `flushed`, they reached the journal but not the log."""
+    if flushed:
+        repo.journal.flush()
+    repo.journal._buffer.clear()
+    repo.journal._file.close()
+    repo.history.close()
+    repo.transactions.close()
+
+def assert_reconciled(repo):
+    assert asyncio.run(Ledger(repo).reconcile())["mismatches"] == []
+
+
+@pytest.mark.parametrize("flushed", [False, True])
+def test_crash_during_redeem_loses_all_or_nothing(saved, flushed):
+    repo = open_repo(saved)
+    run_unflushed(repo, lambda ledger: ledger.redeem("1", "CODE"))
+    crash(repo, flushed)
+
+    repo = open_repo(saved)
+    assert_reconciled(repo)
+    assert repo.has_redeemed("CODE", "1") == flushed
+    assert repo.get_user("1")["balance"] == (800 if flushed else 700)
+    if not flushed:
+        run_unflushed(repo, lambda ledger: ledger.redeem("1", "CODE"))
+        flush_and_log(repo)
+    with pytest.raises(AlreadyRedeemed):
+        run_unflushed(repo, lambda ledger: ledger.redeem("1", "CODE"))
+    assert repo.get_user("1")["balance"] == 800
+    assert_reconciled(repo)
+    close_repo(repo)
+
+
+@pytest.mark.parametrize("flushed", [False, True])
+def test_crash_during_withdraw_loses_all_or_nothing(saved, flushed):
+    repo = open_repo(saved)
+    request, _ = run_unflushed(repo, lambda ledger: ledger.withdraw("1", 400, "me@upi"))
+    crash(repo, flushed)
+
+    repo = open_repo(saved)
+    assert_reconciled(repo)
+    pending = [(w["id"], w["amount"], w["upi"]) for w in repo.get_user_withdrawals("1")]
+    assert pending == ([(request["id"], 400, "me@upi")] if flushed else [])
+    assert repo.get_user("1")["balance"] == (300 if flushed else 700)
+    close_repo(repo)
+
+
+@pytest.mark.parametrize("flushed", [False, True])
+def test_crash_during_cancel_refunds_once(saved, flushed):
+    repo = open_repo(saved)
+    request, _ = run_unflushed(repo, lambda ledger: ledger.withdraw("1", 400, "me@upi"))
+    flush_and_log(repo)
+    run_unflushed(repo, lambda ledger: ledger.cancel_withdrawal("1", request["id"]))
+    crash(repo, flushed)
+
+    repo = open_repo(saved)
+    assert_reconciled(repo)
+    assert (repo.get_withdrawal(request["id"]) is None) == flushed
+    if not flushed:
+        run_unflushed(repo, lambda ledger: ledger.cancel_withdrawal("1", request["id"]))
+        flush_and_log(repo)
+    with pytest.raises(WithdrawalNotFound):
+        run_unflushed(repo, lambda ledger: ledger.cancel_withdrawal("1", request["id"]))
+    assert repo.get_user("1")["balance"] == 700
+    assert_reconciled(repo)
+    close_repo(repo)
@@ -0,0 +1,74 @@
+# tests/test_shared_state.py
+
+import asyncio
+from types import SimpleNamespace
+
+from shared_state import RedisRepository, connect
+
+CHAT_ID = USER_ID = 1000001
+
+
+def open_repo():
+    return RedisRepository(connect("memory://"), default_config={})
+
+def update_from(user_id):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=user_id), effective_user=SimpleNamespace(id=user_id))
+
+
+def test_lock_waiter_leaves_the_loop_running():
+    repo = open_repo()
+
+    async def scenario():
+        order, ticks = [], 0
+
+        async def holder():
+            async with repo.lock("user:1"):
+                order.append("held")
+                await asyncio.sleep(0.05)
+            order.append("released")
+
+        async def waiter():
+            await asyncio.sleep(0.01)
+            async with repo.lock("user:1"):
+                order.append("taken")
+
+        async def ticker():
+            nonlocal ticks
+            while len(order) < 3:
+                ticks += 1
+                await asyncio.sleep(0.001)
+
+        await asyncio.gather(holder(), waiter(), ticker())
+        return order, ticks
+
+    order, ticks = asyncio.run(scenario())
+    assert order == ["held", "released", "taken"]
+    assert ticks > 10
+    assert repo.client.keys("bot:lock:*") == []
+
+
+def test_handler_state_is_read_once_and_written_at_flush(monkeypatch):
+    repo = open_repo()
+    states = repo.conversation_store("redeem")
+    repo.client.hset(states.key, f"{CHAT_ID}:{USER_ID}", "1")
+    repo.client.hset(repo._k("ud", str(USER_ID)), "draft", '"old"')
+
+    async def handle():
+        await repo.prefetch(update_from(USER_ID))
+        with monkeypatch.context() as patched:  # Handlers must not reach Redis
+            for command in ("hget", "hset", "hdel", "hexists", "hkeys", "hlen", "hgetall", "delete"):
+                patched.setattr(repo.client, command, None)
+            user_data = repo.user_data_store(USER_ID)
+            assert states[(CHAT_ID, USER_ID)] == 1
+            assert dict(user_data) == {"draft": "old"}
+            states[(CHAT_ID, USER_ID)] = 2
+            user_data["amount"] = 300
+            del user_data["draft"]
+            assert states[(CHAT_ID, USER_ID)] == 2 and dict(user_data) == {"amount": 300}
+        assert repo.client.hget(states.key, f"{CHAT_ID}:{USER_ID}") == "1"
+        await repo.flush()
+
+    asyncio.run(handle())
+    assert repo.client.hget(states.key, f"{CHAT_ID}:{USER_ID}") == "2"
+    assert repo.client.hgetall(repo._k("ud", str(USER_ID))) == {"amount": "300"}
+    assert states[(CHAT_ID, USER_ID)] == 2  # Outside an update, reads go to Redis
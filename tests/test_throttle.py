@@ -0,0 +1,45 @@
+# tests/test_throttle.py
+
+import asyncio
+
+from bench import FakeBotAPI, UpdateFactory
+
+USER_ID = "1000001"
+
+
+async def run(main, steps):
+    """Feeds `steps` (factory -> update) to the bot in order, then shuts it down."""
+    application = main.build_application(request=FakeBotAPI())
+    await application.initialize()
+    await main.post_init(application)
+    try:
+        factory = UpdateFactory(application.bot)
+        for step in steps:
+            await application.process_update(step(factory))
+    finally:
+        await application.shutdown()
+        await main.post_shutdown(application)
+
+
+def test_wrong_codes_only_block_redeeming(main):
+    main.throttle.rules = dict(main.THROTTLE_RULES, message=(1e6, 1e6))
+    main.throttle.clock = lambda: 0.0  # Nothing refills during the test
+    with main.repo.transaction():
+        main.repo.ensure_user(USER_ID)
+        main.repo.adjust_balance(USER_ID, 1000)
+        main.repo.add_code("GOOD", 100)
+    burst = main.THROTTLE_RULES["redeem"][1]
+
+    asyncio.run(run(main, [
+        lambda f: f.callback(USER_ID, "user_redeem"),
+        *[lambda f, i=i: f.text(USER_ID, f"WRONG{i}") for i in range(burst)],
+        lambda f: f.text(USER_ID, "GOOD"),  # Refused: the bucket is empty
+        lambda f: f.callback(USER_ID, "back_to_main"),
+        lambda f: f.callback(USER_ID, "user_withdraw"),
+        lambda f: f.text(USER_ID, "4"),
+        lambda f: f.text(USER_ID, "me@upi"),
+    ]))
+
+    assert not main.repo.has_redeemed("GOOD", USER_ID)
+    assert [w["amount"] for w in main.repo.get_user_withdrawals(USER_ID)] == [400]
+    assert main.repo.get_user(USER_ID)["balance"] == 600
@@ -0,0 +1,45 @@
+# tests/test_webhook.py
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from telegram import Bot
+
+from webhook import SECRET_HEADER, WebhookServer
+
+SECRET = "s3cret"
+UPDATE = {"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 5, "type": "private"},
+                                      "from": {"id": 5, "is_bot": False, "first_name": "U"}, "text": "hi"}}
+
+
+def post(payload, headers):
+    """POSTs `payload` to a fresh server. Returns (status, updates queued)."""
+    async def run():
+        application = SimpleNamespace(bot=Bot("1:x"), update_queue=asyncio.Queue())
+        server = WebhookServer(application, secret_token=SECRET)
+        async with TestClient(TestServer(server.make_app())) as client:
+            response = await client.post("/telegram", json=payload, headers=headers)
+            return response.status, application.update_queue.qsize()
+    return asyncio.run(run())
+
+
+def test_secret_is_required():
+    with pytest.raises(ValueError):
+        WebhookServer(SimpleNamespace(), secret_token=None)
+
+
+@pytest.mark.parametrize("headers", [{}, {SECRET_HEADER: "wrong"}])
+def test_rejects_missing_or_wrong_secret(headers):
+    assert post(UPDATE, headers) == (403, 0)
+
+
+def test_queues_update_with_secret():
+    assert post(UPDATE, {SECRET_HEADER: SECRET}) == (200, 1)
+    assert post([UPDATE, UPDATE], {SECRET_HEADER: SECRET}) == (200, 2)
+
+
+@pytest.mark.parametrize("payload", [42, "update", [UPDATE, 1], {"update_id": 1, "message": {"chat": 5}}])
+def test_rejects_non_update_bodies(payload):
+    assert post(payload, {SECRET_HEADER: SECRET}) == (400, 0)
@@ -0,0 +1,98 @@
+# throttle.py
+
+import collections
+import re
+import time
+
+from metrics import THROTTLED
+
+# Trailing arguments of callback data, e.g. the page in "admin_view_users_0" or the id in
+# "user_cancel_withdraw_confirm_<uuid>", so one action maps onto one bucket
+_ARGUMENT = re.compile(r"_[^_]*\d[^_]*$")
+
+
+def update_action(update):
+    """Names what an update asks for: "callback:<name>", "command" or "message"; None otherwise."""
+    if update.callback_query is not None:
+        return "callback:" + _ARGUMENT.sub("", (update.callback_query.data or "").split("|", 1)[0])
+    message = update.message
+    if message is None:
+        return None
+    if message.text and message.text.startswith("/"):
+        return "command"
+    return "message"
+
+
+class Throttle:
+    """Token buckets per (user, action), held in memory by the worker that sees the updates.
+
+    `rules` maps an action, or the kind before its ":" as a default, to (tokens per second,
+    burst). A bucket starts full, so an entry that has been idle long enough to refill is
+    the same as no entry; those are dropped as new buckets are made, and the least recently
+    used beyond `max_buckets` go too, which bounds memory whatever the number of users.
+    Every call is O(1) and touches no storage and no network.
+    """
+
+    def __init__(self, rules, max_buckets=100_000, clock=time.monotonic):
+        self.rules = rules
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self._buckets = collections.OrderedDict()  # (user_id, action) -> [tokens, updated_at, warned]
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _rule(self, action):
+        return self.rules.get(action) or self.rules[action.split(":", 1)[0]]
+
+    def _bucket(self, user_id, action):
+        now = self.clock()
+        rate, burst = self._rule(action)
+        key = (user_id, action)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._evict(now)
+            bucket = self._buckets[key] = [float(burst), now, False]
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        return bucket
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            (_, action), (tokens, updated_at, _) = next(iter(buckets.items()))
+            rate, burst = self._rule(action)
+            if len(buckets) < self.max_buckets and tokens + (now - updated_at) * rate < burst:
+                return
+            buckets.popitem(last=False)
+
+    def allow(self, user_id, action):
+        """Takes a token for `action`. Returns False, and counts the rejection, when there is none."""
+        bucket = self._bucket(user_id, action)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True
+        THROTTLED.inc(action)
+        return False
+
+    def charge(self, user_id, action):
+        """Takes a token even if that empties the bucket, e.g. for each wrong code a user tries."""
+        bucket = self._bucket(user_id, action)
+        bucket[0] = max(bucket[0] - 1, 0.0)
+
+    def exhausted(self, user_id, action):
+        """True while the bucket has less than one token, without taking any."""
+        if (user_id, action) not in self._buckets:
+            return False
+        return self._bucket(user_id, action)[0] < 1
+
+    def first_rejection(self, user_id, action):
+        """True once per run of rejections, so the user is told to slow down only once."""
+        bucket = self._buckets.get((user_id, action))
+        if bucket is None or bucket[2]:
+            return False
+        bucket[2] = True
+        return True
@@ -0,0 +1,201 @@
+# webhook.py
+
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import time
+
+from aiohttp import web
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_BODY_SIZE = 16 * 1024 * 1024  # Enough for a few thousand recorded updates in one POST
+
+
+class WebhookServer:
+    """Receives updates over HTTP and feeds them into the application's update queue.
+
+    Telegram POSTs one update per request; a local replay may POST a JSON array to push a
+    whole batch through one request. Updates are queued and acknowledged straight away,
+    while the handlers run on the application's own update processor.
+
+    On SIGTERM/SIGINT the server drains: the health check and new POSTs answer 503 (Telegram
+    redelivers those later), the updates already queued are processed, and only then is the
+    application stopped. `Application.stop` drops whatever is still queued, hence the wait.
+
+    `secret_token` is required: without it anyone who can reach the port could POST updates
+    claiming to come from an admin.
+    """
+
+    def __init__(self, application, host="0.0.0.0", port=8080, path="/telegram", secret_token=None,
+                 drain_timeout=30.0, reuse_port=False):
+        if not secret_token:
+            raise ValueError("A webhook needs a secret token")
+        self.application = application
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.drain_timeout = drain_timeout
+        self.reuse_port = reuse_port
+        self.draining = False
+        self.received = 0
+        self.started_at = None
+        self._stopped = asyncio.Event()
+        self._runner = None
+
+    def make_app(self):
+        app = web.Application(client_max_size=MAX_BODY_SIZE)
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/healthz", self.handle_health)
+        return app
+
+    # --- Routes ---
+    async def handle_update(self, request):
+        if self.draining:
+            return web.Response(status=503, text="draining")
+        given = request.headers.get(SECRET_HEADER, "").encode("utf-8")
+        if not hmac.compare_digest(given, self.secret_token.encode("utf-8")):
+            return web.Response(status=403)
+        try:
+            payload = await request.json(loads=json.loads)
+        except ValueError:
+            return web.Response(status=400, text="invalid JSON")
+        items = payload if isinstance(payload, list) else [payload]
+        if not all(isinstance(data, dict) for data in items):
+            return web.Response(status=400, text="expected an update object or an array of them")
+
+        bot = self.application.bot
+        try:
+            updates = [Update.de_json(data, bot) for data in items]
+        except (KeyError, TypeError, ValueError):
+            return web.Response(status=400, text="malformed update")
+        queue = self.application.update_queue
+        for update in updates:
+            if update is not None:
+                queue.put_nowait(update)
+                self.received += 1
+        return web.Response()
+
+    async def handle_health(self, request):
+        body = {
+            "status": "draining" if self.draining else "ok",
+            "queued": self.application.update_queue.qsize(),
+            "received": self.received,
+            "uptime": round(time.monotonic() - self.started_at, 1) if self.started_at else 0,
+        }
+        return web.json_response(body, status=503 if self.draining else 200)
+
+    # --- Lifecycle ---
+    async def start(self):
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port, reuse_port=self.reuse_port or None).start()
+        self.started_at = time.monotonic()
+        logger.info("Webhook server listening on http://%s:%d%s", self.host, self.port, self.path)
+
+    def request_stop(self):
+        self._stopped.set()
+
+    async def wait_stopped(self):
+        await self._stopped.wait()
+
+    async def drain(self):
+        """Stops accepting updates and waits for the queued ones to be picked up."""
+        self.draining = True
+        queue = self.application.update_queue
+        deadline = time.monotonic() + self.drain_timeout
+        while not queue.empty() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if not queue.empty():
+            logger.warning("Drain timed out with %d updates still queued", queue.qsize())
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def serve(application, server, webhook_url=None, max_connections=40):
+    """Runs `application` behind `server` until SIGTERM/SIGINT, then drains and shuts down.
+
+    Mirrors the lifecycle of `Application.run_polling`, including the post_init/post_stop/
+    post_shutdown hooks. The webhook is registered with Telegram only when `webhook_url` is
+    given, so a local benchmark can POST recorded updates without touching the real bot.
+    """
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, server.request_stop)
+        except NotImplementedError:  # Windows
+            pass
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=webhook_url + server.path, secret_token=server.secret_token,
+                allowed_updates=Update.ALL_TYPES, max_connections=min(max(max_connections, 1), 100))
+        await server.wait_stopped()
+
+        logger.info("Stop signal received, draining %d queued updates", application.update_queue.qsize())
+        await server.drain()
+        await server.close()
+        await application.stop()  # Also waits for the updates already being processed
+        if application.post_stop:
+            await application.post_stop(application)
+    finally:
+        await server.close()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+# --- Local replay ---
+async def replay(url, path, secret_token=None, batch_size=1, concurrency=8):
+    """POSTs the updates in a JSONL file to a running webhook and prints the throughput.
+
+    Lines that are not Telegram updates (no "update_id") are skipped.
+    """
+    import aiohttp
+
+    with open(path, "r", encoding="utf-8") as f:
+        updates = [u for u in (json.loads(line) for line in f if line.strip()) if "update_id" in u]
+    batches = [updates[i:i + batch_size] for i in range(0, len(updates), batch_size)]
+    headers = {SECRET_HEADER: secret_token} if secret_token else {}
+    failures = 0
+    started = time.perf_counter()
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        pending = iter(batches)
+
+        async def worker():
+            nonlocal failures
+            for batch in pending:
+                async with session.post(url, json=batch if batch_size > 1 else batch[0]) as resp:
+                    if resp.status != 200:
+                        failures += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    elapsed = time.perf_counter() - started
+    print(f"{len(updates)} updates in {len(batches)} requests, {elapsed:.2f}s "
+          f"({len(updates) / max(elapsed, 1e-9):.0f} updates/s), {failures} failed requests")
+
+
+if __name__ == "__main__":
+    # Usage: python webhook.py updates.jsonl http://127.0.0.1:8080/telegram [secret] [batch_size]
+    import sys
+
+    if len(sys.argv) < 3:
+        sys.exit("usage: python webhook.py UPDATES.jsonl URL [SECRET] [BATCH_SIZE]")
+    asyncio.run(replay(sys.argv[2], sys.argv[1], sys.argv[3] if len(sys.argv) > 3 else None,
+                       int(sys.argv[4]) if len(sys.argv) > 4 else 1))